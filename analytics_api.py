@@ -1,93 +1,243 @@
-import json
-import subprocess
-import sys
+import logging
+import re
+import threading
 import time
+from argparse import ArgumentParser, BooleanOptionalAction
+from collections import Counter
+from urllib.parse import quote
 
 import requests
 import websocket
 
-SUBSCRIBED_TOPICS = [
-    "SIFIS:Privacy_Aware_Speech_Recognition",
-    "SIFIS:Privacy_Aware_Parental_Control",
-    "SIFIS:Privacy_Aware_Device_Anomaly_Detection",
-    "SIFIS:Privacy_Aware_Object_Recognition",
-    "SIFIS:Privacy_Aware_Face_Recognition",
-    "SIFIS:Publish_Alarms_Request",
-    "SIFIS:AUD_Manager_Request",
-    "SIFIS:Privacy_Aware_Speech_Recognition_Results",
-    "SIFIS:Privacy_Aware_Parental_Control_Results",
-    "SIFIS:Privacy_Aware_Object_Recognition_Results",
-    "SIFIS:Privacy_Aware_Object_Recognition_Frame_Results",
-    "SIFIS:Privacy_Aware_Device_Anomaly_Detection_Results",
-    "SIFIS:Netspot_Control_Results",
-    "SIFIS:AUD_Manager_Results",
-    "SIFIS:Object_Recognition",
-    "SIFIS:Object_Recognition_Frame_Results",
-    "SIFIS:Object_Recognition_Results",
-    "SIFIS:Privacy_Aware_Speaker_Verification",
-    "SIFIS:Privacy_Aware_Audio_Anomaly_Detection",
-    "SIFIS:Privacy_Aware_Audio_Anomaly_Detection_Results",
-    "SIFIS:Privacy_Aware_Face_Recognition_CAM",
-]
-
-
-def get_last_time():
-    """Reads last_time.txt and returns timestamp from there or 0 for known errors"""
-    try:
-        file = open("last_time.txt")
-        timestamp = int(file.readline().rstrip())
-        file.close()
-        return timestamp
-    except (FileNotFoundError, ValueError):
-        return 0
+import async_gateway
+import backends
+import codec
+import device_anomaly
+import logs
+import metrics
+import tracing
+from async_gateway import DEFAULT_MAX_IN_FLIGHT
+from audio_windows import (
+    DEFAULT_HOP,
+    DEFAULT_PIPELINE,
+    DEFAULT_WINDOW,
+    WindowedAudioAnomaly,
+)
+from backends import BACKENDS, BackendRequest, FallbackHandler, Field, Upload
+from camera import DEFAULT_MAX_FPS, CameraSessions
+from deepspeech_pool import DeepSpeechPool
+from dispatch import (
+    DEFAULT_MAX_WORKERS,
+    TOPIC_LIMITS,
+    TOPIC_PRIORITIES,
+    Dispatcher,
+)
+from face_db import DEFAULT_CHECK_INTERVAL, FaceDatabaseIndex
+from netspot import (
+    DEFAULT_CURSOR_FILE,
+    DEFAULT_GROUP_BY,
+    DEFAULT_MAX_INTERVAL,
+    DEFAULT_MIN_INTERVAL,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_TOP_K,
+    AlarmPoller,
+    AlarmSummary,
+    CursorStore,
+    fetch_alarm_page,
+    summary_message,
+)
+from object_stream import DEFAULT_CHUNK_SIZE, ObjectStreams
+from result_cache import DEFAULT_TTL, ResultCache
+from speaker_verification import DEFAULT_WORKERS as DEFAULT_SPEAKER_WORKERS
+from speaker_verification import SpeakerVerification
+
+DHT_URL = "ws://localhost:3000/ws"
+
+log = logs.log
+
+# Device name in the alarms of the Netspot services given with --netspot
+DEFAULT_NETSPOT_DEVICE = "Netspot"
+
+# Media files named in the requests are read from here
+DATA_DIR = "/analytics_api/data/"
+
+SUBSCRIBED_TOPICS = frozenset(
+    [
+        "SIFIS:Privacy_Aware_Speech_Recognition",
+        "SIFIS:Privacy_Aware_Parental_Control",
+        "SIFIS:Privacy_Aware_Device_Anomaly_Detection",
+        "SIFIS:Privacy_Aware_Object_Recognition",
+        "SIFIS:Privacy_Aware_Face_Recognition",
+        "SIFIS:Publish_Alarms_Request",
+        "SIFIS:AUD_Manager_Request",
+        "SIFIS:Privacy_Aware_Speech_Recognition_Results",
+        "SIFIS:Privacy_Aware_Parental_Control_Results",
+        "SIFIS:Privacy_Aware_Object_Recognition_Results",
+        "SIFIS:Privacy_Aware_Object_Recognition_Frame_Results",
+        "SIFIS:Privacy_Aware_Device_Anomaly_Detection_Results",
+        "SIFIS:Netspot_Control_Results",
+        "SIFIS:AUD_Manager_Results",
+        "SIFIS:Object_Recognition",
+        "SIFIS:Object_Recognition_Frame_Results",
+        "SIFIS:Object_Recognition_Results",
+        "SIFIS:Privacy_Aware_Speaker_Verification",
+        "SIFIS:Privacy_Aware_Audio_Anomaly_Detection",
+        "SIFIS:Privacy_Aware_Audio_Anomaly_Detection_Results",
+        "SIFIS:Privacy_Aware_Face_Recognition_CAM",
+    ]
+)
+
+# Results topics not named "<request topic>_Results"
+RESULT_TOPICS = {
+    "SIFIS:Publish_Alarms_Request": "SIFIS:Netspot_Control_Results",
+    "SIFIS:AUD_Manager_Request": "SIFIS:AUD_Manager_Results",
+}
+
+# Status of the requests shed by the worker pool
+OVERLOADED = "rejected: overloaded"
+
+# Topic name -> handler, filled by the topic_handler decorator
+TOPIC_HANDLERS = {}
+
+# Topics with a handler that are ignored, e.g. from the --disable option
+DISABLED_TOPICS = set()
+
+# Number of dropped messages per topic name, for the subscribed topics
+# without a handler (our own results) and the topics we do not subscribe to
+dropped_topics = Counter()
+
+# Worker pool used by on_message. Handlers run inline when this is None.
+dispatcher = None
+
+# Forward the result messages of the backends without decoding them
+pass_through = True
+
+# Start of a result message. With pass_through only this is checked.
+RESULT_ENVELOPE = re.compile(rb'\s*\{\s*"RequestPostTopicUUID"\s*:')
+
+# ResultCache for the analytics registered with cached=True, or None
+result_cache = None
+
+# ResultCache for the AUD Manager responses, or None
+aud_cache = None
+
+# Containers for the DeepSpeech speech recognition. When None, the requests
+# are sent to the DeepSpeech worker service in BACKENDS instead.
+deepspeech_pool = DeepSpeechPool()
+
+DEVICE_ANOMALY_TOPIC = "SIFIS:Privacy_Aware_Device_Anomaly_Detection"
+
+# BatchHandler of the device anomaly requests, from --device-anomaly-window
+device_anomaly_batcher = None
+
+CAM_TOPIC = "SIFIS:Privacy_Aware_Face_Recognition_CAM"
+
+# Versions of the face databases, relative paths are in DATA_DIR
+face_databases = FaceDatabaseIndex(DATA_DIR)
+
+# Alarm cursors of the Netspot services
+netspot_cursors = CursorStore()
+
+# AlarmPollers of the Netspot services given with --netspot
+netspot_pollers = []
+
+metrics.REGISTRY.register(
+    metrics.CallbackGauge(
+        "analytics_netspot_lag_seconds",
+        "Time from the newest followed Netspot alarm to now",
+        ("netspot",),
+        lambda: {(poller.name,): poller.lag for poller in netspot_pollers},
+    )
+)
+metrics.REGISTRY.register(
+    metrics.CallbackGauge(
+        "analytics_netspot_alarms_per_second",
+        "Followed Netspot alarms per second in the last minute",
+        ("netspot",),
+        lambda: {
+            (poller.name,): poller.alarms_per_second
+            for poller in netspot_pollers
+        },
+    )
+)
+
+metrics.REGISTRY.register(
+    metrics.CallbackGauge(
+        "analytics_camera_sessions",
+        "Open camera face recognition sessions",
+        (),
+        lambda: {(): len(camera_sessions)},
+    )
+)
 
+# Most probable alarms and the grouping fields in the Netspot results
+netspot_top_k = DEFAULT_TOP_K
+netspot_group_by = DEFAULT_GROUP_BY
 
-def set_last_time():
-    """Writes the current timestamp to the last_time.txt file"""
-    file = open("last_time.txt", "w")
-    file.write(str(time.time_ns()))
-    file.close()
+# Alarms asked in one request
+netspot_page_size = DEFAULT_PAGE_SIZE
 
 
 def netspot_alarm_check(address, port, within_time=None):
-    # Get or make timestamp for alarms request
-    if within_time is None:
-        timestamp = get_last_time()
-    else:
-        timestamp = time.time_ns() - int(within_time * 6e10)
-
-    # Making the request
-    url = f"http://{address}:{port}/v1/netspots/alarms"
-    params = {"time": timestamp, "last": 50}
-    try:
-        reply = requests.get(url, params)
-    except requests.RequestException as e:
-        return False, str(e)
-
-    # Checking the reply
-    if reply.status_code == 200:
-        # Request was okay, save current time to be used with next request
-        set_last_time()
-
-        # Handling messages
-        messages = reply.json()
-        if len(messages) == 0:
-            # No alarms
-            return True, None
-        # Find messages with the highest probability
-        highest_probability = 0.0
-        most_urgent_message = ""
-        for message in messages:
-            if message["probability"] >= highest_probability:
-                highest_probability = message["probability"]
-                most_urgent_message = message
-        return True, most_urgent_message
-
-    # Server responded with error. Return status code and content in the message
-    return (
-        False,
-        f"Server responded with {reply.status_code}:\n{reply.content.decode('utf-8')}",
-    )
+    """
+    Asks the Netspot service in address:port for the new alarms
+
+    The alarms are read a page at a time like AlarmPoller does, and the
+    shared cursor moves only when the alarms since the cursor were read, so
+    a check during an alarm storm does not skip the alarms the poller has
+    not read yet.
+
+    Returns
+    -------
+    (True, AlarmSummary)
+        If alarms were received.
+    (True, None)
+        If alarms were not received but request was okay.
+    (False, str)
+        If request fails, with the reason for the failure.
+    """
+    # Checks of the same service wait for each other, so that both do not
+    # ask for the same alarms
+    with netspot_cursors.lock(address, port):
+        started = time.time_ns()
+
+        # Get or make timestamp for alarms request
+        if within_time is None:
+            timestamp = netspot_cursors.get(address, port)
+        else:
+            timestamp = started - int(within_time * 6e10)
+
+        summary = AlarmSummary(
+            netspot_top_k, netspot_group_by, timestamp, started
+        )
+        until, seen = None, []
+        try:
+            while True:
+                alarms, until, seen = fetch_alarm_page(
+                    address, port, timestamp, until, seen, netspot_page_size
+                )
+                summary.extend(alarms)
+                if until is None:
+                    break
+        except requests.HTTPError as e:
+            # Return status code and content in the message
+            reply = e.response
+            return (
+                False,
+                f"Server responded with {reply.status_code}:\n"
+                f"{reply.content.decode('utf-8')}",
+            )
+        except requests.RequestException as e:
+            return False, str(e)
+
+        if within_time is None:
+            # The next request asks for the alarms since this one was sent
+            netspot_cursors.advance(address, port, started)
+
+    if summary.count == 0:
+        # No alarms
+        return True, None
+    return True, summary
 
 
 def on_error(ws, error):
@@ -100,673 +250,1261 @@ def on_close(ws, close_status_code, close_msg):
 
 def on_open(ws):
     print("### Connection established ###")
+    start_netspot_pollers(ws)
 
 
-def on_message(ws, message):
-    print("Received:")
-    print(message)
-    json_message = json.loads(message)
-
-    if "Persistent" in json_message:
-        json_message = json_message["Persistent"]
-
-        if "topic_name" in json_message:
-            if json_message["topic_name"] in SUBSCRIBED_TOPICS:
-                if (
-                    json_message["topic_name"]
-                    == "SIFIS:Publish_Alarms_Request"
-                ):
-                    print("Received instance of " + json_message["topic_name"])
-                    print("Topic Name: " + json_message["topic_name"])
-                    print("Address: " + json_message["value"]["Address"])
-                    print("Port: " + str(json_message["value"]["Port"]))
-
-                    Address = json_message["value"]["Address"]
-                    Port = json_message["value"]["Port"]
-                    within_time = json_message["value"]["Within Time"]
-                    device = json_message["value"]["Device name"]
-
-                    if (
-                        Address is not None
-                        and Port is not None
-                        and within_time is not None
-                    ):
-                        print("Time is not None")
-                        (success, message) = netspot_alarm_check(
-                            Address, Port, within_time
-                        )
-                    elif (
-                        Address is not None
-                        and Port is not None
-                        and within_time is None
-                    ):
-                        print("Time is None")
-                        (success, message) = netspot_alarm_check(Address, Port)
-                    else:
-                        print("Error, no variables were passed")
-
-                    if success:
-                        if message is None:
-                            return 0
-                        # We have an alarm message. Let us create DHT message from it.
-                        ws_req = {
-                            "RequestPostTopicUUID": {
-                                "topic_name": "SIFIS:Netspot_Control_Results",
-                                "topic_uuid": "AlarmResult",
-                                "value": {
-                                    "description": "Netspot alarms check results",
-                                    "Device": device,
-                                    "Statistic": message["stat"],
-                                    "Status": message["status"],
-                                    "Probability": message["probability"],
-                                    "Time": message["time"],
-                                },
-                            }
-                        }
-                        ws.send(json.dumps(ws_req))
-
-                        dht_message_json = json.dumps(
-                            ws_req, separators=(",", ":")
-                        )
-                        print(dht_message_json)
-                        return 1
-                    print(
-                        "Could not receive alarms:", message, file=sys.stdout
-                    )
-                    return 2
-
-                elif json_message["topic_name"] == "SIFIS:AUD_Manager_Request":
-                    print("Received instance of " + json_message["topic_name"])
-                    print("Topic Name: " + json_message["topic_name"])
-                    print("Request: " + json_message["value"]["Request"])
-
-                    Request = json_message["value"]["Request"]
-                    cmd1 = "curl http://localhost:5050/" + str(Request)
-                    cmd = cmd1.split()
-                    print(cmd)
-                    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-                    out, err = p.communicate()
-                    # print(out)
-                    print(out.decode("ascii"))
-
-                    ws_req = {
-                        "RequestPostTopicUUID": {
-                            "topic_name": "SIFIS:AUD_Manager_Results",
-                            "topic_uuid": "AUD_Manager_Results",
-                            "value": {
-                                "description": "AUD Manager Results",
-                                "Request": str(Request),
-                                "Results": out.decode("ascii"),
-                            },
-                        }
-                    }
-                    ws.send(json.dumps(ws_req))
-
-                elif (
-                    json_message["topic_name"]
-                    == "SIFIS:Privacy_Aware_Speech_Recognition"
-                ):
-                    print("Received instance of " + json_message["topic_name"])
-                    print("Audio File: " + json_message["value"]["Audio File"])
-                    print(
-                        "requestor_id: "
-                        + json_message["value"]["requestor_id"]
-                    )
-                    print(
-                        "requestor_type: "
-                        + json_message["value"]["requestor_type"]
-                    )
-                    print("request_id: " + json_message["value"]["request_id"])
-                    print(
-                        "Entity Types: "
-                        + str(json_message["value"]["Entity Types"])
-                    )
-                    print("method: " + str(json_message["value"]["method"]))
-
-                    audio = json_message["value"]["Audio File"]
-                    requestor_id = json_message["value"]["requestor_id"]
-                    requestor_type = json_message["value"]["requestor_type"]
-                    request_id = json_message["value"]["request_id"]
-                    Entity_Types = json_message["value"]["Entity Types"]
-                    method = json_message["value"]["method"]
-
-                    if method == "DeepSpeeach":
-                        cmd1 = "docker run -ti -v /var/run/docker.sock:/var/run/docker.sock -u root --net=host --name privacy_preserving_speech_recognition privacy_preserving_speech_recognition python -m recognize_wavFile_Func --audio "
-                        cmd2 = cmd1 + audio
-
-                        cmd = cmd2.split()
-                        print(cmd)
-                        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-                        out, err = p.communicate()
-                        print(out)
-
-                        cmd = "docker rm -f privacy_preserving_speech_recognition".split()
-                        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-                        out, err = p.communicate()
-                        print(out)
-
-                    elif method == "Whisper":
-                        url = (
-                            "http://localhost:5040/whisper/"
-                            + audio
-                            + "/"
-                            + requestor_id
-                            + "/"
-                            + requestor_type
-                            + "/"
-                            + request_id
-                        )
-                        file = {
-                            "file": open("/analytics_api/data/" + audio, "rb")
-                        }
-                        response = requests.post(url, files=file)
-
-                        # Check the response
-                        if response.status_code == 200:
-                            print("Request succeeded.")
-                            response_dict = json.loads(response.content)
-                            response_dict2 = response_dict[
-                                "RequestPostTopicUUID"
-                            ]["value"]
-                            ws.send(json.dumps(response_dict))
-                        else:
-                            print("Request failed.")
-                            print(response.content)
-
-                elif (
-                    json_message["topic_name"]
-                    == "SIFIS:Privacy_Aware_Audio_Anomaly_Detection"
-                ):
-                    print("Received instance of " + json_message["topic_name"])
-                    print("Audio File: " + json_message["value"]["audio_file"])
-                    print(
-                        "requestor_id: "
-                        + json_message["value"]["requestor_id"]
-                    )
-                    print(
-                        "requestor_type: "
-                        + json_message["value"]["requestor_type"]
-                    )
-                    print("request_id: " + json_message["value"]["request_id"])
-                    print("method: " + str(json_message["value"]["method"]))
-
-                    audio_file = json_message["value"]["audio_file"]
-                    requestor_id = json_message["value"]["requestor_id"]
-                    requestor_type = json_message["value"]["requestor_type"]
-                    request_id = json_message["value"]["request_id"]
-                    method = json_message["value"]["method"]
-
-                    url = (
-                        "http://localhost:5000/model/predict/"
-                        + audio_file
-                        + "/"
-                        + method
-                        + "/"
-                        + requestor_id
-                        + "/"
-                        + requestor_type
-                        + "/"
-                        + request_id
-                    )
-                    file = {
-                        "audio": (
-                            "sample1.wav",
-                            open("/analytics_api/data/" + audio_file, "rb"),
-                            "audio/wav",
-                        )
-                    }
-                    response = requests.post(url, files=file)
-
-                    # Check the response
-                    if response.status_code == 200:
-                        print("Request succeeded.")
-
-                        response_dict = json.loads(response.content)
-                        for prediction in range(5):
-                            print(
-                                response_dict["predictions"][prediction][
-                                    "label"
-                                ],
-                                response_dict["predictions"][prediction][
-                                    "probability"
-                                ],
-                            )
-
-                        ws_req = {
-                            "RequestPostTopicUUID": {
-                                "topic_name": "SIFIS:Privacy_Aware_Audio_Anomaly_Detection_Results",
-                                "topic_uuid": "Audio_Anomaly_Detection_Results",
-                                "value": {
-                                    "description": "Speech Recognition Results",
-                                    "requestor_id": str(
-                                        response_dict["requestor_id"]
-                                    ),
-                                    "requestor_type": str(
-                                        response_dict["requestor_type"]
-                                    ),
-                                    "request_id": str(
-                                        response_dict["request_id"]
-                                    ),
-                                    "analyzer_id": str(
-                                        response_dict["analyzer_id"]
-                                    ),
-                                    "analysis_id": str(
-                                        response_dict["analysis_id"]
-                                    ),
-                                    "audio_file": str(
-                                        response_dict["audio_file"]
-                                    ),
-                                    "method": str(response_dict["method"]),
-                                    "predictions": response_dict[
-                                        "predictions"
-                                    ],
-                                },
-                            }
-                        }
-                        ws.send(json.dumps(ws_req))
-
-                    else:
-                        print("Request failed.")
-                        print(response.content)
-
-                elif (
-                    json_message["topic_name"]
-                    == "SIFIS:Privacy_Aware_Device_Anomaly_Detection"
-                ):
-                    print("Received instance of " + json_message["topic_name"])
-                    print("Topic Name: " + json_message["topic_name"])
-                    temp = json_message["value"]["Temperatures"]
-                    t = " ".join(str(item) for item in temp)
-                    requestor_id = json_message["value"]["requestor_id"]
-                    requestor_type = json_message["value"]["requestor_type"]
-                    request_id = json_message["value"]["request_id"]
-
-                    url = (
-                        "http://localhost:9090/temperature/"
-                        + str(t)
-                        + "/"
-                        + requestor_id
-                        + "/"
-                        + requestor_type
-                        + "/"
-                        + request_id
-                    )
-
-                    # Make the request
-                    response = requests.get(url)
-
-                    # Check the response
-                    if response.status_code == 200:
-                        print("Request succeeded.")
-                        response_dict = json.loads(response.content)
-                        response_dict2 = response_dict["RequestPostTopicUUID"][
-                            "value"
-                        ]
-                        # ws.send(json.dumps(response_dict))
-                    else:
-                        print("Request failed.")
-                        print(response.content)
-
-                elif (
-                    json_message["topic_name"]
-                    == "SIFIS:Privacy_Aware_Parental_Control"
-                ):
-                    print("Received instance of " + json_message["topic_name"])
-                    print("file_name: " + json_message["value"]["file_name"])
-                    print(
-                        "requestor_id: "
-                        + json_message["value"]["requestor_id"]
-                    )
-                    print(
-                        "requestor_type: "
-                        + json_message["value"]["requestor_type"]
-                    )
-                    print("request_id: " + json_message["value"]["request_id"])
-                    print(
-                        "Privacy_Parameter: "
-                        + str(json_message["value"]["Privacy_Parameter"])
-                    )
-
-                    file_name = json_message["value"]["file_name"]
-                    Privacy_Parameter = json_message["value"][
-                        "Privacy_Parameter"
-                    ]
-                    requestor_id = json_message["value"]["requestor_id"]
-                    requestor_type = json_message["value"]["requestor_type"]
-                    request_id = json_message["value"]["request_id"]
-
-                    file_path = "/analytics_api/data/" + file_name
-
-                    url = (
-                        "http://localhost:6060/file_estimation/"
-                        + file_name
-                        + "/"
-                        + str(Privacy_Parameter)
-                        + "/"
-                        + requestor_id
-                        + "/"
-                        + requestor_type
-                        + "/"
-                        + request_id
-                    )
-                    file = {"file": open(file_path, "rb")}
-                    response = requests.post(url, files=file)
-
-                    # Use the json module to load CKAN's response into a dictionary.
-                    response_dict = json.loads(response.text)
-                    print(response_dict)
-
-                    # Make the request
-                    response = requests.post(
-                        url, files={"file": open(file_path, "rb")}
-                    )
-
-                    # Check the response
-                    if response.status_code == 200:
-                        print("Request succeeded.")
-                        response_dict = json.loads(response.content)
-                        response_dict2 = response_dict["RequestPostTopicUUID"][
-                            "value"
-                        ]
-                        ws.send(json.dumps(response_dict))
-                    else:
-                        print("Request failed.")
-                        print(response.content)
-
-                elif (
-                    json_message["topic_name"]
-                    == "SIFIS:Privacy_Aware_Object_Recognition"
-                ):
-                    print("Received instance of " + json_message["topic_name"])
-                    print("file_path: " + json_message["value"]["file_path"])
-                    print("file_name: " + json_message["value"]["file_name"])
-                    print(
-                        "requestor_id: "
-                        + json_message["value"]["requestor_id"]
-                    )
-                    print(
-                        "requestor_type: "
-                        + json_message["value"]["requestor_type"]
-                    )
-                    print("request_id: " + json_message["value"]["request_id"])
-                    print("epsilon: " + str(json_message["value"]["epsilon"]))
-                    print(
-                        "sensitivity: "
-                        + str(json_message["value"]["sensitivity"])
-                    )
-
-                    file_path = json_message["value"]["file_path"]
-                    file_name = json_message["value"]["file_name"]
-                    requestor_id = json_message["value"]["requestor_id"]
-                    requestor_type = json_message["value"]["requestor_type"]
-                    request_id = json_message["value"]["request_id"]
-                    epsilon = json_message["value"]["epsilon"]
-                    sensitivity = json_message["value"]["sensitivity"]
-
-                    url = (
-                        "http://localhost:8080/file_object/"
-                        + file_name
-                        + "/"
-                        + str(epsilon)
-                        + "/"
-                        + str(sensitivity)
-                        + "/"
-                        + requestor_id
-                        + "/"
-                        + requestor_type
-                        + "/"
-                        + request_id
-                    )
-                    file_path = "/analytics_api/data/" + file_name
-
-                    # Make the request
-                    response = requests.post(
-                        url, files={"file": open(file_path, "rb")}
-                    )
-
-                    # Check the response
-                    if response.status_code == 200:
-                        print("Request succeeded.")
-                        response_dict = json.loads(response.content)
-                        response_dict2 = response_dict["RequestPostTopicUUID"][
-                            "value"
-                        ]
-                        ws.send(json.dumps(response_dict))
-                    else:
-                        print("Request failed.")
-                        print(response.content)
-
-                elif (
-                    json_message["topic_name"]
-                    == "SIFIS:Privacy_Aware_Face_Recognition"
-                ):
-                    print("Received instance of " + json_message["topic_name"])
-                    print("file_name: " + json_message["value"]["file_name"])
-                    print(
-                        "database_path: "
-                        + json_message["value"]["database_path"]
-                    )
-                    print(
-                        "requestor_id: "
-                        + json_message["value"]["requestor_id"]
-                    )
-                    print(
-                        "requestor_type: "
-                        + json_message["value"]["requestor_type"]
-                    )
-                    print("request_id: " + json_message["value"]["request_id"])
-                    print(
-                        "privacy_parameter: "
-                        + str(json_message["value"]["privacy_parameter"])
-                    )
-
-                    file_name = json_message["value"]["file_name"]
-                    database_path = json_message["value"]["database_path"]
-                    requestor_id = json_message["value"]["requestor_id"]
-                    requestor_type = json_message["value"]["requestor_type"]
-                    request_id = json_message["value"]["request_id"]
-                    privacy_parameter = json_message["value"][
-                        "privacy_parameter"
-                    ]
-
-                    url = (
-                        "http://localhost:8090/check_directory/"
-                        + file_name
-                        + "/"
-                        + str(privacy_parameter)
-                        + "/"
-                        + requestor_id
-                        + "/"
-                        + requestor_type
-                        + "/"
-                        + request_id
-                    )
-                    file_path = "/analytics_api/data/" + file_name
-                    # database_path = '/analytics_api/data/' + database_path
-                    # database_path = '/app/database'
-                    database_path = database_path
-
-                    files = [
-                        ("file", open(file_path, "rb")),
-                        ("path", database_path),
-                    ]
-
-                    # Make the request
-                    response = requests.post(url, files=files)
-
-                    # Check the response
-                    if response.status_code == 200:
-                        print("Request succeeded.")
-                        response_dict = json.loads(response.content)
-                        response_dict2 = response_dict["RequestPostTopicUUID"][
-                            "value"
-                        ]
-
-                        ws.send(json.dumps(response_dict))
-                    else:
-                        print("Request failed.")
-                        print(response.content)
-
-                elif (
-                    json_message["topic_name"]
-                    == "SIFIS:Privacy_Aware_Face_Recognition_CAM"
-                ):
-                    print("Received instance of " + json_message["topic_name"])
-                    print("cam_link: " + json_message["value"]["cam_link"])
-                    print(
-                        "database_path: "
-                        + json_message["value"]["database_path"]
-                    )
-                    print(
-                        "requestor_id: "
-                        + json_message["value"]["requestor_id"]
-                    )
-                    print(
-                        "requestor_type: "
-                        + json_message["value"]["requestor_type"]
-                    )
-                    print("request_id: " + json_message["value"]["request_id"])
-                    print(
-                        "privacy_parameter: "
-                        + str(json_message["value"]["privacy_parameter"])
-                    )
-
-                    cam_link = json_message["value"]["cam_link"]
-                    database_path = json_message["value"]["database_path"]
-                    requestor_id = json_message["value"]["requestor_id"]
-                    requestor_type = json_message["value"]["requestor_type"]
-                    request_id = json_message["value"]["request_id"]
-                    privacy_parameter = json_message["value"][
-                        "privacy_parameter"
-                    ]
-
-                    url = (
-                        "http://localhost:8090/cam_face_recognition/"
-                        + cam_link
-                        + "/"
-                        + str(privacy_parameter)
-                        + "/"
-                        + requestor_id
-                        + "/"
-                        + requestor_type
-                        + "/"
-                        + request_id
-                    )
-                    database_path = database_path
-
-                    files = [
-                        ("path", database_path),
-                    ]
-
-                    # Make the request
-                    response = requests.post(url, files=files)
-
-                    # Check the response
-                    if response.status_code == 200:
-                        print("Request succeeded.")
-                        response_dict = json.loads(response.content)
-                        response_dict2 = response_dict["RequestPostTopicUUID"][
-                            "value"
-                        ]
-
-                        ws.send(json.dumps(response_dict))
-                    else:
-                        print("Request failed.")
-                        print(response.content)
-
-                elif (
-                    json_message["topic_name"]
-                    == "SIFIS:Privacy_Aware_Speaker_Verification"
-                ):
-                    print("Received instance of " + json_message["topic_name"])
-                    print(
-                        "First Audio File: "
-                        + json_message["value"]["first_audio_file"]
-                    )
-                    print(
-                        "Second Audio File: "
-                        + json_message["value"]["second_audio_file"]
-                    )
-                    print(
-                        "requestor_id: "
-                        + json_message["value"]["requestor_id"]
-                    )
-                    print(
-                        "requestor_type: "
-                        + json_message["value"]["requestor_type"]
-                    )
-                    print("request_id: " + json_message["value"]["request_id"])
-
-                    first_audio_file = json_message["value"][
-                        "first_audio_file"
-                    ]
-                    second_audio_file = json_message["value"][
-                        "second_audio_file"
-                    ]
-                    requestor_id = json_message["value"]["requestor_id"]
-                    requestor_type = json_message["value"]["requestor_type"]
-                    request_id = json_message["value"]["request_id"]
-
-                    url = (
-                        "http://localhost:7070/speaker_verification/"
-                        + first_audio_file
-                        + "/"
-                        + second_audio_file
-                        + "/"
-                        + requestor_id
-                        + "/"
-                        + requestor_type
-                        + "/"
-                        + request_id
-                    )
-                    files = [
-                        (
-                            "file1",
-                            (
-                                "filename1.wav",
-                                open(
-                                    "/analytics_api/data/" + first_audio_file,
-                                    "rb",
-                                ),
-                                "audio/wav",
-                            ),
-                        ),
-                        (
-                            "file2",
-                            (
-                                "filename2.wav",
-                                open(
-                                    "/analytics_api/data/" + second_audio_file,
-                                    "rb",
-                                ),
-                                "audio/wav",
-                            ),
-                        ),
-                    ]
-                    response = requests.post(url, files=files)
-
-                    # Check the response
-                    if response.status_code == 200:
-                        print("Request succeeded.")
-                        response_dict = json.loads(response.content)
-                        response_dict2 = response_dict["RequestPostTopicUUID"][
-                            "value"
-                        ]
-                        ws.send(json.dumps(response_dict))
-                    else:
-                        print("Request failed.")
-                        print(response.content)
-
-            else:
-                print(
-                    "We are not subscribed to this topic ",
-                    json_message["topic_name"],
+def start_netspot_pollers(ws):
+    """Starts publishing the alarms of the followed Netspot services"""
+    for poller in netspot_pollers:
+        poller.start(ws)
+
+
+def topic_handler(topic_name):
+    """
+    Decorator registering the function as the handler for *topic_name*
+
+    The handler is called as handler(ws, value), where value is the "value"
+    field of the received DHT message.
+    """
+
+    def register(handler):
+        TOPIC_HANDLERS[topic_name] = handler
+        return handler
+
+    return register
+
+
+def request_succeeded(value, content):
+    log.info(
+        "Request succeeded.",
+        extra=logs.request_fields(value, payload=logs.payload(content)),
+    )
+
+
+def request_failed(value, status_code, content):
+    log.warning(
+        "Request failed with %s.",
+        status_code,
+        extra=logs.request_fields(value, payload=logs.payload(content)),
+    )
+
+
+def forward_reply(value, status_code, content):
+    """
+    Returns the backend response as the result message
+
+    With pass_through only the start of the response is checked and the
+    response is sent as it is, without decoding and encoding it again.
+    """
+    if status_code != 200:
+        request_failed(value, status_code, content)
+        return None
+    request_succeeded(value, content)
+    try:
+        if pass_through and RESULT_ENVELOPE.match(content):
+            return codec.Encoded(content.decode())
+        message = codec.loads(content)
+    except ValueError as e:
+        log.warning(
+            "Invalid result message: %s", e, extra=logs.request_fields(value)
+        )
+        return None
+    if not isinstance(message, dict) or "RequestPostTopicUUID" not in message:
+        log.warning(
+            "Invalid result message: no RequestPostTopicUUID",
+            extra=logs.request_fields(value),
+        )
+        return None
+    return message
+
+
+class BackendHandler:
+    """
+    Topic handler sending one request to an analytics backend
+
+    Parameters
+    ----------
+    build : callable
+        Called as build(value) and returns the BackendRequest for the message.
+    reply : callable
+        Called as reply(value, status_code, content) with the backend
+        response. Returns the result message for the DHT or None.
+    topic_name : str or None
+        Topic of the handled messages, used in the result cache key.
+    cache : callable or None
+        Returns the ResultCache for the results, or None when the results
+        are not cached.
+    """
+
+    def __init__(
+        self, build, reply=forward_reply, topic_name=None, cache=None
+    ):
+        self.build = build
+        self.reply = reply
+        self.topic_name = topic_name
+        self.cache = cache
+
+    @property
+    def cached(self):
+        return self.cache is not None and self.cache() is not None
+
+    def __call__(self, ws, value):
+        request = self.build(value)
+        key, message = self.lookup(value, request)
+        if message is None:
+            try:
+                response = request.send()
+            except requests.RequestException as e:
+                log.warning(
+                    "Request failed: %s", e, extra=logs.request_fields(value)
                 )
+                return
+            message = self.complete(
+                key, value, response.status_code, response.content
+            )
+        if message is not None:
+            with tracing.span("send"):
+                ws.send(codec.dumps(message))
+
+    def lookup(self, value, request):
+        """
+        Checks the result cache for the *request*
+
+        Returns
+        -------
+        (key, message)
+            Cache key, or None when the result is not cached, and the cached
+            result message or None.
+        """
+        cache = self.cache() if self.cache is not None else None
+        if cache is None:
+            return None, None
+        with tracing.span("cache"):
+            key = cache.key(self.topic_name, value, request)
+            message = cache.get(key, value)
+        if message is not None:
+            log.info(
+                "Result found from the cache", extra=logs.request_fields(value)
+            )
+        return key, message
+
+    def complete(self, key, value, status_code, content):
+        """Returns the result message and stores it in the cache"""
+        with tracing.span("response"):
+            message = self.reply(value, status_code, content)
+        if message is not None and key is not None:
+            self.cache().put(key, message)
+        return message
+
+
+def backend_handler(topic_name, reply=forward_reply, cache=None):
+    """
+    Decorator registering a request builder for *topic_name*
+
+    The decorated function is called as build(value) and returns the
+    BackendRequest for the message. It is registered wrapped in a
+    BackendHandler, so the asyncio gateway can send the same request without
+    threads. The function itself is returned unchanged.
+    """
+
+    def register(build):
+        TOPIC_HANDLERS[topic_name] = BackendHandler(
+            build, reply, topic_name, cache
+        )
+        return build
+
+    return register
+
+
+def get_result_cache():
+    """Returns the cache for the analytics results"""
+    return result_cache
+
+
+def get_aud_cache():
+    """Returns the cache for the AUD Manager responses"""
+    return aud_cache
+
+
+def route(topic_name):
+    """
+    Returns the handler for *topic_name* or None when the message is dropped
+
+    Dropped messages are counted in dropped_topics.
+    """
+    handler = TOPIC_HANDLERS.get(topic_name)
+    if (
+        handler is None
+        or topic_name in DISABLED_TOPICS
+        or topic_name not in SUBSCRIBED_TOPICS
+    ):
+        dropped_topics[topic_name] += 1
+        metrics.dropped.inc(topic_name)
+        if topic_name not in SUBSCRIBED_TOPICS:
+            log.info(
+                "We are not subscribed to this topic",
+                extra=logs.fields(topic=topic_name),
+            )
+        return None
+    return handler
+
+
+def parse_request(message):
+    """
+    Decodes a DHT message
+
+    Returns (topic_name, value, handler) for messages with a handler and None
+    for the others.
+    """
+    json_message = codec.loads(message)
+
+    if "Persistent" not in json_message:
+        return None
+    json_message = json_message["Persistent"]
+    if "topic_name" not in json_message:
+        return None
+
+    topic_name = json_message["topic_name"]
+    handler = route(topic_name)
+    if handler is None:
+        return None
+    value = json_message["value"]
+    metrics.messages.inc(topic_name)
+    log.info(
+        "Received instance of %s",
+        topic_name,
+        extra=logs.request_fields(value, topic_name, logs.payload(value)),
+    )
+    return topic_name, value, handler
 
 
-if __name__ == "__main__":
+def on_message(ws, message):
+    started = time.perf_counter()
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Received", extra=logs.fields(message=logs.payload(message)))
+    request = parse_request(message)
+    if request is None:
+        return None
+
+    topic_name, value, handler = request
+    handler = metrics.Instrumented(topic_name, handler)
+    trace = tracing.begin(topic_name, value, started)
+    if trace is not None:
+        handler = tracing.Traced(trace, handler)
+    if dispatcher is None:
+        return handler(ws, value)
+    dispatcher.submit(topic_name, handler, ws, value)
+    return None
+
+
+def rejected_message(topic_name, value, reason):
+    """Returns the results message telling a request was not handled"""
+    if not isinstance(value, dict):
+        value = {}
+    result_topic = RESULT_TOPICS.get(topic_name, f"{topic_name}_Results")
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": result_topic,
+            "topic_uuid": result_topic.partition(":")[2],
+            "value": {
+                "description": OVERLOADED,
+                "requestor_id": value.get("requestor_id"),
+                "requestor_type": value.get("requestor_type"),
+                "request_id": value.get("request_id"),
+                "status": OVERLOADED,
+                "reason": reason,
+            },
+        }
+    }
+
+
+def reject_request(topic_name, reason, ws, value):
+    """Publishes the rejection of a request shed by the dispatcher"""
+    metrics.shed.inc(topic_name, reason)
+    log.warning(
+        "Request rejected, %s",
+        reason,
+        extra=logs.request_fields(value, topic_name),
+    )
+    ws.send(codec.dumps(rejected_message(topic_name, value, reason)))
+
+
+@topic_handler("SIFIS:Publish_Alarms_Request")
+def handle_publish_alarms_request(ws, value):
+    Address = value["Address"]
+    Port = value["Port"]
+    within_time = value["Within Time"]
+    device = value["Device name"]
+
+    if Address is not None and Port is not None and within_time is not None:
+        with tracing.span("inference", backend="netspot"):
+            (success, message) = netspot_alarm_check(
+                Address, Port, within_time
+            )
+    elif Address is not None and Port is not None and within_time is None:
+        with tracing.span("inference", backend="netspot"):
+            (success, message) = netspot_alarm_check(Address, Port)
+    else:
+        log.warning("Error, no variables were passed")
+        return 2
+
+    if success:
+        if message is None:
+            return 0
+        # We have an alarm message. Let us create DHT message from it.
+        ws_req = summary_message(device, message)
+        dht_message_json = codec.dumps(ws_req)
+        with tracing.span("send"):
+            ws.send(dht_message_json)
+        log.info(
+            "Netspot alarms",
+            extra=logs.fields(
+                address=Address,
+                port=Port,
+                count=message.count,
+                message=logs.payload(dht_message_json),
+            ),
+        )
+        return 1
+    log.warning(
+        "Could not receive alarms: %s",
+        message,
+        extra=logs.fields(address=Address, port=Port),
+    )
+    return 2
+
+
+def aud_manager_reply(value, status_code, content):
+    """Returns the AUD Manager response in the results message"""
+    results = content.decode("ascii")
+    log.debug(
+        "AUD Manager response",
+        extra=logs.fields(results=logs.payload(results)),
+    )
+
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": "SIFIS:AUD_Manager_Results",
+            "topic_uuid": "AUD_Manager_Results",
+            "value": {
+                "description": "AUD Manager Results",
+                "Request": str(value["Request"]),
+                "Results": results,
+            },
+        }
+    }
+
+
+@backend_handler(
+    "SIFIS:AUD_Manager_Request", reply=aud_manager_reply, cache=get_aud_cache
+)
+def aud_manager_request(value):
+    # The request is used as the URL path, so it is quoted to keep it in
+    # the path of the AUD Manager. The escapes of an already escaped request
+    # are kept, and only a % not starting an escape is quoted.
+    Request = quote(
+        re.sub(r"%(?![0-9A-Fa-f]{2})", "%25", str(value["Request"])),
+        safe="/?&=%",
+    )
+    backend = BACKENDS["aud_manager"]
+    return BackendRequest(backend, "GET", backend.url(Request))
+
+
+SPEECH_TOPIC = "SIFIS:Privacy_Aware_Speech_Recognition"
+
+# Backend and path of each speech recognition method. Whisper and the
+# DeepSpeech worker service take the same requests.
+SPEECH_METHODS = {"DeepSpeeach": "deepspeech", "Whisper": "whisper"}
+
+
+@backend_handler(SPEECH_TOPIC)
+def speech_recognition_request(value):
+    audio = value["Audio File"]
+    name = SPEECH_METHODS[value["method"]]
+    backend = BACKENDS[name]
+    url = backend.url(
+        name,
+        audio,
+        value["requestor_id"],
+        value["requestor_type"],
+        value["request_id"],
+    )
+    upload = Upload("file", DATA_DIR + audio)
+    return BackendRequest(backend, "POST", url, parts=(upload,))
+
+
+class SpeechRecognition(FallbackHandler):
+    """
+    Topic handler of the speech recognition requests
+
+    The DeepSpeech requests run in the DeepSpeechPool when there is one, and
+    the requests of an unknown method are dropped. The others are sent to
+    Whisper or the DeepSpeech worker service by *fallback*.
+    """
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def handles(self, value):
+        method = value.get("method")
+        return method not in SPEECH_METHODS or (
+            method == "DeepSpeeach" and deepspeech_pool is not None
+        )
+
+    def __call__(self, ws, value):
+        if not self.handles(value):
+            self.fallback(ws, value)
+            return
+        if value.get("method") not in SPEECH_METHODS:
+            log.warning(
+                "Unknown speech recognition method %s",
+                value.get("method"),
+                extra=logs.request_fields(value),
+            )
+            return
+        with tracing.span("inference", backend="deepspeech"):
+            out = deepspeech_pool.recognize(value["Audio File"])
+        if out is not None:
+            request_succeeded(value, out)
+
+
+speech_recognition = SpeechRecognition(TOPIC_HANDLERS[SPEECH_TOPIC])
+TOPIC_HANDLERS[SPEECH_TOPIC] = speech_recognition
+
+
+def audio_anomaly_reply(value, status_code, content):
+    """Returns the results message for the audio anomaly predictions"""
+    if status_code != 200:
+        request_failed(value, status_code, content)
+        return None
+    request_succeeded(value, content)
+
+    response_dict = codec.loads(content)
+    if log.isEnabledFor(logging.DEBUG):
+        for prediction in response_dict["predictions"][:5]:
+            log.debug(
+                "Prediction %s %s",
+                prediction["label"],
+                prediction["probability"],
+                extra=logs.request_fields(value),
+            )
+
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": "SIFIS:Privacy_Aware_Audio_Anomaly_Detection_Results",
+            "topic_uuid": "Audio_Anomaly_Detection_Results",
+            "value": {
+                "description": "Speech Recognition Results",
+                "requestor_id": str(response_dict["requestor_id"]),
+                "requestor_type": str(response_dict["requestor_type"]),
+                "request_id": str(response_dict["request_id"]),
+                "analyzer_id": str(response_dict["analyzer_id"]),
+                "analysis_id": str(response_dict["analysis_id"]),
+                "audio_file": str(response_dict["audio_file"]),
+                "method": str(response_dict["method"]),
+                "predictions": response_dict["predictions"],
+            },
+        }
+    }
+
+
+@backend_handler(
+    "SIFIS:Privacy_Aware_Audio_Anomaly_Detection", reply=audio_anomaly_reply
+)
+def audio_anomaly_detection_request(value):
+    audio_file = value["audio_file"]
+    requestor_id = value["requestor_id"]
+    requestor_type = value["requestor_type"]
+    request_id = value["request_id"]
+    method = value["method"]
+
+    backend = BACKENDS["audio_anomaly"]
+    url = backend.url(
+        "model",
+        "predict",
+        audio_file,
+        method,
+        requestor_id,
+        requestor_type,
+        request_id,
+    )
+    upload = Upload(
+        "audio",
+        DATA_DIR + audio_file,
+        "sample1.wav",
+        "audio/wav",
+    )
+    return BackendRequest(backend, "POST", url, parts=(upload,))
+
+
+# Requests with "stream": true are sent in windows, the others as one
+# request
+audio_anomaly_windows = WindowedAudioAnomaly(
+    BACKENDS["audio_anomaly"],
+    TOPIC_HANDLERS["SIFIS:Privacy_Aware_Audio_Anomaly_Detection"],
+    DATA_DIR,
+)
+TOPIC_HANDLERS[
+    "SIFIS:Privacy_Aware_Audio_Anomaly_Detection"
+] = audio_anomaly_windows
+
+
+@backend_handler(DEVICE_ANOMALY_TOPIC)
+def device_anomaly_detection_request(value):
+    temp = value["Temperatures"]
+    t = " ".join(str(item) for item in temp)
+    requestor_id = value["requestor_id"]
+    requestor_type = value["requestor_type"]
+    request_id = value["request_id"]
+
+    backend = BACKENDS["device_anomaly"]
+    url = backend.url(
+        "temperature", t, requestor_id, requestor_type, request_id
+    )
+    return BackendRequest(backend, "GET", url)
+
+
+@backend_handler(
+    "SIFIS:Privacy_Aware_Parental_Control", cache=get_result_cache
+)
+def parental_control_request(value):
+    file_name = value["file_name"]
+    Privacy_Parameter = value["Privacy_Parameter"]
+    requestor_id = value["requestor_id"]
+    requestor_type = value["requestor_type"]
+    request_id = value["request_id"]
+
+    file_path = DATA_DIR + file_name
+
+    backend = BACKENDS["parental_control"]
+    url = backend.url(
+        "file_estimation",
+        file_name,
+        Privacy_Parameter,
+        requestor_id,
+        requestor_type,
+        request_id,
+    )
+    return BackendRequest(
+        backend, "POST", url, parts=(Upload("file", file_path),)
+    )
+
+
+@backend_handler(
+    "SIFIS:Privacy_Aware_Object_Recognition", cache=get_result_cache
+)
+def object_recognition_request(value):
+    file_path = value["file_path"]
+    file_name = value["file_name"]
+    requestor_id = value["requestor_id"]
+    requestor_type = value["requestor_type"]
+    request_id = value["request_id"]
+    epsilon = value["epsilon"]
+    sensitivity = value["sensitivity"]
+
+    backend = BACKENDS["object_recognition"]
+    url = backend.url(
+        "file_object",
+        file_name,
+        epsilon,
+        sensitivity,
+        requestor_id,
+        requestor_type,
+        request_id,
+    )
+    file_path = DATA_DIR + file_name
+    return BackendRequest(
+        backend, "POST", url, parts=(Upload("file", file_path),)
+    )
+
+
+# Requests with "stream": true are streamed, the others are sent as one
+# request
+object_streams = ObjectStreams(
+    BACKENDS["object_recognition"],
+    TOPIC_HANDLERS["SIFIS:Privacy_Aware_Object_Recognition"],
+    DATA_DIR,
+)
+TOPIC_HANDLERS["SIFIS:Privacy_Aware_Object_Recognition"] = object_streams
+
+
+def database_fields(database_path):
+    """
+    Returns the form fields naming the face database
+
+    The database_version field is added once the database has been indexed
+    here, so the backend can reuse the embeddings of the known faces. The
+    index is only read, the indexing runs on its own thread.
+    """
+    version = face_databases.version(database_path)
+    if version is None:
+        return (Field("path", database_path),)
+    return (
+        Field("path", database_path),
+        Field("database_version", version),
+    )
+
+
+@backend_handler(
+    "SIFIS:Privacy_Aware_Face_Recognition", cache=get_result_cache
+)
+def face_recognition_request(value):
+    file_name = value["file_name"]
+    database_path = value["database_path"]
+    requestor_id = value["requestor_id"]
+    requestor_type = value["requestor_type"]
+    request_id = value["request_id"]
+    privacy_parameter = value["privacy_parameter"]
+
+    backend = BACKENDS["face_recognition"]
+    url = backend.url(
+        "check_directory",
+        file_name,
+        privacy_parameter,
+        requestor_id,
+        requestor_type,
+        request_id,
+    )
+    file_path = DATA_DIR + file_name
+    # database_path = '/analytics_api/data/' + database_path
+    # database_path = '/app/database'
+    database_path = database_path
+
+    parts = (Upload("file", file_path),) + database_fields(database_path)
+    return BackendRequest(backend, "POST", url, parts=parts)
+
+
+@backend_handler(CAM_TOPIC)
+def face_recognition_cam_request(value):
+    cam_link = value["cam_link"]
+    database_path = value["database_path"]
+    requestor_id = value["requestor_id"]
+    requestor_type = value["requestor_type"]
+    request_id = value["request_id"]
+    privacy_parameter = value["privacy_parameter"]
+
+    backend = BACKENDS["face_recognition"]
+    url = backend.url(
+        "cam_face_recognition",
+        cam_link,
+        privacy_parameter,
+        requestor_id,
+        requestor_type,
+        request_id,
+    )
+    database_path = database_path
+
+    parts = database_fields(database_path)
+    return BackendRequest(backend, "POST", url, parts=parts)
+
+
+# Requests with "session": true keep the camera open, the others are sent
+# with the handler above
+camera_sessions = CameraSessions(
+    BACKENDS["face_recognition"],
+    TOPIC_HANDLERS[CAM_TOPIC],
+    database_fields=database_fields,
+)
+TOPIC_HANDLERS[CAM_TOPIC] = camera_sessions
+
+
+@backend_handler("SIFIS:Privacy_Aware_Speaker_Verification")
+def speaker_verification_request(value):
+    first_audio_file = value["first_audio_file"]
+    second_audio_file = value["second_audio_file"]
+    requestor_id = value["requestor_id"]
+    requestor_type = value["requestor_type"]
+    request_id = value["request_id"]
+
+    backend = BACKENDS["speaker_verification"]
+    url = backend.url(
+        "speaker_verification",
+        first_audio_file,
+        second_audio_file,
+        requestor_id,
+        requestor_type,
+        request_id,
+    )
+    parts = (
+        Upload(
+            "file1",
+            DATA_DIR + first_audio_file,
+            "filename1.wav",
+            "audio/wav",
+        ),
+        Upload(
+            "file2",
+            DATA_DIR + second_audio_file,
+            "filename2.wav",
+            "audio/wav",
+        ),
+    )
+    return BackendRequest(backend, "POST", url, parts=parts)
+
+
+# Requests with candidate_audio_files are compared with each candidate, the
+# others are sent as one request
+speaker_verification = SpeakerVerification(
+    BACKENDS["speaker_verification"],
+    TOPIC_HANDLERS["SIFIS:Privacy_Aware_Speaker_Verification"],
+    speaker_verification_request,
+    DATA_DIR,
+)
+TOPIC_HANDLERS[
+    "SIFIS:Privacy_Aware_Speaker_Verification"
+] = speaker_verification
+
+
+def parse_topic_limit(text):
+    """Parses TOPIC=N command line values for --topic-limit"""
+    topic, separator, limit = text.rpartition("=")
+    if not separator or not topic:
+        raise ValueError(f"expected TOPIC=N, got {text!r}")
+    return topic, int(limit)
+
+
+def parse_address(text):
+    """Parses ADDRESS:PORT command line values for --netspot"""
+    address, separator, port = text.rpartition(":")
+    if not separator or not address:
+        raise ValueError(f"expected ADDRESS:PORT, got {text!r}")
+    return address, int(port)
+
+
+def parse_fields(text):
+    """Parses FIELD,... command line values for --netspot-group-by"""
+    return tuple(field.strip() for field in text.split(",") if field.strip())
+
+
+def main():
+    """
+    Application start point.
+
+    Connects to the DHT and runs the analytics handlers until the connection
+    is closed.
+    """
+    global result_cache, aud_cache, deepspeech_pool, netspot_cursors
+    global netspot_top_k, netspot_group_by, netspot_page_size, pass_through
+    global device_anomaly_batcher
+
+    parser = ArgumentParser(description="Analytics API")
+    parser.add_argument(
+        "--url",
+        type=str,
+        default=DHT_URL,
+        help=f"DHT WebSocket address. Default: {DHT_URL}",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        metavar="N",
+        help="Number of worker threads running the analytics. 0 runs them "
+        f"in the WebSocket thread. Default: {DEFAULT_MAX_WORKERS}",
+    )
+    parser.add_argument(
+        "--topic-limit",
+        type=parse_topic_limit,
+        action="append",
+        default=[],
+        metavar="TOPIC=N",
+        dest="topic_limits",
+        help="Maximum number of concurrent requests for the topic",
+    )
+    parser.add_argument(
+        "--topic-priority",
+        type=parse_topic_limit,
+        action="append",
+        default=[],
+        metavar="TOPIC=N",
+        dest="topic_priorities",
+        help="Priority of the waiting requests of the topic, lower values "
+        "run first",
+    )
+    parser.add_argument(
+        "--max-queue",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Maximum number of requests waiting for a worker before the "
+        "lowest priority ones are rejected. Default: 0, no limit",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="Reject the requests waiting for a worker longer than this. "
+        "Default: 0, no deadline",
+    )
+    parser.add_argument(
+        "--device-anomaly-window",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="Collect the device anomaly requests for this long and send "
+        "them to the backend in one batch. Default: 0, one at a time",
+    )
+    parser.add_argument(
+        "--device-anomaly-batch",
+        type=int,
+        default=device_anomaly.DEFAULT_MAX_BATCH,
+        metavar="N",
+        help="Device anomaly requests in a batch at most. "
+        f"Default: {device_anomaly.DEFAULT_MAX_BATCH}",
+    )
+    parser.add_argument(
+        "--cam-max-fps",
+        type=float,
+        default=DEFAULT_MAX_FPS,
+        metavar="FPS",
+        help="Frames per second read from each camera session. "
+        f"Default: {DEFAULT_MAX_FPS}",
+    )
+    parser.add_argument(
+        "--object-chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        metavar="BYTES",
+        help="Bytes of the video sent at a time in the streamed object "
+        f"recognition requests. Default: {DEFAULT_CHUNK_SIZE}",
+    )
+    parser.add_argument(
+        "--speaker-workers",
+        type=int,
+        default=DEFAULT_SPEAKER_WORKERS,
+        metavar="N",
+        help="Speaker verification candidates compared at the same time. "
+        f"Default: {DEFAULT_SPEAKER_WORKERS}",
+    )
+    parser.add_argument(
+        "--audio-window",
+        type=float,
+        default=DEFAULT_WINDOW,
+        metavar="SECONDS",
+        help="Seconds in a window of the streamed audio anomaly requests. "
+        f"Default: {DEFAULT_WINDOW}",
+    )
+    parser.add_argument(
+        "--audio-hop",
+        type=float,
+        default=DEFAULT_HOP,
+        metavar="SECONDS",
+        help="Seconds between the starts of the audio anomaly windows. "
+        f"Default: {DEFAULT_HOP}",
+    )
+    parser.add_argument(
+        "--audio-pipeline",
+        type=int,
+        default=DEFAULT_PIPELINE,
+        metavar="N",
+        help="Audio anomaly windows sent at a time. "
+        f"Default: {DEFAULT_PIPELINE}",
+    )
+    parser.add_argument(
+        "--face-db",
+        type=str,
+        action="append",
+        default=[],
+        metavar="PATH",
+        dest="face_databases",
+        help="Index the face database at startup",
+    )
+    parser.add_argument(
+        "--face-db-interval",
+        type=float,
+        default=DEFAULT_CHECK_INTERVAL,
+        metavar="SECONDS",
+        help="Seconds between the checks for changes in a face database. "
+        f"Default: {DEFAULT_CHECK_INTERVAL}",
+    )
+    parser.add_argument(
+        "--disable",
+        type=str,
+        action="append",
+        default=[],
+        metavar="TOPIC",
+        dest="disabled_topics",
+        help="Ignore requests for the topic",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=backends.DEFAULT_POOL_SIZE,
+        metavar="N",
+        help="Kept alive connections per analytics backend. "
+        f"Default: {backends.DEFAULT_POOL_SIZE}",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=backends.DEFAULT_CONNECT_TIMEOUT,
+        metavar="SECONDS",
+        help="Timeout for connecting to a backend. "
+        f"Default: {backends.DEFAULT_CONNECT_TIMEOUT}",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=backends.DEFAULT_READ_TIMEOUT,
+        metavar="SECONDS",
+        help="Timeout for a backend response. "
+        f"Default: {backends.DEFAULT_READ_TIMEOUT}",
+    )
+    parser.add_argument(
+        "--gateway",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="Run the analytics with websocket-client and worker threads or "
+        "on an asyncio event loop. The asyncio gateway needs aiohttp. "
+        "Default: threads",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT,
+        metavar="N",
+        help="Maximum number of concurrent requests with the asyncio gateway. "
+        f"Default: {DEFAULT_MAX_IN_FLIGHT}",
+    )
+    parser.add_argument(
+        "--upload-mmap",
+        action="store_true",
+        help="Upload media files to the backends from memory maps",
+    )
+    parser.add_argument(
+        "--by-reference",
+        choices=sorted(BACKENDS) + ["all"],
+        action="append",
+        default=[],
+        metavar="BACKEND",
+        help="Send the paths and SHA-256 of the media files to the backend "
+        "on this host instead of uploading them. One of %(choices)s",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Keep the results of N parental control, object recognition "
+        "and face recognition requests for repeated requests. Default: 0",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=DEFAULT_TTL,
+        metavar="SECONDS",
+        help=f"How long a cached result is used. Default: {DEFAULT_TTL}",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        metavar="PATH",
+        help="Also keep the cached results in this directory",
+    )
+    parser.add_argument(
+        "--deepspeech",
+        choices=["pool", "http"],
+        default="pool",
+        help="Run DeepSpeech in a pool of warm containers, or send the "
+        "requests to the DeepSpeech worker service on port "
+        f"{BACKENDS['deepspeech'].port}. Default: pool",
+    )
+    parser.add_argument(
+        "--deepspeech-containers",
+        type=int,
+        default=deepspeech_pool.size,
+        metavar="N",
+        help="Number of warm DeepSpeech containers. "
+        f"Default: {deepspeech_pool.size}",
+    )
+    parser.add_argument(
+        "--aud-cache-ttl",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="Reuse AUD Manager responses for this long. Default: 0",
+    )
+    parser.add_argument(
+        "--cursor-file",
+        type=str,
+        default=DEFAULT_CURSOR_FILE,
+        metavar="PATH",
+        help="File keeping the time of the last alarm check of each Netspot "
+        f"service. Default: {DEFAULT_CURSOR_FILE}",
+    )
+    parser.add_argument(
+        "--netspot",
+        type=parse_address,
+        action="append",
+        default=[],
+        metavar="ADDRESS:PORT",
+        dest="netspot_services",
+        help="Follow the alarms of the Netspot service and publish them as "
+        "they arrive. Can be given more than once.",
+    )
+    parser.add_argument(
+        "--netspot-device",
+        type=str,
+        default=DEFAULT_NETSPOT_DEVICE,
+        metavar="NAME",
+        help="Device name in the followed alarms. "
+        f"Default: {DEFAULT_NETSPOT_DEVICE}",
+    )
+    parser.add_argument(
+        "--netspot-page-size",
+        type=int,
+        default=DEFAULT_PAGE_SIZE,
+        metavar="N",
+        help=f"Alarms asked in one request. Default: {DEFAULT_PAGE_SIZE}",
+    )
+    parser.add_argument(
+        "--netspot-min-interval",
+        type=float,
+        default=DEFAULT_MIN_INTERVAL,
+        metavar="SECONDS",
+        help="Time between the polls while alarms arrive. "
+        f"Default: {DEFAULT_MIN_INTERVAL}",
+    )
+    parser.add_argument(
+        "--netspot-max-interval",
+        type=float,
+        default=DEFAULT_MAX_INTERVAL,
+        metavar="SECONDS",
+        help="Longest time between the polls without alarms. "
+        f"Default: {DEFAULT_MAX_INTERVAL}",
+    )
+    parser.add_argument(
+        "--netspot-top-k",
+        type=int,
+        default=DEFAULT_TOP_K,
+        metavar="N",
+        help="Most probable alarms listed in the Netspot results. "
+        f"Default: {DEFAULT_TOP_K}",
+    )
+    parser.add_argument(
+        "--netspot-group-by",
+        type=parse_fields,
+        default=DEFAULT_GROUP_BY,
+        metavar="FIELD,...",
+        help="Alarm fields counting the alarms in the Netspot results. "
+        f"Default: {','.join(DEFAULT_GROUP_BY)}",
+    )
+    parser.add_argument(
+        "--json",
+        choices=["auto", "json", "orjson"],
+        default="auto",
+        help="JSON codec of the messages. auto uses orjson when it is "
+        "installed. Default: auto",
+    )
+    parser.add_argument(
+        "--pass-through",
+        action=BooleanOptionalAction,
+        default=True,
+        help="Forward the result messages of the backends as they are, "
+        "checking only that they start with RequestPostTopicUUID. "
+        "Default: on",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default=logs.DEFAULT_LEVEL,
+        help="Lowest level of the logged records. DEBUG also logs every "
+        f"received message. Default: {logs.DEFAULT_LEVEL}",
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=["text", "json"],
+        default=logs.DEFAULT_FORMAT,
+        help=f"Format of the log records. Default: {logs.DEFAULT_FORMAT}",
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=parse_topic_limit,
+        action="append",
+        default=[],
+        metavar="TOPIC=N",
+        help="Log one of every N informational records of the topic. Can be "
+        "given more than once.",
+    )
+    parser.add_argument(
+        "--log-payload-size",
+        type=int,
+        default=logs.DEFAULT_MAX_PAYLOAD,
+        metavar="N",
+        help="Characters of a message or response in a log record. "
+        f"Default: {logs.DEFAULT_MAX_PAYLOAD}",
+    )
+    parser.add_argument(
+        "--log-payloads",
+        action=BooleanOptionalAction,
+        default=True,
+        help="Log the messages and responses. Default: on",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        metavar="PORT",
+        help="Serve Prometheus metrics on http://ADDRESS:PORT/metrics. "
+        "Default: 0, off",
+    )
+    parser.add_argument(
+        "--metrics-address",
+        type=str,
+        default=metrics.DEFAULT_ADDRESS,
+        metavar="ADDRESS",
+        help=f"Address of the metrics endpoint. "
+        f"Default: {metrics.DEFAULT_ADDRESS}",
+    )
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        default=None,
+        metavar="PATH",
+        help="Write the time spent in each stage of every request to PATH. "
+        "Default: off",
+    )
+    parser.add_argument(
+        "--trace-format",
+        choices=tracing.FORMATS,
+        default=tracing.DEFAULT_FORMAT,
+        help="Chrome trace events or OTLP JSON lines. "
+        f"Default: {tracing.DEFAULT_FORMAT}",
+    )
+    args = parser.parse_args()
+
+    logs.setup(
+        args.log_level,
+        args.log_format,
+        dict(args.log_sample),
+        args.log_payload_size,
+        args.log_payloads,
+    )
+
+    codec.use(args.json)
+    pass_through = args.pass_through
+    backends.configure(
+        pool_size=args.pool_size,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        upload_mmap=args.upload_mmap,
+    )
+    if "all" in args.by_reference:
+        backends.configure(by_reference=True)
+    for name in set(args.by_reference) - {"all"}:
+        BACKENDS[name].configure(by_reference=True)
+    DISABLED_TOPICS.update(args.disabled_topics)
+    camera_sessions.max_fps = args.cam_max_fps
+    object_streams.chunk_size = args.object_chunk_size
+    speaker_verification.workers = args.speaker_workers
+    audio_anomaly_windows.window = args.audio_window
+    audio_anomaly_windows.hop = args.audio_hop
+    audio_anomaly_windows.pipeline = args.audio_pipeline
+    face_databases.check_interval = args.face_db_interval
+    if args.face_databases:
+        face_databases.allow(args.face_databases)
+        threading.Thread(
+            target=face_databases.warm,
+            args=(args.face_databases,),
+            name="face_db",
+            daemon=True,
+        ).start()
+    if args.device_anomaly_window > 0:
+        device_anomaly_batcher = device_anomaly.BatchHandler(
+            BACKENDS["device_anomaly"],
+            TOPIC_HANDLERS[DEVICE_ANOMALY_TOPIC],
+            args.device_anomaly_window,
+            args.device_anomaly_batch,
+        )
+        TOPIC_HANDLERS[DEVICE_ANOMALY_TOPIC] = device_anomaly_batcher
+    if args.deepspeech == "pool":
+        deepspeech_pool = DeepSpeechPool(
+            args.deepspeech_containers, timeout=args.read_timeout
+        )
+    else:
+        deepspeech_pool = None
+    if args.aud_cache_ttl > 0:
+        aud_cache = ResultCache(ttl=args.aud_cache_ttl, name="aud")
+    if args.cache_size > 0:
+        result_cache = ResultCache(
+            args.cache_size, args.cache_ttl, args.cache_dir
+        )
+    netspot_cursors = CursorStore(args.cursor_file)
+    netspot_top_k = args.netspot_top_k
+    netspot_group_by = args.netspot_group_by
+    netspot_page_size = args.netspot_page_size
+    for address, port in args.netspot_services:
+        netspot_pollers.append(
+            AlarmPoller(
+                address,
+                port,
+                netspot_cursors,
+                args.netspot_device,
+                netspot_page_size,
+                args.netspot_min_interval,
+                args.netspot_max_interval,
+                netspot_top_k,
+                netspot_group_by,
+            )
+        )
+
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = metrics.serve(args.metrics_port, args.metrics_address)
+    if args.trace_file:
+        tracing.enable(args.trace_file, args.trace_format)
+
+    try:
+        if args.gateway == "asyncio":
+            async_gateway.run(
+                args.url,
+                parse_request,
+                args.max_in_flight,
+                on_open=start_netspot_pollers,
+            )
+        else:
+            run_threads(args)
+    finally:
+        for poller in netspot_pollers:
+            poller.stop()
+        camera_sessions.stop_all()
+        speaker_verification.close()
+        audio_anomaly_windows.close()
+        if device_anomaly_batcher is not None:
+            device_anomaly_batcher.flush()
+        backends.close_all()
+        netspot_cursors.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        tracing.close()
+        logs.shutdown()
+        if deepspeech_pool is not None:
+            deepspeech_pool.stop()
+
+
+def run_threads(args):
+    """Runs the analytics with websocket-client and worker threads"""
+    global dispatcher
+
+    if args.workers > 0:
+        topic_limits = dict(TOPIC_LIMITS)
+        topic_limits.update(args.topic_limits)
+        priorities = dict(TOPIC_PRIORITIES)
+        priorities.update(args.topic_priorities)
+        dispatcher = Dispatcher(
+            args.workers,
+            topic_limits,
+            priorities=priorities,
+            max_pending=args.max_queue or None,
+            deadline=args.deadline or None,
+            on_reject=reject_request,
+        )
+
     ws = websocket.WebSocketApp(
-        "ws://localhost:3000/ws",
+        args.url,
         on_open=on_open,
         on_message=on_message,
         on_error=on_error,
@@ -774,3 +1512,10 @@ if __name__ == "__main__":
     )
 
     ws.run_forever()
+
+    if dispatcher is not None:
+        dispatcher.shutdown()
+
+
+if __name__ == "__main__":
+    main()
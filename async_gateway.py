@@ -0,0 +1,301 @@
+"""
+Asyncio Gateway
+
+Alternative to the websocket-client and worker thread setup in
+analytics_api.py. The DHT connection and the backend requests run on one
+asyncio event loop with aiohttp, so hundreds of analytics requests can wait
+for their backends without a thread each.
+
+The gateway uses the same topic handlers. Handlers registered with
+backend_handler describe their request with a BackendRequest, which is sent
+here with aiohttp, and their reply function builds the result message. The
+other handlers, and the messages for which build() returns None, are run in
+the default thread pool executor.
+
+Needs the optional aiohttp dependency.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+
+import codec
+import logs
+import metrics
+import tracing
+from backends import (
+    REFERENCE_HEADER,
+    reference_rejected,
+    report_upload,
+    trace_upload,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+DEFAULT_MAX_IN_FLIGHT = 256
+
+log = logs.get_logger("gateway")
+
+
+class AsyncSender:
+    """Serializes the sends to an aiohttp WebSocket"""
+
+    def __init__(self, ws):
+        self._ws = ws
+        self._lock = asyncio.Lock()
+
+    async def send(self, data):
+        async with self._lock:
+            await self._ws.send_str(data)
+
+
+class ThreadSender:
+    """Lets handlers running in a worker thread send with an AsyncSender"""
+
+    def __init__(self, sender, loop):
+        self._sender = sender
+        self._loop = loop
+
+    def send(self, data):
+        future = asyncio.run_coroutine_threadsafe(
+            self._sender.send(data), self._loop
+        )
+        return future.result()
+
+
+async def read_chunks(body):
+    """Reads the MultipartEncoder *body* in a thread, one chunk at a time"""
+    while True:
+        chunk = await asyncio.to_thread(body.read, body.chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class AsyncBackends:
+    """
+    aiohttp sessions for the analytics backends
+
+    Each Backend gets its own session, limited to the pool size and using the
+    timeouts of the Backend.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+
+    def session(self, backend):
+        session = self._sessions.get(backend.base_url)
+        if session is None:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=backend.pool_size),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=backend.connect_timeout,
+                    sock_read=backend.read_timeout,
+                ),
+            )
+            self._sessions[backend.base_url] = session
+        return session
+
+    async def send(self, request):
+        """
+        Sends the BackendRequest
+
+        Returns
+        -------
+        (int, bytes)
+            Status code and content of the response.
+        """
+        started = time.perf_counter()
+        try:
+            result = await self._send(request)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            metrics.backend_request(
+                request.backend, "error", time.perf_counter() - started
+            )
+            raise
+        metrics.backend_request(
+            request.backend, result[0], time.perf_counter() - started
+        )
+        return result
+
+    async def _send(self, request):
+        session = self.session(request.backend)
+        if not request.parts:
+            with tracing.span("inference", backend=request.backend.name):
+                async with session.request(
+                    request.method, request.url, params=request.params
+                ) as response:
+                    return response.status, await response.read()
+
+        if request.by_reference:
+            # Hashing the files reads them
+            parts = await asyncio.to_thread(request.reference_parts)
+            status, content, headers = await self._send_parts(
+                session, request, parts, True
+            )
+            if not reference_rejected(request.backend, status, headers):
+                return status, content
+        status, content, _ = await self._send_parts(
+            session, request, request.parts
+        )
+        return status, content
+
+    async def _send_parts(self, session, request, parts, by_reference=False):
+        with tracing.span("open"):
+            body = request.encoder(parts)
+        with body:
+            headers = {
+                "Content-Type": body.content_type,
+                "Content-Length": str(len(body)),
+            }
+            if by_reference:
+                headers[REFERENCE_HEADER] = "reference"
+            try:
+                async with session.request(
+                    request.method,
+                    request.url,
+                    params=request.params,
+                    data=read_chunks(body),
+                    headers=headers,
+                ) as response:
+                    result = (
+                        response.status,
+                        await response.read(),
+                        response.headers,
+                    )
+            finally:
+                trace_upload(body, time.perf_counter())
+        report_upload(request.backend, body)
+        return result
+
+    async def close(self):
+        sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            await session.close()
+
+
+class Gateway:
+    """
+    Reads the DHT messages and runs their handlers as tasks
+
+    Parameters
+    ----------
+    parse : callable
+        Called as parse(message) and returns (topic_name, value, handler) or
+        None, like analytics_api.parse_request.
+    max_in_flight : int
+        Maximum number of handlers running at the same time. Reading the DHT
+        waits when the limit is reached.
+    on_open : callable or None
+        Called as on_open(ws) when connected, with a ws whose send() can be
+        called from other threads.
+    """
+
+    def __init__(
+        self, parse, max_in_flight=DEFAULT_MAX_IN_FLIGHT, on_open=None
+    ):
+        if aiohttp is None:
+            raise RuntimeError("The asyncio gateway needs aiohttp installed")
+        self._parse = parse
+        self._on_open = on_open
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._tasks = set()
+        self.backends = AsyncBackends()
+
+    async def run(self, url):
+        """Connects to the DHT in *url* and handles messages until closed"""
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.ws_connect(url) as ws:
+                    print("### Connection established ###")
+                    sender = AsyncSender(ws)
+                    if self._on_open is not None:
+                        loop = asyncio.get_running_loop()
+                        self._on_open(ThreadSender(sender, loop))
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            await self.on_message(sender, message.data)
+                        elif message.type == aiohttp.WSMsgType.ERROR:
+                            log.error("%s", ws.exception())
+                            break
+                    print("### Connection closed ###")
+                    await self.join()
+        finally:
+            await self.backends.close()
+
+    async def on_message(self, sender, message):
+        """Starts a task for the handler of the DHT *message*"""
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "Received", extra=logs.fields(message=logs.payload(message))
+            )
+        started = time.perf_counter()
+        try:
+            request = self._parse(message)
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning(
+                "Invalid message: %s",
+                e,
+                extra=logs.fields(message=logs.payload(message)),
+            )
+            return
+        if request is None:
+            return
+        topic_name, value, handler = request
+        trace = tracing.begin(topic_name, value, started)
+        await self._in_flight.acquire()
+        task = asyncio.create_task(
+            self._handle(sender, topic_name, handler, value, trace)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def join(self):
+        """Waits for the running handlers"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def _handle(self, sender, topic_name, handler, value, trace=None):
+        try:
+            with metrics.handling(topic_name), tracing.activate(trace):
+                await self._run_handler(sender, handler, value)
+        except Exception:
+            log.exception("Handler failed")
+        finally:
+            self._in_flight.release()
+
+    async def _run_handler(self, sender, handler, value):
+        build = getattr(handler, "build", None)
+        request = build(value) if build is not None else None
+        if request is None:
+            loop = asyncio.get_running_loop()
+            # The executor does not copy the context with the trace
+            context = contextvars.copy_context()
+            await loop.run_in_executor(
+                None, context.run, handler, ThreadSender(sender, loop), value
+            )
+            return
+        key, message = None, None
+        if handler.cached:
+            # Hashing the uploaded files reads them
+            key, message = await asyncio.to_thread(
+                handler.lookup, value, request
+            )
+        if message is None:
+            status, content = await self.backends.send(request)
+            message = handler.complete(key, value, status, content)
+        if message is not None:
+            with tracing.span("send"):
+                await sender.send(codec.dumps(message))
+
+
+def run(url, parse, max_in_flight=DEFAULT_MAX_IN_FLIGHT, on_open=None):
+    """Runs the asyncio gateway until the DHT connection is closed"""
+
+    async def main():
+        await Gateway(parse, max_in_flight, on_open).run(url)
+
+    asyncio.run(main())
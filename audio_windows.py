@@ -0,0 +1,369 @@
+"""
+Audio Anomaly Detection in Windows
+
+A SIFIS:Privacy_Aware_Audio_Anomaly_Detection request posts the whole WAV
+file to the audio anomaly backend and gets the predictions of the whole
+recording at once. A request with "stream": true instead splits the
+recording into overlapping windows of *window* seconds, starting every
+*hop* seconds, and posts each window as a WAV file of its own to the same
+endpoint.
+
+The file is memory mapped and each window is read from the map when it is
+sent, so only the windows being sent are in memory. The windows are sent
+on a thread pool of *pipeline* threads shared by the requests, and a request
+has at most *pipeline* windows in flight. The predictions of each window
+are published in order as a results message with "final": false, and the
+last message has the timeline of the windows and the top_k labels over the
+whole recording.
+"""
+import collections
+import mmap
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import NamedTuple
+
+import requests
+
+import codec
+import logs
+from backends import BackendRequest, Content, FallbackHandler
+
+DEFAULT_WINDOW = 10.0
+DEFAULT_HOP = 5.0
+
+# Windows sent at a time
+DEFAULT_PIPELINE = 4
+
+# Labels in the predictions over the whole recording
+DEFAULT_TOP_K = 5
+
+TOPIC = "SIFIS:Privacy_Aware_Audio_Anomaly_Detection"
+RESULTS_TOPIC = TOPIC + "_Results"
+
+log = logs.get_logger("audio_windows")
+
+
+class WavFormat(NamedTuple):
+    """Format and location of the samples in a WAV file"""
+
+    # Contents of the fmt chunk
+    fmt: bytes
+    data_offset: int
+    data_size: int
+
+    @property
+    def sample_rate(self):
+        return struct.unpack_from("<I", self.fmt, 4)[0]
+
+    @property
+    def block_align(self):
+        return struct.unpack_from("<H", self.fmt, 12)[0]
+
+    @property
+    def duration(self):
+        return self.data_size / self.block_align / self.sample_rate
+
+
+def parse_wav(data):
+    """
+    Returns the WavFormat of the WAV file *data*
+
+    Raises ValueError when *data* is not a WAV file.
+    """
+    if len(data) < 12 or data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("Not a WAV file")
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = bytes(data[offset : offset + 4])
+        (size,) = struct.unpack_from("<I", data, offset + 4)
+        start = offset + 8
+        if chunk_id == b"fmt ":
+            fmt = bytes(data[start : start + size])
+        elif chunk_id == b"data":
+            if fmt is None or len(fmt) < 16:
+                raise ValueError("No fmt chunk before the data")
+            size = min(size, len(data) - start)
+            wav = WavFormat(fmt, start, size)
+            if not wav.block_align or not wav.sample_rate:
+                raise ValueError("Invalid fmt chunk")
+            return wav
+        # Chunks are padded to an even size
+        offset = start + size + (size & 1)
+    raise ValueError("No data chunk")
+
+
+def windows(wav, window, hop):
+    """
+    Returns the (start, end) byte offsets of the windows in the data
+
+    The offsets are relative to the start of the samples and fall on whole
+    frames. A recording shorter than *window* is one window.
+    """
+    length = max(1, int(window * wav.sample_rate)) * wav.block_align
+    step = max(1, int(hop * wav.sample_rate)) * wav.block_align
+    size = wav.data_size - wav.data_size % wav.block_align
+    if size <= length:
+        return [(0, size)]
+    offsets = list(range(0, size - length + 1, step))
+    if offsets[-1] + length < size:
+        # The last window ends at the end of the recording
+        offsets.append(size - length)
+    return [(start, start + length) for start in offsets]
+
+
+def window_wav(data, wav, start, end):
+    """Returns the WAV file of the samples from *start* to *end*"""
+    fmt = wav.fmt
+    size = end - start
+    header = (
+        b"RIFF"
+        + struct.pack("<I", 4 + 8 + len(fmt) + 8 + size)
+        + b"WAVE"
+        + b"fmt "
+        + struct.pack("<I", len(fmt))
+        + fmt
+        + b"data"
+        + struct.pack("<I", size)
+    )
+    offset = wav.data_offset
+    return header + data[offset + start : offset + end]
+
+
+def top_labels(results, top_k):
+    """
+    Returns the *top_k* labels of the window *results*
+
+    Each label has its highest probability in any window and the number of
+    windows predicting it.
+    """
+    labels = {}
+    for result in results:
+        for prediction in result.get("predictions", ()):
+            label = prediction["label"]
+            probability = prediction["probability"]
+            best, count = labels.get(label, (probability, 0))
+            labels[label] = (max(best, probability), count + 1)
+    ranked = sorted(labels.items(), key=lambda item: -item[1][0])
+    return [
+        {"label": label, "probability": probability, "windows": count}
+        for label, (probability, count) in ranked[:top_k]
+    ]
+
+
+def results_message(value, **fields):
+    """Returns a results message for the request *value*"""
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": RESULTS_TOPIC,
+            "topic_uuid": "Audio_Anomaly_Detection_Results",
+            "value": dict(
+                description="Audio Anomaly Detection Results",
+                requestor_id=str(value.get("requestor_id")),
+                requestor_type=str(value.get("requestor_type")),
+                request_id=str(value.get("request_id")),
+                audio_file=str(value.get("audio_file")),
+                method=str(value.get("method")),
+                **fields,
+            ),
+        }
+    }
+
+
+class WindowedAudioAnomaly(FallbackHandler):
+    """
+    Topic handler of the audio anomaly requests
+
+    Requests with "stream": true are sent in windows, the others go to
+    *fallback*.
+
+    Parameters
+    ----------
+    backend : Backend
+        Audio anomaly backend.
+    fallback : callable
+        Handler for the requests without windows.
+    data_dir : str
+        Directory of the recordings named in the requests.
+    window : float
+        Seconds in a window.
+    hop : float
+        Seconds from the start of a window to the start of the next one.
+    pipeline : int
+        Windows sent at a time, by all the requests together and by each
+        request.
+    top_k : int
+        Labels in the predictions of the whole recording.
+    """
+
+    def __init__(
+        self,
+        backend,
+        fallback,
+        data_dir,
+        window=DEFAULT_WINDOW,
+        hop=DEFAULT_HOP,
+        pipeline=DEFAULT_PIPELINE,
+        top_k=DEFAULT_TOP_K,
+    ):
+        self.backend = backend
+        self.fallback = fallback
+        self.data_dir = data_dir
+        self.window = window
+        self.hop = hop
+        self.top_k = top_k
+        self._pipeline = pipeline
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def pipeline(self):
+        return self._pipeline
+
+    @pipeline.setter
+    def pipeline(self, pipeline):
+        with self._lock:
+            self._pipeline = pipeline
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self._pipeline, thread_name_prefix="audio"
+                )
+            return self._executor
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def handles(self, value):
+        return bool(value.get("stream"))
+
+    def __call__(self, ws, value):
+        if not self.handles(value):
+            self.fallback(ws, value)
+            return
+        try:
+            self.stream(ws, value)
+        except requests.RequestException as e:
+            log.warning(
+                "Request failed: %s",
+                e,
+                extra=logs.request_fields(value, TOPIC),
+            )
+        except (OSError, ValueError) as e:
+            log.warning(
+                "Reading the recording failed: %s",
+                e,
+                extra=logs.request_fields(value, TOPIC),
+            )
+
+    def url(self, value):
+        return self.backend.url(
+            "model",
+            "predict",
+            value["audio_file"],
+            value["method"],
+            value["requestor_id"],
+            value["requestor_type"],
+            value["request_id"],
+        )
+
+    def stream(self, ws, value):
+        """Sends the windows of the request *value* and publishes them"""
+        with open(self.data_dir + value["audio_file"], "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self._stream(ws, value, data)
+
+    def _stream(self, ws, value, data):
+        wav = parse_wav(data)
+        url = self.url(value)
+        bounds = windows(wav, self.window, self.hop)
+        frame_rate = wav.sample_rate * wav.block_align
+        timeline = []
+        executor = self.executor()
+        pending = collections.deque()
+        try:
+            for index, (start, end) in enumerate(bounds):
+                pending.append(
+                    (
+                        index,
+                        start / frame_rate,
+                        end / frame_rate,
+                        executor.submit(
+                            self._predict, url, data, wav, start, end
+                        ),
+                    )
+                )
+                if len(pending) >= self.pipeline:
+                    self._publish(ws, value, pending.popleft(), timeline)
+            while pending:
+                self._publish(ws, value, pending.popleft(), timeline)
+        finally:
+            # The windows read the memory map closed after this
+            for *_, future in pending:
+                future.cancel()
+            wait([future for *_, future in pending])
+        results = [entry for entry in timeline if "predictions" in entry]
+        ws.send(
+            codec.dumps(
+                results_message(
+                    value,
+                    duration=wav.duration,
+                    timeline=timeline,
+                    predictions=top_labels(results, self.top_k),
+                    final=True,
+                )
+            )
+        )
+        log.info(
+            "Request succeeded with %d windows.",
+            len(timeline),
+            extra=logs.request_fields(value, TOPIC),
+        )
+
+    def _predict(self, url, data, wav, start, end):
+        audio = Content(
+            "audio",
+            window_wav(data, wav, start, end),
+            "window.wav",
+            "audio/wav",
+        )
+        request = BackendRequest(self.backend, "POST", url, parts=(audio,))
+        response = request.send()
+        if response.status_code != 200:
+            return {"status": f"failed with {response.status_code}"}
+        result = codec.loads(response.content)
+        if not isinstance(result, dict) or not isinstance(
+            result.get("predictions"), list
+        ):
+            raise ValueError("No predictions in the response")
+        return {"predictions": result["predictions"][: self.top_k]}
+
+    def _publish(self, ws, value, item, timeline):
+        index, start, end, future = item
+        try:
+            result = future.result()
+        except (
+            requests.RequestException,
+            ValueError,
+            KeyError,
+            TypeError,
+        ) as e:
+            log.warning(
+                "Window %d failed: %s",
+                index,
+                e,
+                extra=logs.request_fields(value, TOPIC),
+            )
+            result = {"status": f"failed: {e}"}
+        entry = dict(index=index, start=start, end=end, **result)
+        timeline.append(entry)
+        ws.send(codec.dumps(results_message(value, window=entry, final=False)))
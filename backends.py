@@ -0,0 +1,655 @@
+"""
+Analytics Backends
+
+The analytics run in their own services on the local host. Each service gets
+one shared requests.Session so the connections are kept alive and reused
+instead of opening a new TCP connection for every request. The sessions have
+their own connection pools, and every request has connect and read timeouts,
+so a hung backend can not block a worker forever.
+
+The media files are usually uploaded to the backends as multipart forms,
+although the backends run on the same host and can read the files
+themselves. Backends configured with by_reference get the path and SHA-256
+of each file in the form instead of its contents. A backend that rejects
+such a form gets the files uploaded, and later requests are uploaded too.
+"""
+import abc
+import hashlib
+import mmap
+import os
+import threading
+import time
+from contextlib import ExitStack
+from typing import NamedTuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
+
+import logs
+import metrics
+import tracing
+
+DEFAULT_HOST = "localhost"
+DEFAULT_POOL_SIZE = 4
+
+# Seconds to wait for the connection and for the backend to respond. The
+# read timeout has to cover the inference, e.g. a long Whisper transcription.
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 300.0
+
+# Bytes read from an uploaded file at a time
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+# Hosts of the backends that can read the files by reference
+LOCAL_HOSTS = frozenset(["localhost", "127.0.0.1", "::1"])
+
+# Response status of a backend not reading the files by reference
+REFERENCE_REJECTED = 415
+
+# Header telling the backend the files are sent by reference. A backend
+# answering with the header set to REFERENCE_UPLOAD asks for the upload.
+REFERENCE_HEADER = "X-Analytics-Transport"
+REFERENCE_UPLOAD = "upload"
+
+# Response statuses of a backend without the requested endpoint
+MISSING_ENDPOINT = frozenset([404, 405])
+
+log = logs.get_logger("backends")
+
+
+class MissingEndpoint(Exception):
+    """The backend has no such endpoint"""
+
+
+class FallbackHandler(abc.ABC):
+    """
+    Base of the topic handlers sending some of the requests themselves
+
+    handles(value) is True for the requests the subclass sends, and the
+    others go to the *fallback* handler. The build(), reply(), lookup() and
+    complete() of a BackendHandler fallback are exposed, so the asyncio
+    gateway sends those requests without a thread. build() returns None for
+    the requests of the subclass.
+    """
+
+    fallback = None
+
+    @abc.abstractmethod
+    def handles(self, value):
+        """Returns True for the requests sent by the subclass"""
+
+    def build(self, value):
+        build = getattr(self.fallback, "build", None)
+        if build is None or self.handles(value):
+            return None
+        return build(value)
+
+    @property
+    def reply(self):
+        return self.fallback.reply
+
+    @property
+    def topic_name(self):
+        return self.fallback.topic_name
+
+    @property
+    def cached(self):
+        return self.fallback.cached
+
+    def lookup(self, value, request):
+        return self.fallback.lookup(value, request)
+
+    def complete(self, key, value, status_code, content):
+        return self.fallback.complete(key, value, status_code, content)
+
+
+class Backend:
+    """
+    Analytics service with a shared keep-alive session
+
+    Parameters
+    ----------
+    name : str
+        Name used in the configuration and messages.
+    port : int
+        Port the service is listening to.
+    host : str
+        Service address.
+    pool_size : int
+        Maximum number of kept alive connections to the service.
+    connect_timeout : float
+        Seconds to wait for the connection.
+    read_timeout : float
+        Seconds to wait for the response.
+    upload_mmap : bool
+        Upload files from a memory map instead of reading them.
+    by_reference : bool
+        Send the path and SHA-256 of the files instead of uploading them,
+        if the service is on the local host.
+    """
+
+    def __init__(
+        self,
+        name,
+        port,
+        host=DEFAULT_HOST,
+        pool_size=DEFAULT_POOL_SIZE,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+        upload_mmap=False,
+        by_reference=False,
+    ):
+        self.name = name
+        self.port = port
+        self.host = host
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.upload_mmap = upload_mmap
+        self.by_reference = by_reference
+        self._session = None
+        self._missing_endpoints = set()
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def local(self):
+        """True when the service is on this host"""
+        return self.host in LOCAL_HOSTS
+
+    @property
+    def timeout(self):
+        return self.connect_timeout, self.read_timeout
+
+    @property
+    def session(self):
+        """The shared session, created on first use"""
+        with self._lock:
+            if self._session is None:
+                self._session = self._make_session()
+            return self._session
+
+    def url(self, *segments):
+        """Returns the service URL for the path made of *segments*"""
+        return "/".join([self.base_url] + [str(s) for s in segments])
+
+    def request(self, method, url, **kwargs):
+        """Sends the request with the backend timeouts unless given"""
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            metrics.backend_request(
+                self, "error", time.perf_counter() - started
+            )
+            raise
+        metrics.backend_request(
+            self, response.status_code, time.perf_counter() - started
+        )
+        return response
+
+    def has_endpoint(self, path):
+        """False once the service answered that it has no endpoint *path*"""
+        return path not in self._missing_endpoints
+
+    def check_endpoint(self, path, status_code):
+        """
+        Raises MissingEndpoint when *status_code* is MISSING_ENDPOINT
+
+        The endpoint *path* is then remembered as missing, so has_endpoint()
+        is False until the backend is configured again.
+        """
+        if status_code not in MISSING_ENDPOINT:
+            return
+        if path not in self._missing_endpoints:
+            log.info("Backend %s has no %s endpoint", self.name, path)
+            self._missing_endpoints.add(path)
+        raise MissingEndpoint(path)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def configure(self, **settings):
+        """
+        Changes the settings given as keyword arguments
+
+        The session is recreated on next use so that a new pool size is used.
+        """
+        for key, value in settings.items():
+            if not hasattr(self, key) or key.startswith("_"):
+                raise AttributeError(f"Unknown backend setting {key!r}")
+            setattr(self, key, value)
+        self._missing_endpoints.clear()
+        self.close()
+
+    def close(self):
+        """Closes the pooled connections"""
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+
+class Upload(NamedTuple):
+    """Multipart form part read from a file"""
+
+    name: str
+    path: str
+    filename: str = None
+    content_type: str = None
+
+    @property
+    def form_filename(self):
+        """File name sent in the form, the base name of path by default"""
+        return self.filename or os.path.basename(self.path)
+
+
+class Field(NamedTuple):
+    """Multipart form part with a str value"""
+
+    name: str
+    value: str
+
+
+class Content(NamedTuple):
+    """Multipart form part sent as a file from bytes in memory"""
+
+    name: str
+    data: bytes
+    filename: str
+    content_type: str = None
+
+
+class MultipartEncoder:
+    """
+    Streams a multipart/form-data body from Upload and Field parts
+
+    requests sends the body by calling read(), so only one chunk of an
+    uploaded file is in memory at a time instead of the whole form. With
+    *use_mmap* the chunks are memoryviews of a memory map of the file, which
+    are written to the socket without copying them first. The files are
+    opened when the encoder is created and closed by close().
+
+    The encoded parts are the same as requests makes from a files list.
+    """
+
+    def __init__(
+        self,
+        parts,
+        use_mmap=False,
+        chunk_size=UPLOAD_CHUNK_SIZE,
+        boundary=None,
+    ):
+        self.boundary = boundary or choose_boundary()
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.started = None
+        self.finished = None
+        self._stack = ExitStack()
+        self._segments = []
+        self._index = 0
+        self._offset = 0
+        try:
+            for part in parts:
+                self._add_part(part, use_mmap)
+            self._segments.append(f"--{self.boundary}--\r\n".encode())
+        except BaseException:
+            self.close()
+            raise
+        self.length = sum(len(segment) for segment in self._segments)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def elapsed(self):
+        """Seconds from the first read to the end of the body"""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def bytes_per_second(self):
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes_read / elapsed
+
+    def read(self, size=-1):
+        """
+        Returns up to *size* bytes of the body
+
+        A read does not continue past the end of an uploaded file, so the
+        result can be shorter than *size* before the end of the body.
+        """
+        if self.started is None:
+            self.started = time.perf_counter()
+        if size is None or size < 0:
+            size = self.length
+        while self._index < len(self._segments):
+            segment = self._segments[self._index]
+            if isinstance(segment, _FileSegment):
+                data = segment.read(self._offset, size)
+            else:
+                data = segment[self._offset : self._offset + size]
+            if data:
+                self._offset += len(data)
+                self.bytes_read += len(data)
+                return data
+            self._index += 1
+            self._offset = 0
+        if self.finished is None:
+            self.finished = time.perf_counter()
+        return b""
+
+    def close(self):
+        """Closes the uploaded files"""
+        self._stack.close()
+
+    def _add_part(self, part, use_mmap):
+        if isinstance(part, Upload):
+            field = RequestField(part.name, None, part.form_filename)
+            field.make_multipart(content_type=part.content_type)
+            file = self._stack.enter_context(open(part.path, "rb"))
+            body = _FileSegment(file, use_mmap, self._stack)
+        elif isinstance(part, Content):
+            field = RequestField(part.name, None, part.filename)
+            field.make_multipart(content_type=part.content_type)
+            body = part.data
+        else:
+            field = RequestField(part.name, None, part.name)
+            field.make_multipart()
+            body = part.value.encode()
+        header = f"--{self.boundary}\r\n{field.render_headers()}"
+        self._segments += [header.encode(), body, b"\r\n"]
+
+
+class _FileSegment:
+    """Uploaded file in a MultipartEncoder"""
+
+    def __init__(self, file, use_mmap, stack):
+        self._file = file
+        self._size = os.fstat(file.fileno()).st_size
+        self._view = None
+        if use_mmap and self._size > 0:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            stack.callback(self._close_map, mapped)
+            self._view = memoryview(mapped)
+
+    def __len__(self):
+        return self._size
+
+    def read(self, offset, size):
+        if self._view is not None:
+            return self._view[offset : offset + size]
+        return self._file.read(size)
+
+    def _close_map(self, mapped):
+        self._view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # A chunk is still referenced, e.g. by a socket buffer. The map
+            # is closed when the chunk is released.
+            pass
+
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+# Files whose digest is kept
+MAX_DIGESTS = 1024
+
+
+def file_digest(path):
+    """
+    Returns the SHA-256 of the file contents
+
+    The digest is reused while the size and modification time of the file
+    stay the same.
+    """
+    status = os.stat(path)
+    stamp = (status.st_size, status.st_mtime_ns)
+    with _digests_lock:
+        cached = _digests.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    with _digests_lock:
+        _digests[path] = (stamp, digest.hexdigest())
+        while len(_digests) > MAX_DIGESTS:
+            del _digests[next(iter(_digests))]
+    return digest.hexdigest()
+
+
+def reference_rejected(backend, status_code, headers=None):
+    """
+    Checks the response to a request with the files by reference
+
+    Returns True when the backend did not accept the references, after
+    setting the backend to upload the files from now on. Other errors, e.g.
+    a 400 for an invalid request, are returned to the caller as they are.
+    """
+    transport = (headers or {}).get(REFERENCE_HEADER, "")
+    if (
+        status_code != REFERENCE_REJECTED
+        and transport.lower() != REFERENCE_UPLOAD
+    ):
+        return False
+    log.warning(
+        "%s rejected the files by reference with %s, uploading them",
+        backend.name,
+        status_code,
+    )
+    backend.by_reference = False
+    return True
+
+
+def report_upload(backend, body):
+    """Logs the size and speed of the upload"""
+    metrics.uploaded_bytes.inc(backend.name, amount=body.bytes_read)
+    log.debug(
+        "Uploaded %d bytes to %s in %.3f s (%.0f bytes/s)",
+        body.bytes_read,
+        backend.name,
+        body.elapsed,
+        body.bytes_per_second,
+    )
+
+
+def trace_upload(body, responded):
+    """Adds the upload and inference spans of a sent multipart *body*"""
+    tracing.record(
+        "upload", body.started, body.finished, bytes=body.bytes_read
+    )
+    tracing.record("inference", body.finished, responded)
+
+
+class BackendRequest(NamedTuple):
+    """
+    Request for an analytics backend
+
+    The topic handlers describe their requests with this so that the same
+    request can be sent with requests or with the asyncio gateway.
+
+    Attributes
+    ----------
+    backend : Backend
+        Service receiving the request.
+    method : str
+        HTTP method.
+    url : str
+        Request URL, usually from backend.url().
+    params : dict or None
+        Query string parameters.
+    parts : tuple
+        Upload, Content and Field objects sent as a multipart form.
+
+    An Upload sent by reference becomes the fields <name>_path,
+    <name>_sha256 and <name>_filename.
+    """
+
+    backend: Backend
+    method: str
+    url: str
+    params: dict = None
+    parts: tuple = ()
+
+    def send(self):
+        """
+        Sends the request with the shared session of the backend
+
+        The multipart form is streamed with a MultipartEncoder and the
+        uploaded files are closed before returning.
+        """
+        if not self.parts:
+            with tracing.span("inference", backend=self.backend.name):
+                return self.backend.request(
+                    self.method, self.url, params=self.params
+                )
+        if self.by_reference:
+            response = self._send_parts(self.reference_parts(), True)
+            if not reference_rejected(
+                self.backend, response.status_code, response.headers
+            ):
+                return response
+        return self._send_parts(self.parts)
+
+    def _send_parts(self, parts, by_reference=False):
+        with tracing.span("open"):
+            body = self.encoder(parts)
+        headers = {"Content-Type": body.content_type}
+        if by_reference:
+            headers[REFERENCE_HEADER] = "reference"
+        with body:
+            try:
+                response = self.backend.request(
+                    self.method,
+                    self.url,
+                    params=self.params,
+                    data=body,
+                    headers=headers,
+                )
+            finally:
+                trace_upload(body, time.perf_counter())
+        report_upload(self.backend, body)
+        return response
+
+    @property
+    def by_reference(self):
+        """True when the files are sent by reference"""
+        return (
+            self.backend.by_reference
+            and self.backend.local
+            and any(isinstance(part, Upload) for part in self.parts)
+        )
+
+    def reference_parts(self):
+        """Returns the parts with the Upload parts sent by reference"""
+        parts = []
+        with tracing.span("hash"):
+            for part in self.parts:
+                if not isinstance(part, Upload):
+                    parts.append(part)
+                    continue
+                parts += [
+                    Field(f"{part.name}_path", os.path.abspath(part.path)),
+                    Field(f"{part.name}_sha256", file_digest(part.path)),
+                    Field(f"{part.name}_filename", part.form_filename),
+                ]
+        return tuple(parts)
+
+    def encoder(self, parts=None):
+        """Returns a MultipartEncoder for the parts, or the given *parts*"""
+        if parts is None:
+            parts = self.parts
+        return MultipartEncoder(parts, self.backend.upload_mmap)
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in [
+        Backend("audio_anomaly", 5000),
+        Backend("deepspeech", 5030),
+        Backend("whisper", 5040),
+        Backend("aud_manager", 5050),
+        Backend("parental_control", 6060),
+        Backend("speaker_verification", 7070),
+        Backend("object_recognition", 8080),
+        Backend("face_recognition", 8090),
+        Backend("device_anomaly", 9090),
+    ]
+}
+
+# Netspot services are given in the alarm requests, so their backends are
+# created when first used, with the settings given to configure().
+_netspots = {}
+_netspots_lock = threading.Lock()
+_netspot_settings = {}
+
+
+def netspot(address, port):
+    """Returns the shared Backend for the Netspot service in address:port"""
+    key = (address, int(port))
+    with _netspots_lock:
+        backend = _netspots.get(key)
+        if backend is None:
+            backend = Backend(
+                f"netspot {address}:{port}",
+                port,
+                address,
+                **_netspot_settings,
+            )
+            _netspots[key] = backend
+        return backend
+
+
+def configure(**settings):
+    """Changes the settings of all backends"""
+    with _netspots_lock:
+        _netspot_settings.update(settings)
+        netspots = list(_netspots.values())
+    for backend in list(BACKENDS.values()) + netspots:
+        backend.configure(**settings)
+
+
+def close_all():
+    """Closes the connections of all backends"""
+    with _netspots_lock:
+        netspots = list(_netspots.values())
+    for backend in list(BACKENDS.values()) + netspots:
+        backend.close()
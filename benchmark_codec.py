@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+JSON Codec Benchmark
+
+Compares the throughput of the available JSON codecs on typical analytics
+messages: a DHT request, a backend response with object recognition results
+and a Netspot results message.
+
+python3 benchmark_codec.py [--number N]
+"""
+import sys
+import timeit
+from argparse import ArgumentParser
+
+import codec
+
+REQUEST = {
+    "Persistent": {
+        "topic_name": "SIFIS:Privacy_Aware_Object_Recognition",
+        "topic_uuid": "Object_Recognition",
+        "value": {
+            "description": "Object Recognition",
+            "requestor_id": "1",
+            "requestor_type": "NSSD",
+            "request_id": "a8c8d4e6-2a9a-4b2e-9d0d-0f6c4b9a1e3f",
+            "file_name": "image.jpg",
+            "epsilon": 0.1,
+            "sensitivity": 1.0,
+        },
+    }
+}
+
+RESPONSE = {
+    "RequestPostTopicUUID": {
+        "topic_name": "SIFIS:Privacy_Aware_Object_Recognition_Results",
+        "topic_uuid": "Object_Recognition_Results",
+        "value": {
+            "description": "Object Recognition Results",
+            "requestor_id": "1",
+            "requestor_type": "NSSD",
+            "request_id": "a8c8d4e6-2a9a-4b2e-9d0d-0f6c4b9a1e3f",
+            "analyzer_id": "Object_Recognition",
+            "analysis_id": "0d9e7f2c",
+            "Results": [
+                {
+                    "label": f"object {i}",
+                    "probability": i / 100,
+                    "box": [i, i + 10, i + 100, i + 200],
+                }
+                for i in range(100)
+            ],
+        },
+    }
+}
+
+NETSPOT = {
+    "RequestPostTopicUUID": {
+        "topic_name": "SIFIS:Netspot_Control_Results",
+        "topic_uuid": "AlarmResult",
+        "value": {
+            "description": "Netspot alarms check results",
+            "Device": "Example Smart Device",
+            "Statistic": "R_SYN",
+            "Status": "UP_ALERT",
+            "Probability": 0.98,
+            "Time": "2023-05-04T10:11:12.123456789Z",
+            "Count": 1200,
+            "Rate": 20.0,
+            "Top Alarms": [
+                {
+                    "Statistic": "R_SYN",
+                    "Status": "UP_ALERT",
+                    "Probability": 0.98 - i / 100,
+                    "Time": "2023-05-04T10:11:12.123456789Z",
+                }
+                for i in range(5)
+            ],
+        },
+    }
+}
+
+PAYLOADS = {"request": REQUEST, "response": RESPONSE, "netspot": NETSPOT}
+
+
+def main():
+    parser = ArgumentParser(description="JSON Codec Benchmark")
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=10000,
+        help="Messages encoded and decoded per measurement. Default: 10000",
+    )
+    args = parser.parse_args()
+
+    print(f"{'payload':10} {'codec':8} {'dumps/s':>12} {'loads/s':>12}")
+    for payload_name, payload in PAYLOADS.items():
+        for name, implementation in codec.CODECS.items():
+            text = implementation.dumps(payload)
+            dumps = timeit.timeit(
+                lambda: implementation.dumps(payload), number=args.number
+            )
+            loads = timeit.timeit(
+                lambda: implementation.loads(text), number=args.number
+            )
+            print(
+                f"{payload_name:10} {name:8} {args.number / dumps:12.0f} "
+                f"{args.number / loads:12.0f}"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,381 @@
+"""
+Camera Sessions
+
+A SIFIS:Privacy_Aware_Face_Recognition_CAM request is one POST to the face
+recognition backend, which opens the camera stream and loads the face
+database again for every request. A request with "session": true instead
+opens a session for its cam_link that stays open until a request with
+"stop": true. One backend stream is kept per cam_link and shared by all
+the requests subscribed to it.
+
+The session posts to the cam_face_recognition_stream endpoint, which
+responds with one JSON line per processed frame, and publishes each frame
+as a SIFIS:Privacy_Aware_Face_Recognition_CAM_Results message to every
+subscribed request. The frames are read at most max_fps per second, which
+is also sent to the backend, so a busy camera can not starve the others.
+The last message of a session has "final": true.
+"""
+import threading
+import time
+
+import requests
+
+import codec
+import logs
+from backends import BackendRequest, FallbackHandler, Field, MissingEndpoint
+
+DEFAULT_MAX_FPS = 2.0
+
+# Seconds to wait for a stopped session to end
+STOP_TIMEOUT = 5.0
+
+STREAM_PATH = "cam_face_recognition_stream"
+TOPIC = "SIFIS:Privacy_Aware_Face_Recognition_CAM"
+RESULTS_TOPIC = "SIFIS:Privacy_Aware_Face_Recognition_CAM_Results"
+
+log = logs.get_logger("camera")
+
+
+def path_field(database_path):
+    """Returns the form fields naming the face database"""
+    return (Field("path", database_path),)
+
+
+def _fields(value):
+    return logs.request_fields(value, TOPIC, cam_link=value.get("cam_link"))
+
+
+def frame_message(value, frame, result, final=False):
+    """
+    Returns the results message of a frame for the request *value*
+
+    Parameters
+    ----------
+    value : dict
+        Subscribed request.
+    frame : int
+        Number of the frame in the session, from 1.
+    result : dict
+        Frame result from the backend, either a results message or its
+        value.
+    final : bool
+        True for the last message of the session.
+    """
+    if isinstance(result, dict) and "RequestPostTopicUUID" in result:
+        result = result["RequestPostTopicUUID"].get("value", {})
+    if not isinstance(result, dict):
+        result = {"result": result}
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": RESULTS_TOPIC,
+            "topic_uuid": RESULTS_TOPIC.partition(":")[2],
+            "value": dict(
+                result,
+                description="Face Recognition Results",
+                requestor_id=value.get("requestor_id"),
+                requestor_type=value.get("requestor_type"),
+                request_id=value.get("request_id"),
+                cam_link=value.get("cam_link"),
+                frame=frame,
+                final=final,
+            ),
+        }
+    }
+
+
+class CameraSession:
+    """
+    Backend stream of one camera and the requests subscribed to it
+
+    Parameters
+    ----------
+    backend : Backend
+        Face recognition backend.
+    value : dict
+        Request opening the session.
+    max_fps : float
+        Frames read per second at most.
+    fallback : callable
+        Handler for one request, used when the backend has no stream
+        endpoint.
+    on_end : callable or None
+        Called as on_end(session) when the stream has ended.
+    database_fields : callable
+        Returns the form fields for the database_path of the request.
+    """
+
+    def __init__(
+        self,
+        backend,
+        value,
+        max_fps,
+        fallback,
+        on_end=None,
+        database_fields=path_field,
+    ):
+        self.backend = backend
+        self.value = value
+        self.cam_link = value["cam_link"]
+        self.max_fps = max_fps
+        self.fallback = fallback
+        self.on_end = on_end
+        self.database_fields = database_fields
+        self.frames = 0
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._response = None
+        self._thread = None
+
+    def subscribe(self, ws, value):
+        """Publishes the frames also to the request *value*"""
+        with self._lock:
+            self._subscribers[str(value.get("request_id"))] = (ws, value)
+
+    def unsubscribe(self, request_id):
+        """
+        Stops publishing the frames to *request_id*
+
+        Returns False, without unsubscribing, for the last subscriber,
+        and None when *request_id* is not subscribed.
+        """
+        with self._lock:
+            request_id = str(request_id)
+            if request_id not in self._subscribers:
+                return None
+            if len(self._subscribers) == 1:
+                return False
+            del self._subscribers[request_id]
+            return True
+
+    def subscribers(self):
+        with self._lock:
+            return list(self._subscribers.values())
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name=f"camera {self.cam_link}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Closes the backend stream and waits for the session to end"""
+        self._stopped.set()
+        response = self._response
+        if response is not None:
+            # Unblocks the reading thread
+            response.close()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def request(self):
+        """Returns the BackendRequest opening the stream"""
+        value = self.value
+        url = self.backend.url(
+            STREAM_PATH,
+            self.cam_link,
+            value["privacy_parameter"],
+            value["requestor_id"],
+            value["requestor_type"],
+            value["request_id"],
+        )
+        return BackendRequest(
+            self.backend,
+            "POST",
+            url,
+            params={"max_fps": self.max_fps},
+            parts=self.database_fields(value["database_path"]),
+        )
+
+    def _run(self):
+        try:
+            self._stream()
+        except requests.RequestException as e:
+            if not self._stopped.is_set():
+                log.warning(
+                    "Camera stream failed: %s", e, extra=_fields(self.value)
+                )
+        except Exception:
+            # Closing the response from stop() can fail the reading
+            if not self._stopped.is_set():
+                log.exception(
+                    "Camera session failed", extra=_fields(self.value)
+                )
+        finally:
+            self._publish({"status": "stopped"}, final=True)
+            if self.on_end is not None:
+                self.on_end(self)
+
+    def _stream(self):
+        request = self.request()
+        with request.encoder() as body:
+            response = self.backend.request(
+                request.method,
+                request.url,
+                params=request.params,
+                data=body,
+                headers={"Content-Type": body.content_type},
+                stream=True,
+            )
+        self._response = response
+        with response:
+            if self._stopped.is_set():
+                return
+            try:
+                self.backend.check_endpoint(STREAM_PATH, response.status_code)
+            except MissingEndpoint:
+                for ws, value in self.subscribers():
+                    self.fallback(ws, value)
+                return
+            if response.status_code != 200:
+                log.warning(
+                    "Camera stream failed with %s.",
+                    response.status_code,
+                    extra=_fields(self.value),
+                )
+                return
+            log.info("Camera session started", extra=_fields(self.value))
+            interval = 1.0 / self.max_fps if self.max_fps > 0 else 0.0
+            next_frame = time.monotonic()
+            for line in response.iter_lines():
+                if self._stopped.is_set():
+                    return
+                if not line:
+                    continue
+                try:
+                    result = codec.loads(line)
+                except ValueError as e:
+                    log.warning(
+                        "Invalid frame result: %s",
+                        e,
+                        extra=_fields(self.value),
+                    )
+                    continue
+                self.frames += 1
+                self._publish(result)
+                # Reading slower holds the backend back with the connection
+                next_frame = max(next_frame + interval, time.monotonic())
+                if self._stopped.wait(next_frame - time.monotonic()):
+                    return
+
+    def _publish(self, result, final=False):
+        for ws, value in self.subscribers():
+            message = frame_message(value, self.frames, result, final)
+            try:
+                ws.send(codec.dumps(message))
+            except Exception as e:
+                log.warning(
+                    "Sending a frame failed: %s", e, extra=_fields(value)
+                )
+
+
+class CameraSessions(FallbackHandler):
+    """
+    Topic handler of the camera face recognition requests
+
+    Requests with "session": true open or join the session of their
+    cam_link and requests with "stop": true leave it. The session ends when
+    its last request leaves, or when a stop request without a request_id
+    arrives. The other requests, and the session requests once the backend
+    has no stream endpoint, go to *fallback*.
+
+    Parameters
+    ----------
+    backend : Backend
+        Face recognition backend.
+    fallback : callable
+        Handler for the requests without a session.
+    max_fps : float
+        Frames read per second at most, per camera.
+    database_fields : callable
+        Returns the form fields for the database_path of a request.
+    """
+
+    def __init__(
+        self,
+        backend,
+        fallback,
+        max_fps=DEFAULT_MAX_FPS,
+        database_fields=path_field,
+    ):
+        self.backend = backend
+        self.fallback = fallback
+        self.max_fps = max_fps
+        self.database_fields = database_fields
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def handles(self, value):
+        return bool(
+            value.get("stop")
+            or value.get("session")
+            and self.backend.has_endpoint(STREAM_PATH)
+        )
+
+    def __call__(self, ws, value):
+        if not self.handles(value):
+            self.fallback(ws, value)
+        elif value.get("stop"):
+            self.leave(value)
+        else:
+            self.join(ws, value)
+
+    def join(self, ws, value):
+        """Subscribes the request to the session of its cam_link"""
+        started = None
+        with self._lock:
+            session = self._sessions.get(value["cam_link"])
+            if session is None:
+                session = started = CameraSession(
+                    self.backend,
+                    value,
+                    self.max_fps,
+                    self.fallback,
+                    self._end,
+                    self.database_fields,
+                )
+                self._sessions[session.cam_link] = session
+            session.subscribe(ws, value)
+        if started is not None:
+            started.start()
+
+    def leave(self, value):
+        """Unsubscribes the request, stopping the session if it was last"""
+        with self._lock:
+            session = self._sessions.get(value.get("cam_link"))
+            if session is None:
+                log.info("No camera session to stop", extra=_fields(value))
+                return
+            request_id = value.get("request_id")
+            if request_id is not None:
+                left = session.unsubscribe(request_id)
+                if left is None:
+                    log.info(
+                        "Not subscribed to the camera session",
+                        extra=_fields(value),
+                    )
+                    return
+                if left:
+                    log.info("Left the camera session", extra=_fields(value))
+                    return
+            del self._sessions[session.cam_link]
+        log.info("Camera session stopped", extra=_fields(value))
+        session.stop(STOP_TIMEOUT)
+
+    def stop_all(self, timeout=STOP_TIMEOUT):
+        """Stops all the sessions"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.stop(timeout)
+
+    def _end(self, session):
+        with self._lock:
+            if self._sessions.get(session.cam_link) is session:
+                del self._sessions[session.cam_link]
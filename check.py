@@ -11,10 +11,10 @@ Running the application needs two arguments. The address for the server and port
 For example, connecting to the localhost server on port 2000:
 python3 check.py 127.0.0.1 2000
 
-By default, the application asks the server to send all alarms since the last time the program was run. Alarms request
-is also limited to the 50 most recent available since the previous run. This behavior can be changed by giving an
-optional argument --within <minutes>, where <minutes> is the number of minutes from the current time backward, we
-request the server to send alarms.
+By default, the application asks the server to send all alarms since the last time the program was run for the same
+server. The times are kept in netspot_cursors.json. Alarms request is also limited to the 50 most recent available since
+the previous run. This behavior can be changed by giving an optional argument --within <minutes>, where <minutes> is
+the number of minutes from the current time backward, we request the server to send alarms.
 
 The program exits with code 1 if alarms are available, with 0 if not, and 2 on errors.
 """
@@ -25,25 +25,12 @@ from argparse import ArgumentParser
 
 import requests
 
-DEFAULT_DEVICE_NAME = "Example Smart Device"
-
-
-def get_last_time():
-    """Reads last_time.txt and returns timestamp from there or 0 for known errors"""
-    try:
-        file = open("last_time.txt")
-        timestamp = int(file.readline().rstrip())
-        file.close()
-        return timestamp
-    except (FileNotFoundError, ValueError):
-        return 0
+from netspot import CursorStore
 
+DEFAULT_DEVICE_NAME = "Example Smart Device"
 
-def set_last_time():
-    """Writes the current timestamp to the last_time.txt file"""
-    file = open("last_time.txt", "w")
-    file.write(str(time.time_ns()))
-    file.close()
+# Alarm cursors of the Netspot services
+netspot_cursors = CursorStore()
 
 
 def netspot_alarm_check(address, port, minutes=None):
@@ -71,25 +58,30 @@ def netspot_alarm_check(address, port, minutes=None):
         If request fails. The message is str containing reason for the failure.
     """
 
-    # Get or make timestamp for alarms request
-    if minutes is None:
-        timestamp = get_last_time()
-    else:
-        timestamp = time.time_ns() - int(minutes * 6e10)
+    with netspot_cursors.lock(address, port):
+        started = time.time_ns()
 
-    # Making the request
-    url = f"http://{address}:{port}/v1/netspots/alarms"
-    params = {"time": timestamp, "last": 50}
-    try:
-        reply = requests.get(url, params)
-    except requests.RequestException as e:
-        return False, str(e)
+        # Get or make timestamp for alarms request
+        if minutes is None:
+            timestamp = netspot_cursors.get(address, port)
+        else:
+            timestamp = started - int(minutes * 6e10)
+
+        # Making the request
+        url = f"http://{address}:{port}/v1/netspots/alarms"
+        params = {"time": timestamp, "last": 50}
+        try:
+            reply = requests.get(url, params)
+        except requests.RequestException as e:
+            return False, str(e)
+
+        if reply.status_code == 200:
+            # Request was okay. The next request asks for the alarms since
+            # this one was sent.
+            netspot_cursors.advance(address, port, started)
 
     # Checking the reply
     if reply.status_code == 200:
-        # Request was okay, save current time to be used with next request
-        set_last_time()
-
         # Handling messages
         messages = reply.json()
         if len(messages) == 0:
@@ -148,9 +140,12 @@ def main():
     )
     args = parser.parse_args()
 
-    (success, message) = netspot_alarm_check(
-        args.address, args.port, args.minutes
-    )
+    try:
+        (success, message) = netspot_alarm_check(
+            args.address, args.port, args.minutes
+        )
+    finally:
+        netspot_cursors.close()
 
     if success:
         if message is None:
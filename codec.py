@@ -0,0 +1,91 @@
+"""
+JSON Codec
+
+The DHT messages and the backend responses are decoded, and the result
+messages encoded, with orjson when it is installed and with the json module
+otherwise. orjson is several times faster on the typical analytics messages,
+benchmark_codec.py compares the codecs.
+
+Both codecs write compact JSON without spaces.
+
+Needs the optional orjson dependency for the fast codec.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec:
+    """Codec using the json module"""
+
+    name = "json"
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"))
+
+
+class OrjsonCodec:
+    """Codec using orjson"""
+
+    name = "orjson"
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            # E.g. an int larger than 64 bits
+            return JsonCodec.dumps(obj)
+
+
+class Encoded(str):
+    """JSON text that dumps() returns as it is"""
+
+
+CODECS = {JsonCodec.name: JsonCodec}
+if orjson is not None:
+    CODECS[OrjsonCodec.name] = OrjsonCodec
+
+# Codec used by loads() and dumps()
+codec = OrjsonCodec if orjson is not None else JsonCodec
+
+
+def use(name):
+    """
+    Selects the codec used by loads() and dumps()
+
+    Parameters
+    ----------
+    name : str
+        "json", "orjson" or "auto" for the fastest available codec.
+    """
+    global codec
+    if name == "auto":
+        name = OrjsonCodec.name if orjson is not None else JsonCodec.name
+    if name not in CODECS:
+        raise ValueError(f"JSON codec {name!r} is not available")
+    codec = CODECS[name]
+
+
+def loads(data):
+    """Decodes the JSON str or bytes *data*"""
+    return codec.loads(data)
+
+
+def dumps(obj):
+    """Encodes *obj* as a JSON str, Encoded text is returned as it is"""
+    if isinstance(obj, Encoded):
+        return obj
+    return codec.dumps(obj)
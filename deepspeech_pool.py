@@ -0,0 +1,225 @@
+"""
+DeepSpeech Worker Pool
+
+The DeepSpeech method of speech recognition used to start a new
+privacy_preserving_speech_recognition container for every request and remove
+it afterwards. Starting the container cost several seconds per utterance, and
+because the container always had the same name, two requests at the same time
+collided.
+
+The pool starts its containers once and keeps them running. Each container
+runs one long-lived deepspeech_worker process, which loads the model with the
+first request and reads the requests from a pipe, so the following requests
+pay neither for a new interpreter nor for loading the model. Every container
+has its own name, and a container is used by one request at a time.
+"""
+import json
+import os
+import queue
+import select
+import subprocess
+import threading
+import time
+
+import logs
+from backends import DEFAULT_READ_TIMEOUT
+
+IMAGE = "privacy_preserving_speech_recognition"
+DEFAULT_POOL_SIZE = 1
+
+# Run in the containers with python -c
+WORKER_PATH = os.path.join(os.path.dirname(__file__), "deepspeech_worker.py")
+
+log = logs.get_logger("deepspeech")
+
+
+class Worker:
+    """
+    deepspeech_worker process in a container
+
+    The process is started with the first request and again after it has
+    failed.
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.process = None
+
+    def command(self):
+        with open(WORKER_PATH) as file:
+            source = file.read()
+        return (
+            "docker",
+            "exec",
+            "-i",
+            self.container,
+            "python",
+            "-u",
+            "-c",
+            source,
+        )
+
+    def recognize(self, audio, timeout):
+        """
+        Returns the reply of the worker for the *audio* file
+
+        Raises OSError or ValueError when the worker fails, and TimeoutError
+        when it does not reply in *timeout* seconds. The process is stopped
+        then.
+        """
+        try:
+            if self.process is None or self.process.poll() is not None:
+                self.process = subprocess.Popen(
+                    self.command(),
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                )
+            request = json.dumps({"audio": audio}) + "\n"
+            self.process.stdin.write(request.encode())
+            self.process.stdin.flush()
+            line = self._read_line(timeout)
+            if not line:
+                raise OSError("DeepSpeech worker exited")
+            return json.loads(line)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        process, self.process = self.process, None
+        if process is None:
+            return
+        process.kill()
+        process.wait()
+        for pipe in (process.stdin, process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def _read_line(self, timeout):
+        deadline = time.monotonic() + timeout
+        stdout = self.process.stdout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"No reply in {timeout} s")
+            readable, _, _ = select.select([stdout], [], [], remaining)
+            if readable:
+                return stdout.readline()
+
+
+class DeepSpeechPool:
+    """
+    Warm privacy_preserving_speech_recognition containers
+
+    Parameters
+    ----------
+    size : int
+        Number of containers.
+    image : str
+        Docker image of the containers.
+    timeout : float
+        Seconds a recognition may take.
+    """
+
+    def __init__(
+        self, size=DEFAULT_POOL_SIZE, image=IMAGE, timeout=DEFAULT_READ_TIMEOUT
+    ):
+        self.size = size
+        self.image = image
+        self.timeout = timeout
+        self._idle = queue.Queue()
+        self._containers = []
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def container_name(self, index):
+        return f"{self.image}_{index}"
+
+    def start(self):
+        """Starts the containers unless they are already running"""
+        with self._lock:
+            if self._containers:
+                return
+            for index in range(self.size):
+                name = self.container_name(index)
+                # Remove a container left behind by an earlier run
+                self._docker("rm", "-f", name)
+                self._docker(
+                    "run",
+                    "-d",
+                    "-v",
+                    "/var/run/docker.sock:/var/run/docker.sock",
+                    "-u",
+                    "root",
+                    "--net=host",
+                    "--name",
+                    name,
+                    "--entrypoint",
+                    "sleep",
+                    self.image,
+                    "infinity",
+                    check=True,
+                )
+                worker = Worker(name)
+                self._containers.append(name)
+                self._workers.append(worker)
+                self._idle.put(worker)
+
+    def stop(self):
+        """Removes the containers"""
+        with self._lock:
+            containers, self._containers = self._containers, []
+            workers, self._workers = self._workers, []
+            self._idle = queue.Queue()
+        for worker in workers:
+            worker.close()
+        for name in containers:
+            self._docker("rm", "-f", name)
+
+    def recognize(self, audio):
+        """
+        Runs the recognition for the *audio* file in an idle container
+
+        Waits for a container when all of them are busy.
+
+        Returns
+        -------
+        bytes or None
+            Output of the recognition or None if it failed.
+        """
+        try:
+            self.start()
+        except (OSError, subprocess.SubprocessError) as e:
+            log.error("Could not start DeepSpeech containers: %s", e)
+            return None
+
+        worker = self._idle.get()
+        try:
+            reply = worker.recognize(audio, self.timeout)
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            log.warning("Request failed: %s", e)
+            return None
+        finally:
+            self._idle.put(worker)
+
+        if reply.get("returncode") != 0:
+            log.warning(
+                "Request failed with %s.",
+                reply.get("returncode"),
+                extra=logs.fields(stderr=logs.payload(reply.get("stderr"))),
+            )
+            return None
+        return reply.get("stdout", "").encode()
+
+    @staticmethod
+    def _docker(*args, check=False, timeout=None):
+        return subprocess.run(
+            ("docker",) + args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=check,
+            timeout=timeout,
+        )
@@ -0,0 +1,91 @@
+"""
+DeepSpeech Worker
+
+Runs in a privacy_preserving_speech_recognition container, started by
+DeepSpeechPool with docker exec. The recognition module of the image is run
+in this one interpreter for every request, and deepspeech.Model is wrapped
+so that a model file is loaded only by the first request.
+
+Each request is one JSON line on stdin, {"audio": <file>}, and each reply
+one JSON line on stdout, {"returncode": int, "stdout": str, "stderr": str},
+with the exit code and output of the recognition. Output written straight
+to the stdout file descriptor goes to stderr, so it can not break the
+replies.
+
+Runs on the Python of the image, so this file only uses the standard library
+and no newer syntax.
+"""
+import contextlib
+import io
+import json
+import os
+import runpy
+import sys
+import traceback
+
+MODULE = "recognize_wavFile_Func"
+
+
+def cache_models():
+    """Makes deepspeech.Model load each model only once"""
+    try:
+        import deepspeech
+    except ImportError:
+        return
+    load = deepspeech.Model
+    models = {}
+
+    def model(*args):
+        if args not in models:
+            models[args] = load(*args)
+        return models[args]
+
+    deepspeech.Model = model
+
+
+def recognize(audio):
+    """Runs the recognition module for *audio* and returns the reply"""
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    returncode = 0
+    sys.argv = [MODULE, "--audio", audio]
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(
+            stderr
+        ):
+            try:
+                runpy.run_module(MODULE, run_name="__main__")
+            except SystemExit as e:
+                if e.code is None:
+                    returncode = 0
+                elif isinstance(e.code, int):
+                    returncode = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    returncode = 1
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+    finally:
+        sys.argv = [sys.argv[0]]
+    return {
+        "returncode": returncode,
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+    }
+
+
+def main():
+    replies = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+    cache_models()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        replies.write(json.dumps(recognize(request["audio"])) + "\n")
+        replies.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+Device Anomaly Batching
+
+Each SIFIS:Privacy_Aware_Device_Anomaly_Detection message used to be one
+GET request with the temperatures joined in the URL path, so long series
+made very long URLs and every short series paid for a request of its own.
+
+BatchHandler collects the messages for a short window and posts them to the
+temperature_batch endpoint of the device anomaly backend as one JSON body:
+
+    {
+        "dtype": "<f4",
+        "temperatures": "<base64 of all the series, one after the other>",
+        "requests": [
+            {"requestor_id": ..., "requestor_type": ..., "request_id": ...,
+             "length": <number of temperatures of the request>},
+            ...
+        ]
+    }
+
+The backend responds with {"results": [<results message>, ...]} and the
+results are published for the requests with the same request_id. Once the
+backend answers that it has no batch endpoint, the messages go one at a time
+to the fallback handler.
+
+Needs the optional numpy dependency for the fastest packing.
+"""
+import array
+import base64
+import itertools
+import sys
+import threading
+
+import requests
+
+import codec
+import logs
+from backends import MissingEndpoint
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Seconds the first message of a batch waits for others
+DEFAULT_WINDOW = 0.05
+
+# Messages sent in one request at most
+DEFAULT_MAX_BATCH = 64
+
+BATCH_PATH = "temperature_batch"
+TOPIC = "SIFIS:Privacy_Aware_Device_Anomaly_Detection"
+
+# Little-endian float32
+DTYPE = "<f4"
+
+log = logs.get_logger("device_anomaly")
+
+
+def pack_series(series):
+    """
+    Packs the temperature series into one array
+
+    Parameters
+    ----------
+    series : list of list of float
+        Temperatures of each request.
+
+    Returns
+    -------
+    (str, list of int)
+        Base64 of the series as DTYPE values, one after the other, and the
+        number of values in each series.
+    """
+    lengths = [len(values) for values in series]
+    values = itertools.chain.from_iterable(series)
+    if numpy is not None:
+        data = numpy.fromiter(values, dtype=DTYPE, count=sum(lengths))
+    else:
+        data = array.array("f", values)
+        if sys.byteorder == "big":
+            data.byteswap()
+    return base64.b64encode(data.tobytes()).decode("ascii"), lengths
+
+
+def unpack_series(text, lengths):
+    """Returns the series packed by pack_series() as lists of float"""
+    data = array.array("f", base64.b64decode(text))
+    if sys.byteorder == "big":
+        data.byteswap()
+    series = []
+    offset = 0
+    for length in lengths:
+        series.append(data[offset : offset + length].tolist())
+        offset += length
+    return series
+
+
+def batch_body(values, series):
+    """Returns the JSON body for the messages *values* and their *series*"""
+    temperatures, lengths = pack_series(series)
+    return {
+        "dtype": DTYPE,
+        "temperatures": temperatures,
+        "requests": [
+            {
+                "requestor_id": value.get("requestor_id"),
+                "requestor_type": value.get("requestor_type"),
+                "request_id": value.get("request_id"),
+                "length": length,
+            }
+            for value, length in zip(values, lengths)
+        ],
+    }
+
+
+def split_results(results):
+    """Returns the results messages by their str request_id"""
+    messages = {}
+    for message in results:
+        try:
+            request_id = message["RequestPostTopicUUID"]["value"]["request_id"]
+        except (KeyError, TypeError):
+            log.warning("Result without request_id: %s", logs.payload(message))
+            continue
+        messages[str(request_id)] = message
+    return messages
+
+
+class BatchHandler:
+    """
+    Topic handler sending the device anomaly requests in batches
+
+    The handler returns once the message is added to a batch. A batch is
+    sent when it has *max_batch* messages, or *window* seconds after its
+    first message, from a timer thread.
+
+    Parameters
+    ----------
+    backend : Backend
+        Device anomaly backend.
+    fallback : callable
+        Handler for one message, used when the backend has no batch
+        endpoint.
+    window : float
+        Seconds to wait for more messages.
+    max_batch : int
+        Messages in a batch at most.
+    """
+
+    def __init__(
+        self,
+        backend,
+        fallback,
+        window=DEFAULT_WINDOW,
+        max_batch=DEFAULT_MAX_BATCH,
+    ):
+        self.backend = backend
+        self.fallback = fallback
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._batch = []
+        self._timer = None
+
+    def __call__(self, ws, value):
+        if not self.backend.has_endpoint(BATCH_PATH):
+            self.fallback(ws, value)
+            return
+        try:
+            series = [float(t) for t in value["Temperatures"]]
+        except (KeyError, TypeError, ValueError) as e:
+            log.warning(
+                "Invalid temperatures: %s",
+                e,
+                extra=logs.request_fields(value, TOPIC),
+            )
+            return
+        batch = None
+        with self._lock:
+            self._batch.append((ws, value, series))
+            if len(self._batch) >= self.max_batch:
+                batch = self._take()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self.send(batch)
+
+    def flush(self):
+        """Sends the collected messages now"""
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self.send(batch)
+
+    def _take(self):
+        batch, self._batch = self._batch, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def send(self, batch):
+        """
+        Sends the (ws, value, series) *batch* and publishes the results
+
+        Runs on the timer thread too, so the errors of each request are
+        logged here.
+        """
+        values = [value for _, value, _ in batch]
+        body = codec.dumps(batch_body(values, [s for _, _, s in batch]))
+        try:
+            response = self.backend.post(
+                self.backend.url(BATCH_PATH),
+                data=body,
+                headers={"Content-Type": "application/json"},
+            )
+            self.backend.check_endpoint(BATCH_PATH, response.status_code)
+        except requests.RequestException as e:
+            for value in values:
+                log.warning(
+                    "Request failed: %s",
+                    e,
+                    extra=logs.request_fields(value, TOPIC),
+                )
+            return
+        except MissingEndpoint:
+            for ws, value, _ in batch:
+                try:
+                    self.fallback(ws, value)
+                except Exception:
+                    log.exception(
+                        "Request failed",
+                        extra=logs.request_fields(value, TOPIC),
+                    )
+            return
+        if response.status_code != 200:
+            for value in values:
+                log.warning(
+                    "Request failed with %s.",
+                    response.status_code,
+                    extra=logs.request_fields(value, TOPIC),
+                )
+            return
+        try:
+            results = split_results(codec.loads(response.content)["results"])
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning("Invalid batch response: %s", e)
+            return
+        for ws, value, _ in batch:
+            message = results.get(str(value.get("request_id")))
+            if message is None:
+                log.warning(
+                    "No result in the batch",
+                    extra=logs.request_fields(value, TOPIC),
+                )
+                continue
+            log.info(
+                "Request succeeded.", extra=logs.request_fields(value, TOPIC)
+            )
+            try:
+                ws.send(codec.dumps(message))
+            except Exception:
+                log.exception(
+                    "Sending the result failed",
+                    extra=logs.request_fields(value, TOPIC),
+                )
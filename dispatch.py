@@ -0,0 +1,293 @@
+"""
+Worker Pool Dispatch
+
+The WebSocket client calls ``on_message`` from its own thread. When the
+analytics ran inside that callback, a long Whisper transcription or a
+DeepSpeech container start stalled every other topic, Netspot alarm checks
+included. The Dispatcher moves the handlers onto a bounded thread pool so the
+callback only has to parse and enqueue the message.
+
+Each topic has its own concurrency limit. Messages above the limit wait in a
+per-topic queue without occupying a worker thread, so a burst on one topic
+cannot take the whole pool.
+
+When a worker becomes free it takes the oldest waiting message of the topic
+with the highest priority, so Netspot alarms and AUD Manager requests go
+ahead of video analytics. The number of waiting messages can be bounded and
+messages can be given a deadline. Messages over the bound or waiting past
+the deadline are shed: they are not handled, and the on_reject callback can
+tell the requestor.
+"""
+import itertools
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import logs
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_TOPIC_LIMIT = 2
+
+# Limits differing from DEFAULT_TOPIC_LIMIT, by topic name
+TOPIC_LIMITS = {}
+
+# Waiting messages of the topic with the lowest priority value run first
+DEFAULT_PRIORITY = 1
+
+# Priorities differing from DEFAULT_PRIORITY, by topic name
+TOPIC_PRIORITIES = {
+    "SIFIS:Publish_Alarms_Request": 0,
+    "SIFIS:AUD_Manager_Request": 0,
+    "SIFIS:Privacy_Aware_Object_Recognition": 2,
+    "SIFIS:Privacy_Aware_Face_Recognition_CAM": 2,
+}
+
+# Reasons given to on_reject
+QUEUE_FULL = "queue full"
+DEADLINE = "deadline"
+
+log = logs.get_logger("dispatch")
+
+
+class LockedSender:
+    """
+    WebSocket wrapper serializing send() calls from the worker threads
+
+    Everything except send() is passed to the wrapped object.
+    """
+
+    def __init__(self, ws, lock):
+        self._ws = ws
+        self._lock = lock
+
+    def send(self, *args, **kwargs):
+        with self._lock:
+            return self._ws.send(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._ws, name)
+
+
+class _Task(NamedTuple):
+    handler: object
+    args: tuple
+    received: float
+    number: int
+
+
+class Dispatcher:
+    """
+    Runs topic handlers on a bounded pool of worker threads
+
+    Parameters
+    ----------
+    max_workers : int
+        Number of worker threads shared by all topics.
+    topic_limits : dict or None
+        Maximum number of handlers running at the same time per topic name.
+        Uses TOPIC_LIMITS when None.
+    default_limit : int
+        Limit for the topics not listed in *topic_limits*.
+    priorities : dict or None
+        Priority per topic name, lower values run first. Uses
+        TOPIC_PRIORITIES when None.
+    default_priority : int
+        Priority of the topics not listed in *priorities*.
+    max_pending : int or None
+        Maximum number of waiting messages of all topics. When reached, the
+        newest message of the lowest priority is shed, or the new message if
+        none has a lower priority. Not bounded when None.
+    deadline : float or None
+        Messages waiting longer than this many seconds are shed.
+    on_reject : callable or None
+        Called as on_reject(topic, reason, ws, *args) for each shed message,
+        with the reason QUEUE_FULL or DEADLINE.
+    """
+
+    def __init__(
+        self,
+        max_workers=DEFAULT_MAX_WORKERS,
+        topic_limits=None,
+        default_limit=DEFAULT_TOPIC_LIMIT,
+        priorities=None,
+        default_priority=DEFAULT_PRIORITY,
+        max_pending=None,
+        deadline=None,
+        on_reject=None,
+    ):
+        if topic_limits is None:
+            topic_limits = TOPIC_LIMITS
+        if priorities is None:
+            priorities = TOPIC_PRIORITIES
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="analytics"
+        )
+        self._max_workers = max_workers
+        self._topic_limits = dict(topic_limits)
+        self._default_limit = default_limit
+        self._priorities = dict(priorities)
+        self._default_priority = default_priority
+        self.max_pending = max_pending
+        self.deadline = deadline
+        self.on_reject = on_reject
+        # Shed messages by (topic, reason)
+        self.rejected = Counter()
+        self._numbers = itertools.count()
+        self._active = 0
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._closed = False
+        self._send_lock = threading.Lock()
+        self._running = Counter()
+        self._pending = defaultdict(deque)
+
+    def limit(self, topic):
+        """Returns the concurrency limit for the *topic*"""
+        return max(1, self._topic_limits.get(topic, self._default_limit))
+
+    def priority(self, topic):
+        """Returns the priority of the *topic*, lower values run first"""
+        return self._priorities.get(topic, self._default_priority)
+
+    def running(self, topic):
+        """Returns the number of handlers running for the *topic*"""
+        with self._lock:
+            return self._running[topic]
+
+    def pending(self, topic):
+        """Returns the number of messages waiting for a slot on the *topic*"""
+        with self._lock:
+            return len(self._pending[topic])
+
+    def queued(self):
+        """Returns the number of waiting messages of all topics"""
+        with self._lock:
+            return self._queued
+
+    def submit(self, topic, handler, ws, *args):
+        """
+        Queue *handler* to be called as handler(ws, *args)
+
+        The handler receives *ws* wrapped in a LockedSender so results from
+        different workers are sent one at a time.
+        """
+        task = _Task(
+            handler,
+            (LockedSender(ws, self._send_lock),) + args,
+            time.monotonic(),
+            next(self._numbers),
+        )
+        shed = []
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Dispatcher has been shut down")
+            self._shed_expired(task.received, shed)
+            if self._active < self._max_workers and self._running[
+                topic
+            ] < self.limit(topic):
+                self._start(topic)
+            else:
+                self._enqueue(topic, task, shed)
+                task = None
+        self._reject(shed)
+        if task is not None:
+            self._executor.submit(self._run, topic, task)
+
+    def shutdown(self, wait=True):
+        """
+        Stops accepting new messages
+
+        With *wait* the call returns after the queued messages have been
+        handled. Otherwise the queued messages are dropped.
+        """
+        with self._lock:
+            self._closed = True
+            if wait:
+                self._idle.wait_for(lambda: not self._active)
+            else:
+                self._pending.clear()
+                self._queued = 0
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, topic, task):
+        try:
+            task.handler(*task.args)
+        except Exception:
+            log.exception("Handler failed", extra=logs.fields(topic=topic))
+        finally:
+            self._next(topic)
+
+    def _next(self, topic):
+        shed = []
+        with self._lock:
+            self._running[topic] -= 1
+            self._active -= 1
+            self._shed_expired(time.monotonic(), shed)
+            topic, task = self._pop()
+            if task is None:
+                self._idle.notify_all()
+            else:
+                self._start(topic)
+        self._reject(shed)
+        if task is not None:
+            self._executor.submit(self._run, topic, task)
+
+    def _start(self, topic):
+        self._running[topic] += 1
+        self._active += 1
+
+    def _enqueue(self, topic, task, shed):
+        if self.max_pending is not None and self._queued >= self.max_pending:
+            victim = self._lowest_priority()
+            if victim is None or self.priority(victim) <= self.priority(topic):
+                shed.append((topic, QUEUE_FULL, task))
+                return
+            shed.append((victim, QUEUE_FULL, self._pending[victim].pop()))
+            self._queued -= 1
+        self._pending[topic].append(task)
+        self._queued += 1
+
+    def _lowest_priority(self):
+        """Returns the waiting topic with the lowest priority or None"""
+        topics = [topic for topic, tasks in self._pending.items() if tasks]
+        if not topics:
+            return None
+        return max(topics, key=self.priority)
+
+    def _pop(self):
+        """Returns the next (topic, task) to run, or (None, None)"""
+        best = None
+        for topic, tasks in self._pending.items():
+            if tasks and self._running[topic] < self.limit(topic):
+                key = (self.priority(topic), tasks[0].number)
+                if best is None or key < best[0]:
+                    best = (key, topic)
+        if best is None:
+            return None, None
+        topic = best[1]
+        self._queued -= 1
+        return topic, self._pending[topic].popleft()
+
+    def _shed_expired(self, now, shed):
+        if self.deadline is None:
+            return
+        for topic, tasks in self._pending.items():
+            while tasks and now - tasks[0].received > self.deadline:
+                shed.append((topic, DEADLINE, tasks.popleft()))
+                self._queued -= 1
+
+    def _reject(self, shed):
+        for topic, reason, task in shed:
+            self.rejected[topic, reason] += 1
+            if self.on_reject is None:
+                continue
+            try:
+                self.on_reject(topic, reason, *task.args)
+            except Exception:
+                log.exception(
+                    "Rejecting a request failed",
+                    extra=logs.fields(topic=topic),
+                )
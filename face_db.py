@@ -0,0 +1,250 @@
+"""
+Face Database Index
+
+The face recognition requests name a directory of known faces,
+database_path, and the backend scanned the directory and computed the
+embeddings of the faces again for every request.
+
+FaceDatabaseIndex keeps a manifest of each database: the size, modification
+time and SHA-256 of its files. The requests carry the database version, a
+hash of the manifest, in the database_version form field, so the backend
+can keep the embeddings of a version and reuse them until the version
+changes. Only the files whose size or modification time changed are hashed
+again, and a database is checked at most every check_interval seconds.
+
+The requests never wait for the indexing: a database is indexed on a
+background thread and the requests carry its last known version, or no
+version before the first indexing has finished.
+"""
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from typing import NamedTuple
+
+import logs
+
+DEFAULT_CHECK_INTERVAL = 2.0
+
+# Bytes read from a file at a time when hashing it
+HASH_CHUNK_SIZE = 1024 * 1024
+
+log = logs.get_logger("face_db")
+
+
+class Manifest(NamedTuple):
+    """Indexed database"""
+
+    version: str
+    # Relative path -> (size, modification time in ns, SHA-256)
+    files: dict
+    checked: float
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan(directory, previous=None):
+    """
+    Returns the files of *directory* for a Manifest
+
+    The digests of the files with the same size and modification time as
+    in the *previous* files are reused. Files that can not be read, e.g.
+    dangling symlinks or files removed during the scan, are left out.
+    """
+    previous = previous or {}
+    files = {}
+    for parent, directories, names in os.walk(directory):
+        directories.sort()
+        for name in sorted(names):
+            path = os.path.join(parent, name)
+            relative = os.path.relpath(path, directory)
+            try:
+                status = os.stat(path)
+                stamp = (status.st_size, status.st_mtime_ns)
+                old = previous.get(relative)
+                if old is not None and old[:2] == stamp:
+                    files[relative] = old
+                else:
+                    files[relative] = stamp + (_sha256(path),)
+            except OSError as e:
+                log.debug("Skipping %s: %s", path, e)
+    return files
+
+
+def manifest_version(files):
+    """Returns the version ID of the database with the *files*"""
+    text = json.dumps(
+        sorted((name, item[2]) for name, item in files.items()),
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+class FaceDatabaseIndex:
+    """
+    Versions of the face databases
+
+    version() only reads the index, so the request builders can call it on
+    the event loop of the asyncio gateway. The databases are indexed on a
+    background thread.
+
+    The database paths come from the requests, so only the directories
+    under *root* and the ones given to allow() or warm() are indexed.
+
+    Parameters
+    ----------
+    root : str or None
+        Directory of the relative database paths.
+    check_interval : float
+        Seconds a version is used before the database is checked again.
+    """
+
+    def __init__(self, root=None, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.root = root
+        self.check_interval = check_interval
+        self._allowed = set()
+        self._manifests = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def allow(self, paths):
+        """Allows indexing the databases in *paths* outside root"""
+        with self._lock:
+            self._allowed.update(
+                os.path.realpath(os.path.join(self.root or "", path))
+                for path in paths
+            )
+
+    def resolve(self, path):
+        """
+        Returns the local directory of the database *path*
+
+        Returns None when the directory, with the symlinks and ".." of
+        *path* resolved, is neither under root nor allowed.
+        """
+        if self.root is not None:
+            path = os.path.join(self.root, path)
+        directory = os.path.realpath(path)
+        with self._lock:
+            if directory in self._allowed:
+                return directory
+        if self.root is None:
+            return None
+        root = os.path.realpath(self.root)
+        if os.path.commonpath([root, directory]) != root:
+            return None
+        return directory
+
+    def version(self, path):
+        """
+        Returns the indexed version ID of the database in *path*
+
+        A database not indexed yet, or checked more than check_interval
+        seconds ago, is queued for indexing and the last version is
+        returned. Returns None until the database has been indexed, when
+        *path* is not a directory on this host, e.g. when it is a path
+        inside the backend container, and when it is not allowed.
+        """
+        directory = self.resolve(path)
+        if directory is None:
+            return None
+        with self._lock:
+            manifest = self._manifests.get(directory)
+            if not self._fresh(manifest) and directory not in self._pending:
+                self._pending.add(directory)
+                self._queue.put(directory)
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._index_queued, name="face_db", daemon=True
+                    )
+                    self._thread.start()
+        return manifest.version if manifest is not None else None
+
+    def refresh(self, path):
+        """Indexes the database in *path* now and returns its version ID"""
+        directory = self.resolve(path)
+        if directory is None:
+            return None
+        return self._refresh(directory)
+
+    def warm(self, paths):
+        """Allows and indexes the databases in *paths* before the requests"""
+        self.allow(paths)
+        for path in paths:
+            started = time.perf_counter()
+            version = self.refresh(path)
+            if version is None:
+                log.warning("Face database %s not found", path)
+                continue
+            log.info(
+                "Indexed face database %s in %.3f s",
+                path,
+                time.perf_counter() - started,
+            )
+
+    def join(self):
+        """Waits until the queued databases are indexed"""
+        self._queue.join()
+
+    def _refresh(self, directory):
+        with self._lock:
+            lock = self._locks.setdefault(directory, threading.Lock())
+        with lock:
+            # Another thread may have indexed the database meanwhile
+            with self._lock:
+                manifest = self._manifests.get(directory)
+            if self._fresh(manifest):
+                return manifest.version
+            version, files = None, {}
+            if os.path.isdir(directory):
+                try:
+                    files = scan(
+                        directory, manifest.files if manifest else None
+                    )
+                except OSError as e:
+                    log.warning("Indexing %s failed: %s", directory, e)
+                else:
+                    version = manifest_version(files)
+            if version is not None and (
+                manifest is None or manifest.version != version
+            ):
+                log.info(
+                    "Face database %s has version %s (%d files)",
+                    directory,
+                    version,
+                    len(files),
+                )
+            with self._lock:
+                self._manifests[directory] = Manifest(
+                    version, files, time.monotonic()
+                )
+            return version
+
+    def _index_queued(self):
+        while True:
+            directory = self._queue.get()
+            try:
+                self._refresh(directory)
+            except Exception:
+                log.exception("Indexing %s failed", directory)
+            finally:
+                with self._lock:
+                    self._pending.discard(directory)
+                self._queue.task_done()
+
+    def _fresh(self, manifest):
+        return (
+            manifest is not None
+            and time.monotonic() - manifest.checked < self.check_interval
+        )
@@ -0,0 +1,252 @@
+"""
+Logging
+
+The analytics used to print every received message, each of its fields and
+the whole backend output. With base64 payloads or large detection results the
+printing took most of the CPU time, and it blocked the handlers when the
+reader of stdout, often a Docker log pipe, was slow.
+
+The records now go to the "analytics_api" logger. setup() gives it a handler
+that only puts the records on a bounded queue, and a background thread
+writes them, as text or JSON lines. When the queue is full the record is
+dropped and counted instead of waiting. Informational records of busy topics
+can be sampled, and payloads are truncated or left out altogether.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from collections import Counter
+
+ROOT = "analytics_api"
+DEFAULT_LEVEL = "INFO"
+DEFAULT_FORMAT = "text"
+DEFAULT_QUEUE_SIZE = 10000
+
+# Characters of a payload in a record
+DEFAULT_MAX_PAYLOAD = 256
+
+# Settings of payload(), changed by setup()
+echo_payloads = True
+max_payload = DEFAULT_MAX_PAYLOAD
+
+log = logging.getLogger(ROOT)
+
+
+def get_logger(name):
+    """Returns the logger for a part of the analytics, e.g. "netspot" """
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def fields(**items):
+    """
+    Returns the *extra* argument adding structured fields to a record
+
+    log.info("Received request", extra=fields(topic=topic_name))
+    """
+    return {"fields": items}
+
+
+def request_fields(value, topic_name=None, payload=None, **items):
+    """Returns the *extra* argument identifying the request *value*"""
+    if not isinstance(value, dict):
+        value = {}
+    return fields(
+        topic=topic_name,
+        request_id=value.get("request_id"),
+        requestor_id=value.get("requestor_id"),
+        value=payload,
+        **items,
+    )
+
+
+class Payload:
+    """
+    Message, response or other data in a record
+
+    The data is converted and truncated only when the record is written.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        data = self.data
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            size = len(data)
+            text = bytes(data[: max_payload + 1]).decode("utf-8", "replace")
+        else:
+            text = data if isinstance(data, str) else str(data)
+            size = len(text)
+        if size > max_payload:
+            return f"{text[:max_payload]}... ({size} total)"
+        return text
+
+    __repr__ = __str__
+
+
+def payload(data):
+    """Returns *data* for a record field, or None if payload echo is off"""
+    if not echo_payloads:
+        return None
+    return Payload(data)
+
+
+class TextFormatter(logging.Formatter):
+    """Writes the fields as key=value after the message"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        items = getattr(record, "fields", None)
+        if items:
+            text += " " + " ".join(
+                f"{key}={value}"
+                for key, value in items.items()
+                if value is not None
+            )
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """Writes each record as a JSON object on one line"""
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in getattr(record, "fields", {}).items():
+            if value is not None:
+                data[key] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes one of every N records of a topic
+
+    Only records below WARNING with a topic field are sampled.
+
+    Parameters
+    ----------
+    rates : dict
+        Topic name -> N.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        topic = getattr(record, "fields", {}).get("topic")
+        rate = self.rates.get(topic, 1)
+        if rate <= 1:
+            return True
+        with self._lock:
+            count = self._counts[topic]
+            self._counts[topic] += 1
+        return count % rate == 0
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts the records on a bounded queue without waiting
+
+    The records are formatted by the thread writing them, not by the
+    thread logging them. Records not fitting on the queue are dropped.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room instead of failing on a full queue
+        self.queue.put(self._sentinel)
+
+
+_listener = None
+
+
+def setup(
+    level=DEFAULT_LEVEL,
+    log_format=DEFAULT_FORMAT,
+    sample=None,
+    max_payload_size=DEFAULT_MAX_PAYLOAD,
+    echo=True,
+    stream=None,
+    queue_size=DEFAULT_QUEUE_SIZE,
+):
+    """
+    Starts writing the records of the analytics in a background thread
+
+    Parameters
+    ----------
+    level : str
+        Lowest level written, e.g. "INFO".
+    log_format : str
+        "text" or "json".
+    sample : dict or None
+        Topic name -> N, write one of every N informational records.
+    max_payload_size : int
+        Characters of a payload in a record.
+    echo : bool
+        Write the payloads of the messages and responses.
+    stream : file or None
+        Where the records are written, stdout by default.
+    queue_size : int
+        Records waiting to be written before new ones are dropped.
+    """
+    global _listener, echo_payloads, max_payload
+    shutdown()
+    echo_payloads = echo
+    max_payload = max_payload_size
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    if log_format == "json":
+        writer.setFormatter(JsonFormatter())
+    else:
+        writer.setFormatter(TextFormatter())
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    if sample:
+        handler.addFilter(SamplingFilter(sample))
+    log.handlers = [handler]
+    log.setLevel(level)
+    log.propagate = False
+    _listener = _Listener(handler.queue, writer)
+    _listener.start()
+    return handler
+
+
+def shutdown():
+    """Writes the queued records and stops the background thread"""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
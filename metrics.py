@@ -0,0 +1,366 @@
+"""
+Metrics
+
+Counts the DHT messages and backend requests and measures their latency, so
+that a slow analytic or an overloaded backend can be found. The metrics are
+served in the Prometheus text format from a local HTTP endpoint, /metrics,
+started with serve().
+
+Handler metrics are labelled with the topic name and backend metrics with
+the backend name (see backends.BACKENDS for their ports).
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ADDRESS = "127.0.0.1"
+
+# Latency histogram bucket limits in seconds. The inference of some
+# analytics, e.g. a Whisper transcription, takes minutes.
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    """
+    Metric with a value per combination of label values
+
+    Parameters
+    ----------
+    name : str
+        Metric name.
+    documentation : str
+        HELP text.
+    labelnames : tuple of str
+        Names of the labels, given as positional values to the methods.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """Returns [(name suffix, labels dict, value)]"""
+        with self._lock:
+            items = list(self._values.items())
+        return [("", self._labels(key), value) for key, value in items]
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+    def _add(self, labels, amount):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._add(labels, amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        self._add(labels, amount)
+
+    def dec(self, *labels, amount=1):
+        self._add(labels, -amount)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+
+class CallbackGauge(Metric):
+    """
+    Gauge read from *callback* when collected
+
+    The callback returns a dict of label value tuples to values.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames, callback):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self):
+        return [
+            ("", self._labels(key), value)
+            for key, value in self.callback().items()
+            if value is not None
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # Count per bucket, the last one for +Inf, and the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1)
+                counts.append(0.0)
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            return sum(counts[:-1]) if counts else 0
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - started)
+
+    def samples(self):
+        with self._lock:
+            items = [
+                (key, list(counts)) for key, counts in self._values.items()
+            ]
+        samples = []
+        for key, counts in items:
+            labels = self._labels(key)
+            total = 0
+            for limit, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                bucket = dict(labels, le=_format_value(limit))
+                samples.append(("_bucket", bucket, total))
+            samples.append(("_count", labels, total))
+            samples.append(("_sum", labels, counts[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """Returns the metrics in the Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(
+                    f"{metric.name}{suffix}{_format_labels(labels)} "
+                    f"{_format_value(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    items = ",".join(
+        f'{name}="{_escape(str(value))}"' for name, value in labels.items()
+    )
+    return "{" + items + "}"
+
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+REGISTRY = Registry()
+
+messages = REGISTRY.register(
+    Counter(
+        "analytics_messages_total",
+        "DHT messages received for a handler",
+        ("topic",),
+    )
+)
+dropped = REGISTRY.register(
+    Counter(
+        "analytics_dropped_messages_total",
+        "DHT messages without a handler or on a disabled topic",
+        ("topic",),
+    )
+)
+shed = REGISTRY.register(
+    Counter(
+        "analytics_shed_messages_total",
+        "DHT messages rejected by the worker pool when overloaded",
+        ("topic", "reason"),
+    )
+)
+errors = REGISTRY.register(
+    Counter(
+        "analytics_handler_errors_total",
+        "Handlers ended by an exception",
+        ("topic",),
+    )
+)
+in_flight = REGISTRY.register(
+    Gauge("analytics_handlers_in_flight", "Running handlers", ("topic",))
+)
+handler_seconds = REGISTRY.register(
+    Histogram(
+        "analytics_handler_seconds",
+        "Time from starting a handler to its end",
+        ("topic",),
+    )
+)
+backend_requests = REGISTRY.register(
+    Counter(
+        "analytics_backend_requests_total",
+        "Backend requests by response status, error for no response",
+        ("backend", "status"),
+    )
+)
+backend_seconds = REGISTRY.register(
+    Histogram(
+        "analytics_backend_request_seconds",
+        "Time from sending a backend request to its response",
+        ("backend",),
+    )
+)
+cache_events = REGISTRY.register(
+    Counter(
+        "analytics_cache_events_total",
+        "Result cache hits, misses, expirations, evictions and file errors",
+        ("cache", "event"),
+    )
+)
+uploaded_bytes = REGISTRY.register(
+    Counter(
+        "analytics_uploaded_bytes_total",
+        "Bytes uploaded to the backends",
+        ("backend",),
+    )
+)
+
+
+@contextmanager
+def handling(topic_name):
+    """Measures a handler of *topic_name* run in the with block"""
+    in_flight.inc(topic_name)
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        errors.inc(topic_name)
+        raise
+    finally:
+        handler_seconds.observe(
+            topic_name, value=time.perf_counter() - started
+        )
+        in_flight.dec(topic_name)
+
+
+def backend_request(backend, status, seconds):
+    """Counts a backend request with the response *status* or "error" """
+    backend_requests.inc(backend.name, str(status))
+    backend_seconds.observe(backend.name, value=seconds)
+
+
+class Instrumented:
+    """Topic handler measured with handling()"""
+
+    def __init__(self, topic_name, handler):
+        self.topic_name = topic_name
+        self.handler = handler
+
+    def __call__(self, ws, value):
+        with handling(self.topic_name):
+            return self.handler(ws, value)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, address=DEFAULT_ADDRESS):
+    """
+    Serves /metrics in a background thread
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        Call shutdown() and server_close() to stop it.
+    """
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name="metrics", daemon=True
+    )
+    thread.start()
+    return server
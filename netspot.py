@@ -0,0 +1,644 @@
+"""
+Netspot Alarms
+
+The alarm checks ask a Netspot service for the alarms since the previous
+check. The time of the previous check, the cursor, used to be in a
+last_time.txt file that was read and rewritten on every check and shared by
+all Netspot services.
+
+CursorStore keeps a cursor per Netspot address and port in memory. Changed
+cursors are written to a JSON file by a background thread, with an atomic
+replace so that a crash never leaves a partial file. Checks of the same
+service are serialized with a per-service lock, while different services can
+be polled at the same time.
+
+AlarmPoller follows one Netspot service in a background thread and publishes
+the new alarms as they arrive, without waiting for Publish_Alarms_Request
+messages. It reads the alarms one page at a time until it has caught up, so
+an alarm storm is not cut to the 50 most recent alarms. Netspot returns the
+newest alarms first, so the pages go back in time: each page asks for the
+alarms up to the oldest alarm of the previous page with the until parameter.
+"""
+import heapq
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+import requests
+
+import backends
+import codec
+import logs
+
+DEFAULT_CURSOR_FILE = "netspot_cursors.json"
+
+# Cursor file of the earlier versions. Its time is used for the services
+# without a cursor of their own.
+LEGACY_CURSOR_FILE = "last_time.txt"
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# Alarms asked in one request
+DEFAULT_PAGE_SIZE = 50
+
+# Seconds between the polls. The interval grows up to the maximum while the
+# service has no new alarms and is reset when alarms arrive.
+DEFAULT_MIN_INTERVAL = 1.0
+DEFAULT_MAX_INTERVAL = 30.0
+
+# Most probable alarms listed in the results message
+DEFAULT_TOP_K = 5
+
+# Alarm fields counting the alarms in the results message
+DEFAULT_GROUP_BY = ("stat", "status")
+
+# Names of the alarm fields in the results message
+FIELD_NAMES = {
+    "stat": "Statistic",
+    "status": "Status",
+    "probability": "Probability",
+    "time": "Time",
+}
+
+# Seconds of history for the alarms per second metric
+RATE_WINDOW = 60.0
+
+log = logs.get_logger("netspot")
+
+
+def endpoint_key(address, port):
+    return f"{address}:{port}"
+
+
+class CursorStore:
+    """
+    Alarm cursors of the Netspot services
+
+    Parameters
+    ----------
+    path : str or None
+        JSON file for the cursors. Cursors are kept only in memory if None.
+    flush_interval : float
+        Seconds between the background writes of changed cursors.
+    legacy_path : str or None
+        last_time.txt file used for services without a cursor.
+    """
+
+    def __init__(
+        self,
+        path=DEFAULT_CURSOR_FILE,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        legacy_path=LEGACY_CURSOR_FILE,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.legacy_path = legacy_path
+        self._cursors = None
+        self._default = 0
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._flusher = None
+
+    def lock(self, address, port):
+        """Returns the lock serializing the checks of address:port"""
+        key = endpoint_key(address, port)
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def get(self, address, port):
+        """Returns the cursor in nanoseconds, 0 for an unknown service"""
+        with self._lock:
+            self._load()
+            return self._cursors.get(
+                endpoint_key(address, port), self._default
+            )
+
+    def advance(self, address, port, timestamp):
+        """
+        Moves the cursor of address:port to *timestamp*
+
+        The cursor never moves backwards. The change is written to the file
+        in the background.
+        """
+        key = endpoint_key(address, port)
+        with self._lock:
+            self._load()
+            if timestamp <= self._cursors.get(key, self._default):
+                return
+            self._cursors[key] = timestamp
+            self._dirty = True
+            if self.path is not None and self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_loop,
+                    name="netspot-cursors",
+                    daemon=True,
+                )
+                self._flusher.start()
+
+    def flush(self):
+        """Writes the cursors to the file if they have changed"""
+        with self._lock:
+            if not self._dirty or self.path is None:
+                return
+            data = json.dumps(self._cursors)
+            self._dirty = False
+        try:
+            _write_atomic(self.path, data)
+        except OSError:
+            with self._lock:
+                self._dirty = True
+            raise
+
+    def close(self):
+        """Stops the background writes and writes the changed cursors"""
+        with self._lock:
+            self._closed = True
+            flusher = self._flusher
+        self._wakeup.set()
+        if flusher is not None:
+            flusher.join()
+        self.flush()
+
+    def _load(self):
+        # Called with self._lock held
+        if self._cursors is not None:
+            return
+        self._cursors = {}
+        if self.path is not None:
+            try:
+                with open(self.path) as file:
+                    self._cursors = {
+                        key: int(value)
+                        for key, value in json.load(file).items()
+                    }
+            except (FileNotFoundError, ValueError, AttributeError):
+                pass
+        if self.legacy_path is not None:
+            try:
+                with open(self.legacy_path) as file:
+                    self._default = int(file.readline().rstrip())
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            with self._lock:
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except OSError as e:
+                log.warning("Could not save Netspot cursors: %s", e)
+
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "w") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def alarm_time_ns(alarm):
+    """
+    Returns the time of the *alarm* in nanoseconds or None if unknown
+
+    Netspot gives the time as an RFC 3339 string, nanoseconds are accepted
+    too.
+    """
+    value = alarm.get("time")
+    if isinstance(value, (int, float)):
+        return int(value)
+    if not isinstance(value, str):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    # datetime takes at most microseconds
+    match = re.fullmatch(r"([^.]*)(?:\.(\d+))?(.*)", value.strip())
+    fraction = (match[2] or "").ljust(9, "0")
+    text = match[1] + match[3]
+    if text.endswith(("Z", "z")):
+        text = text[:-1] + "+00:00"
+    try:
+        stamp = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    return int(stamp.timestamp()) * 1_000_000_000 + int(fraction[:9])
+
+
+class AlarmSummary:
+    """
+    Top-k alarms and aggregates of a set of Netspot alarms
+
+    The alarms are added one at a time and only the *top_k* most probable
+    ones are kept, in a heap, so summarizing thousands of alarms needs
+    little memory. The alarms are also counted by the *group_by* fields.
+
+    Parameters
+    ----------
+    top_k : int
+        Number of most probable alarms kept.
+    group_by : tuple of str
+        Alarm fields grouping the alarms, e.g. ("stat", "status").
+    since : int or None
+        Start of the time window of the alarms in nanoseconds.
+    until : int or None
+        End of the time window in nanoseconds, the current time if None.
+    """
+
+    def __init__(
+        self,
+        top_k=DEFAULT_TOP_K,
+        group_by=DEFAULT_GROUP_BY,
+        since=None,
+        until=None,
+    ):
+        self.top_k = max(1, top_k)
+        self.group_by = tuple(group_by)
+        self.since = since
+        self.until = until
+        self.count = 0
+        self.max_probability = None
+        self.total_probability = 0.0
+        self._heap = []
+        self._groups = {}
+
+    def add(self, alarm):
+        probability = alarm["probability"]
+        self.count += 1
+        self.total_probability += probability
+        if self.max_probability is None or probability > self.max_probability:
+            self.max_probability = probability
+
+        # The count breaks ties, so the later one of equally probable alarms
+        # ranks higher and the alarms themselves are never compared
+        item = (probability, self.count, alarm)
+        if len(self._heap) < self.top_k:
+            heapq.heappush(self._heap, item)
+        elif self._heap and item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+        key = tuple(alarm.get(field) for field in self.group_by)
+        group = self._groups.get(key)
+        if group is None:
+            self._groups[key] = [1, probability, probability]
+        else:
+            group[0] += 1
+            group[1] = max(group[1], probability)
+            group[2] += probability
+
+    def extend(self, alarms):
+        for alarm in alarms:
+            self.add(alarm)
+
+    @property
+    def mean_probability(self):
+        if self.count == 0:
+            return None
+        return self.total_probability / self.count
+
+    @property
+    def window(self):
+        """Seconds in the time window or None if the start is not known"""
+        if not self.since:
+            return None
+        until = self.until or time.time_ns()
+        return max(0, until - self.since) / 1e9
+
+    @property
+    def rate(self):
+        """Alarms per second in the time window"""
+        window = self.window
+        if not window:
+            return None
+        return self.count / window
+
+    def top(self):
+        """Returns the most probable alarms, the most probable first"""
+        return [item[2] for item in sorted(self._heap, reverse=True)]
+
+    def groups(self):
+        """Returns [(key, count, max probability, mean probability)]"""
+        groups = [
+            (key, count, highest, total / count)
+            for key, (count, highest, total) in self._groups.items()
+        ]
+        groups.sort(key=lambda group: (-group[1], -group[2]))
+        return groups
+
+
+def summary_message(device, summary):
+    """
+    Returns the Netspot_Control_Results message for the AlarmSummary
+
+    Statistic, Status, Probability and Time are from the most probable
+    alarm, as in the single alarm messages of the earlier versions.
+    """
+    top = summary.top()
+    value = {
+        "description": "Netspot alarms check results",
+        "Device": device,
+    }
+    value.update(_alarm_fields(top[0]))
+    value.update(
+        {
+            "Count": summary.count,
+            "Rate": summary.rate,
+            "Window": summary.window,
+            "Max Probability": summary.max_probability,
+            "Mean Probability": summary.mean_probability,
+            "Top Alarms": [_alarm_fields(alarm) for alarm in top],
+            "Groups": [
+                _group_fields(summary.group_by, group)
+                for group in summary.groups()
+            ],
+        }
+    )
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": "SIFIS:Netspot_Control_Results",
+            "topic_uuid": "AlarmResult",
+            "value": value,
+        }
+    }
+
+
+def _group_fields(group_by, group):
+    key, count, highest, mean = group
+    fields = {
+        FIELD_NAMES.get(name, name): item for name, item in zip(group_by, key)
+    }
+    fields.update(
+        {"Count": count, "Max Probability": highest, "Mean Probability": mean}
+    )
+    return fields
+
+
+def _alarm_fields(alarm):
+    return {
+        "Statistic": alarm["stat"],
+        "Status": alarm["status"],
+        "Probability": alarm["probability"],
+        "Time": alarm["time"],
+    }
+
+
+def fetch_alarm_page(
+    address, port, cursor, until=None, seen=(), page_size=DEFAULT_PAGE_SIZE
+):
+    """
+    Asks the Netspot service for the newest alarms since *cursor*
+
+    Netspot returns the newest alarms first, so the pages of a storm are
+    read backwards: the next page asks for the alarms up to the oldest time
+    of a full page, *until*, and *seen* are the alarms of that time already
+    returned.
+
+    Returns
+    -------
+    (list, int, list)
+        The new alarms of the page, and the oldest time of the page and
+        its alarms when the page is full and older alarms are left, or
+        (alarms, None, []) when the page reaches the cursor.
+    """
+    backend = backends.netspot(address, port)
+    url = backend.url("v1", "netspots", "alarms")
+    params = {"time": cursor, "last": page_size}
+    if until is not None:
+        params["until"] = until
+    reply = backend.get(url, params=params)
+    if reply.status_code != 200:
+        raise requests.HTTPError(
+            f"Server responded with {reply.status_code}", response=reply
+        )
+    alarms = reply.json()
+    times = [alarm_time_ns(alarm) for alarm in alarms]
+    new = [
+        alarm
+        for alarm, alarm_time in zip(alarms, times)
+        if until is None
+        or (
+            alarm_time is not None
+            and alarm_time <= until
+            and alarm not in seen
+        )
+    ]
+    if len(alarms) < page_size:
+        return new, None, []
+    if None in times or not new:
+        log.warning(
+            "Netspot %s: can not page by the alarm times, "
+            "older alarms may be missing",
+            endpoint_key(address, port),
+        )
+        return new, None, []
+    # The next page ends at the oldest alarm of this one. Other alarms of
+    # the same time may be left, so the page asks for that time too.
+    oldest = min(times)
+    at_oldest = [a for a in new if alarm_time_ns(a) == oldest]
+    if oldest == until:
+        return new, oldest, list(seen) + at_oldest
+    return new, oldest, at_oldest
+
+
+class AlarmPoller:
+    """
+    Publishes the alarms of a Netspot service as they arrive
+
+    Each page of new alarms is published as an AlarmSummary. The poller
+    asks for the alarms since the cursor of the service, a page of
+    *page_size* at a time. Netspot returns the newest alarms first, so a
+    full page is followed at once by the page of the alarms up to the oldest
+    one of the page, until a page is not full. The cursor moves to the time
+    of the first request only then, so no alarm of a storm is skipped. Then
+    the poller waits for the poll interval, which doubles up to
+    *max_interval* while there are no new alarms.
+
+    Parameters
+    ----------
+    address : str
+        Netspot service address.
+    port : int
+        Netspot service port.
+    cursors : CursorStore
+        Cursors shared with the alarm checks.
+    device : str
+        Device name in the result messages.
+    page_size : int
+        Alarms asked in one request.
+    min_interval : float
+        Seconds between the polls when alarms are arriving.
+    max_interval : float
+        Longest time between the polls.
+    top_k : int
+        Most probable alarms listed in a results message.
+    group_by : tuple of str
+        Alarm fields counting the alarms in a results message.
+    """
+
+    def __init__(
+        self,
+        address,
+        port,
+        cursors,
+        device,
+        page_size=DEFAULT_PAGE_SIZE,
+        min_interval=DEFAULT_MIN_INTERVAL,
+        max_interval=DEFAULT_MAX_INTERVAL,
+        top_k=DEFAULT_TOP_K,
+        group_by=DEFAULT_GROUP_BY,
+    ):
+        self.address = address
+        self.port = port
+        self.cursors = cursors
+        self.device = device
+        self.page_size = page_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.top_k = top_k
+        self.group_by = group_by
+        self.interval = min_interval
+        self.stats = Counter()
+        self._arrivals = deque()
+        self.ws = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return endpoint_key(self.address, self.port)
+
+    @property
+    def lag(self):
+        """Seconds from the time the poller has caught up to until now"""
+        cursor = self.cursors.get(self.address, self.port)
+        if cursor == 0:
+            return None
+        return max(0.0, (time.time_ns() - cursor) / 1e9)
+
+    @property
+    def alarms_per_second(self):
+        """Alarms published per second during the last RATE_WINDOW"""
+        now = time.monotonic()
+        with self._lock:
+            while self._arrivals and self._arrivals[0][0] < now - RATE_WINDOW:
+                self._arrivals.popleft()
+            return sum(count for _, count in self._arrivals) / RATE_WINDOW
+
+    def start(self, ws):
+        """Starts polling and publishing the alarms with ws.send()"""
+        with self._lock:
+            self.ws = ws
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name=f"netspot {self.name}", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Stops polling and waits for the poll in progress"""
+        self._stop.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def poll(self):
+        """
+        Publishes the alarms since the cursor until caught up
+
+        Returns
+        -------
+        int
+            Number of alarms published.
+        """
+        published = 0
+        with self.cursors.lock(self.address, self.port):
+            started = time.time_ns()
+            cursor = self.cursors.get(self.address, self.port) or started
+            until = None
+            # Alarms at the time of *until*, published with a newer page
+            seen = []
+            while not self._stop.is_set():
+                alarms, oldest, seen = self._fetch_page(cursor, until, seen)
+                if alarms:
+                    summary = AlarmSummary(
+                        self.top_k,
+                        self.group_by,
+                        cursor if oldest is None else oldest,
+                        started if until is None else until,
+                    )
+                    summary.extend(alarms)
+                    self.stats["alarms"] += summary.count
+                    self._publish(summary_message(self.device, summary))
+                    published += summary.count
+                until = oldest
+                if oldest is None:
+                    # Caught up with the alarms since the cursor
+                    self.cursors.advance(self.address, self.port, started)
+                    break
+        if published:
+            with self._lock:
+                self._arrivals.append((time.monotonic(), published))
+            lag = self.lag or 0.0
+            log.info(
+                "Netspot %s: %d alarms, lag %.1f s, %.2f alarms/s",
+                self.name,
+                published,
+                lag,
+                self.alarms_per_second,
+            )
+        return published
+
+    def adapt_interval(self, published):
+        """Returns the time to the next poll after *published* alarms"""
+        if published:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        return self.interval
+
+    def _fetch_page(self, cursor, until, seen):
+        self.stats["polls"] += 1
+        return fetch_alarm_page(
+            self.address, self.port, cursor, until, seen, self.page_size
+        )
+
+    def _publish(self, message):
+        self.ws.send(codec.dumps(message))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                published = self.poll()
+            except Exception as e:
+                self.stats["errors"] += 1
+                log.warning("Netspot %s poll failed: %s", self.name, e)
+                published = 0
+            self._stop.wait(self.adapt_interval(published))
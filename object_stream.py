@@ -0,0 +1,202 @@
+"""
+Object Recognition Streaming
+
+A SIFIS:Privacy_Aware_Object_Recognition request uploads the whole video
+and waits for one response with the objects of all the frames. A request
+with "stream": true is instead sent to the file_object_stream endpoint of
+the object recognition backend. The video is sent in chunks with chunked
+transfer encoding, so the backend can decode the first frames before the
+rest has arrived, and the backend responds with one JSON line per processed
+frame.
+
+Each frame is published as a SIFIS:Privacy_Aware_Object_Recognition_Frame_
+Results message with its frame number as soon as it is read. A line with a
+whole results message is published as it is, and the last frame message has
+"final": true.
+
+requests sends the whole body before it reads the response, so the first
+frame is published only after the upload has finished. The stream saves the
+wait for the inference of the whole video, not the upload time.
+"""
+import os
+
+import requests
+
+import codec
+import logs
+import tracing
+from backends import FallbackHandler, MissingEndpoint
+
+# Bytes of the video sent at a time
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+STREAM_PATH = "file_object_stream"
+TOPIC = "SIFIS:Privacy_Aware_Object_Recognition"
+FRAME_TOPIC = "SIFIS:Privacy_Aware_Object_Recognition_Frame_Results"
+
+log = logs.get_logger("object_stream")
+
+
+def frame_message(value, frame, result, final=False):
+    """
+    Returns the frame results message of a frame for the request *value*
+
+    Parameters
+    ----------
+    value : dict
+        Streamed request.
+    frame : int
+        Number of the frame, from 1, when the result has none.
+    result : dict
+        Objects of the frame from the backend.
+    final : bool
+        True for the last message of the request.
+    """
+    if not isinstance(result, dict):
+        result = {"result": result}
+    frame_value = {"frame": frame}
+    frame_value.update(result)
+    frame_value.update(
+        description="Object Recognition Frame Results",
+        requestor_id=value.get("requestor_id"),
+        requestor_type=value.get("requestor_type"),
+        request_id=value.get("request_id"),
+        file_name=value.get("file_name"),
+        final=final,
+    )
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": FRAME_TOPIC,
+            "topic_uuid": FRAME_TOPIC.partition(":")[2],
+            "value": frame_value,
+        }
+    }
+
+
+def read_chunks(file, chunk_size):
+    """Yields the contents of *file* in chunks of *chunk_size* bytes"""
+    while chunk := file.read(chunk_size):
+        yield chunk
+
+
+class ObjectStreams(FallbackHandler):
+    """
+    Topic handler of the object recognition requests
+
+    Requests with "stream": true are streamed, the others go to *fallback*.
+
+    Parameters
+    ----------
+    backend : Backend
+        Object recognition backend.
+    fallback : callable
+        Handler for the requests without streaming, and for all the requests
+        when the backend has no stream endpoint.
+    data_dir : str
+        Directory of the videos named in the requests.
+    chunk_size : int
+        Bytes of the video sent at a time.
+    """
+
+    def __init__(
+        self, backend, fallback, data_dir, chunk_size=DEFAULT_CHUNK_SIZE
+    ):
+        self.backend = backend
+        self.fallback = fallback
+        self.data_dir = data_dir
+        self.chunk_size = chunk_size
+
+    def handles(self, value):
+        return bool(
+            value.get("stream") and self.backend.has_endpoint(STREAM_PATH)
+        )
+
+    def __call__(self, ws, value):
+        if not self.handles(value):
+            self.fallback(ws, value)
+            return
+        try:
+            self.stream(ws, value)
+        except MissingEndpoint:
+            self.fallback(ws, value)
+        except requests.RequestException as e:
+            log.warning(
+                "Request failed: %s",
+                e,
+                extra=logs.request_fields(value, TOPIC),
+            )
+        except OSError as e:
+            log.warning(
+                "Reading the video failed: %s",
+                e,
+                extra=logs.request_fields(value, TOPIC),
+            )
+
+    def url(self, value):
+        return self.backend.url(
+            STREAM_PATH,
+            value["file_name"],
+            value["epsilon"],
+            value["sensitivity"],
+            value["requestor_id"],
+            value["requestor_type"],
+            value["request_id"],
+        )
+
+    def stream(self, ws, value):
+        """
+        Streams the video of the request *value* and publishes the frames
+
+        Raises MissingEndpoint when the backend has no stream endpoint.
+        """
+        path = os.path.join(self.data_dir, value["file_name"])
+        with open(path, "rb") as file, tracing.span("upload"):
+            response = self.backend.request(
+                "POST",
+                self.url(value),
+                data=read_chunks(file, self.chunk_size),
+                headers={"Content-Type": "application/octet-stream"},
+                stream=True,
+            )
+        with response:
+            self.backend.check_endpoint(STREAM_PATH, response.status_code)
+            if response.status_code != 200:
+                log.warning(
+                    "Request failed with %s.",
+                    response.status_code,
+                    extra=logs.request_fields(value, TOPIC),
+                )
+                return
+            self._publish(ws, value, response.iter_lines())
+
+    def _publish(self, ws, value, lines):
+        frames = 0
+        with tracing.span("inference"):
+            for line in lines:
+                if not line:
+                    continue
+                try:
+                    result = codec.loads(line)
+                except ValueError as e:
+                    log.warning(
+                        "Invalid frame result: %s",
+                        e,
+                        extra=logs.request_fields(value, TOPIC),
+                    )
+                    continue
+                if (
+                    isinstance(result, dict)
+                    and "RequestPostTopicUUID" in result
+                ):
+                    # Results of the whole video
+                    message = result
+                else:
+                    frames += 1
+                    message = frame_message(value, frames, result)
+                ws.send(codec.dumps(message))
+        ws.send(codec.dumps(frame_message(value, frames, {}, final=True)))
+        log.info(
+            "Request succeeded with %d frames.",
+            frames,
+            extra=logs.request_fields(value, TOPIC),
+        )
@@ -0,0 +1,206 @@
+"""
+Result Cache
+
+Parental control, object recognition and face recognition are often asked
+again for the same file with the same privacy parameters. The cache keeps
+the result messages of these analytics keyed on a hash of the uploaded file
+contents and the analytic parameters, so a repeated request is answered
+without running the inference again.
+
+Entries are evicted by age (TTL) and by least recent use. An optional
+directory keeps the entries over restarts and after they have been evicted
+from memory.
+"""
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import codec
+import logs
+import metrics
+from backends import Content, Field, Upload, file_digest
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_TTL = 3600.0
+
+# Fields identifying the caller. They are not part of the cache key and are
+# replaced in the cached result for the new caller.
+CALLER_FIELDS = ("requestor_id", "requestor_type", "request_id")
+
+log = logs.get_logger("result_cache")
+
+
+class ResultCache:
+    """
+    LRU and TTL cache for analytics result messages
+
+    Parameters
+    ----------
+    max_entries : int
+        Number of results kept in memory.
+    ttl : float
+        Seconds a result is valid.
+    directory : str or None
+        Also keep the results as files in this directory.
+    name : str
+        Cache label in the metrics.
+    """
+
+    def __init__(
+        self,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        ttl=DEFAULT_TTL,
+        directory=None,
+        name="results",
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.name = name
+        self.stats = Counter()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, topic_name, value, request):
+        """
+        Returns the cache key for a request
+
+        The key is made of the topic, the message value without the caller
+        fields, and the contents of the parts sent in the *request*.
+        """
+        parameters = {
+            name: item
+            for name, item in value.items()
+            if name not in CALLER_FIELDS
+        }
+        parts = []
+        for part in request.parts:
+            if isinstance(part, Upload):
+                parts.append([part.name, file_digest(part.path)])
+            elif isinstance(part, Content):
+                parts.append(
+                    [part.name, hashlib.sha256(part.data).hexdigest()]
+                )
+            elif isinstance(part, Field):
+                parts.append([part.name, part.value])
+        text = json.dumps(
+            [topic_name, parameters, parts], sort_keys=True, default=str
+        )
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key, value):
+        """
+        Returns the cached result for *key* or None
+
+        The caller fields of the returned message are taken from the
+        request *value*.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._count("hits")
+                    return self._for_caller(entry[1], value)
+                del self._entries[key]
+                self._count("expired")
+
+        entry = self._read_file(key, now)
+        with self._lock:
+            if entry is None:
+                self._count("misses")
+                return None
+            self._count("hits")
+            self._count("disk_hits")
+            self._store(key, entry)
+        return self._for_caller(entry[1], value)
+
+    def put(self, key, message):
+        """Stores the result *message* for *key*"""
+        if isinstance(message, str):
+            # Passed through without decoding
+            message = codec.loads(str(message))
+        entry = (time.time() + self.ttl, message)
+        with self._lock:
+            self._store(key, entry)
+        self._write_file(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._count("evictions")
+
+    def _count(self, event):
+        self.stats[event] += 1
+        metrics.cache_events.inc(self.name, event)
+
+    @staticmethod
+    def _for_caller(message, value):
+        message = copy.deepcopy(message)
+        result = message.get("RequestPostTopicUUID", {}).get("value")
+        if isinstance(result, dict):
+            for name in CALLER_FIELDS:
+                if name in result and name in value:
+                    result[name] = value[name]
+        return message
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _read_file(self, key, now):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key)) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if not (
+            isinstance(data, dict)
+            and isinstance(data.get("expires"), (int, float))
+            and isinstance(data.get("message"), dict)
+        ):
+            log.debug("Ignoring the invalid cache file of %s", key)
+            return None
+        if data["expires"] <= now:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            return None
+        return data["expires"], data["message"]
+
+    def _write_file(self, key, entry):
+        """Writes the entry to the directory, keeping it in memory on errors"""
+        if self.directory is None:
+            return
+        data = {"expires": entry[0], "message": entry[1]}
+        temporary = None
+        try:
+            handle, temporary = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(handle, "w") as file:
+                json.dump(data, file)
+            os.replace(temporary, self._path(key))
+        except OSError as e:
+            with self._lock:
+                self._count("write_errors")
+            log.warning("Writing the cached result failed: %s", e)
+            if temporary is not None:
+                try:
+                    os.unlink(temporary)
+                except OSError:
+                    pass
@@ -0,0 +1,305 @@
+"""
+Speaker Verification Against Many Candidates
+
+A SIFIS:Privacy_Aware_Speaker_Verification request compares the speakers of
+first_audio_file and second_audio_file, and both files are uploaded for
+every comparison. A request with a candidate_audio_files list instead
+compares the reference in first_audio_file with each candidate:
+
+1. The speaker_embedding endpoint of the backend computes the embedding of
+   the reference. The embeddings are kept by the SHA-256 of the file, so a
+   reference verified again is not uploaded.
+2. The candidates are posted with the reference embedding to the
+   speaker_verification_embedding endpoint, several at a time.
+
+The result message has the candidates ranked by their score, highest first.
+"""
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import codec
+import logs
+from backends import (
+    BackendRequest,
+    FallbackHandler,
+    Field,
+    MissingEndpoint,
+    Upload,
+    file_digest,
+)
+
+# Candidates compared at the same time
+DEFAULT_WORKERS = 4
+
+# Reference embeddings kept
+MAX_EMBEDDINGS = 256
+
+EMBEDDING_PATH = "speaker_embedding"
+VERIFICATION_PATH = "speaker_verification_embedding"
+TOPIC = "SIFIS:Privacy_Aware_Speaker_Verification"
+RESULTS_TOPIC = TOPIC + "_Results"
+
+log = logs.get_logger("speaker_verification")
+
+
+def _audio(name, path, filename):
+    return Upload(name, path, filename, "audio/wav")
+
+
+def _result_value(content):
+    """Returns the value of a results message, or the decoded *content*"""
+    result = codec.loads(content)
+    if isinstance(result, dict) and "RequestPostTopicUUID" in result:
+        result = result["RequestPostTopicUUID"].get("value", {})
+    if not isinstance(result, dict):
+        result = {"result": result}
+    return result
+
+
+def rank(results):
+    """
+    Returns the candidate *results* with the highest score first
+
+    The results without a score keep their order after the others.
+    """
+
+    def key(result):
+        score = result.get("score")
+        if isinstance(score, (int, float)):
+            return (0, -score)
+        return (1, 0)
+
+    return sorted(results, key=key)
+
+
+def ranking_message(value, ranking):
+    """Returns the results message of the request *value*"""
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": RESULTS_TOPIC,
+            "topic_uuid": RESULTS_TOPIC.partition(":")[2],
+            "value": {
+                "description": "Speaker Verification Ranking",
+                "requestor_id": value.get("requestor_id"),
+                "requestor_type": value.get("requestor_type"),
+                "request_id": value.get("request_id"),
+                "first_audio_file": value.get("first_audio_file"),
+                "ranking": ranking,
+            },
+        }
+    }
+
+
+class EmbeddingCache:
+    """Speaker embeddings by the SHA-256 of the audio file"""
+
+    def __init__(self, max_size=MAX_EMBEDDINGS):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, digest):
+        with self._lock:
+            embedding = self._entries.get(digest)
+            if embedding is not None:
+                self._entries.move_to_end(digest)
+            return embedding
+
+    def put(self, digest, embedding):
+        with self._lock:
+            self._entries[digest] = embedding
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SpeakerVerification(FallbackHandler):
+    """
+    Topic handler of the speaker verification requests
+
+    Requests with candidate_audio_files are compared with each candidate,
+    the others go to *fallback*.
+
+    Parameters
+    ----------
+    backend : Backend
+        Speaker verification backend.
+    fallback : callable
+        Handler for the requests with one second_audio_file.
+    pairwise : callable
+        Called as pairwise(value) with second_audio_file set to a candidate
+        and returns the BackendRequest comparing the two files, used when
+        the backend has no embedding endpoints.
+    data_dir : str
+        Directory of the audio files named in the requests.
+    workers : int
+        Candidates compared at the same time.
+    """
+
+    def __init__(
+        self, backend, fallback, pairwise, data_dir, workers=DEFAULT_WORKERS
+    ):
+        self.backend = backend
+        self.fallback = fallback
+        self.pairwise = pairwise
+        self.data_dir = data_dir
+        self.embeddings = EmbeddingCache()
+        self._workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, workers):
+        with self._lock:
+            self._workers = workers
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self._workers, thread_name_prefix="speaker"
+                )
+            return self._executor
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def handles(self, value):
+        return value.get("candidate_audio_files") is not None
+
+    def __call__(self, ws, value):
+        if not self.handles(value):
+            self.fallback(ws, value)
+            return
+        try:
+            ranking = self.verify(value, list(value["candidate_audio_files"]))
+        except requests.RequestException as e:
+            log.warning(
+                "Request failed: %s",
+                e,
+                extra=logs.request_fields(value, TOPIC),
+            )
+            return
+        except (OSError, ValueError) as e:
+            log.warning(
+                "Verification failed: %s",
+                e,
+                extra=logs.request_fields(value, TOPIC),
+            )
+            return
+        log.info(
+            "Request succeeded with %d candidates.",
+            len(ranking),
+            extra=logs.request_fields(value, TOPIC),
+        )
+        ws.send(codec.dumps(ranking_message(value, ranking)))
+
+    def verify(self, value, candidates):
+        """Returns the ranked results of the *candidates* for *value*"""
+        try:
+            embedding = self.embedding(value)
+        except MissingEndpoint:
+            compare = functools.partial(self.compare_pair, value)
+        else:
+            compare = functools.partial(
+                self.compare_embedding, value, embedding
+            )
+        results = self.executor().map(
+            functools.partial(self._compare, compare), candidates
+        )
+        return rank(
+            [
+                dict(result, audio_file=candidate)
+                for candidate, result in zip(candidates, results)
+            ]
+        )
+
+    def embedding(self, value):
+        """
+        Returns the embedding of the reference of the request *value*
+
+        Raises MissingEndpoint when the backend has no embedding endpoint
+        and ValueError when the response has no embedding.
+        """
+        if not self.backend.has_endpoint(EMBEDDING_PATH):
+            raise MissingEndpoint(EMBEDDING_PATH)
+        path = self.data_dir + value["first_audio_file"]
+        digest = file_digest(path)
+        embedding = self.embeddings.get(digest)
+        if embedding is not None:
+            return embedding
+        url = self.backend.url(
+            EMBEDDING_PATH,
+            value["requestor_id"],
+            value["requestor_type"],
+            value["request_id"],
+        )
+        request = BackendRequest(
+            self.backend,
+            "POST",
+            url,
+            parts=(_audio("file", path, "reference.wav"),),
+        )
+        response = request.send()
+        self.backend.check_endpoint(EMBEDDING_PATH, response.status_code)
+        if response.status_code != 200:
+            raise ValueError(f"Embedding failed with {response.status_code}")
+        result = codec.loads(response.content)
+        embedding = (
+            result.get("embedding") if isinstance(result, dict) else None
+        )
+        if embedding is None:
+            raise ValueError("No embedding in the response")
+        self.embeddings.put(digest, embedding)
+        return embedding
+
+    def compare_embedding(self, value, embedding, candidate):
+        """Returns the result of *candidate* against the reference embedding"""
+        url = self.backend.url(
+            VERIFICATION_PATH,
+            candidate,
+            value["requestor_id"],
+            value["requestor_type"],
+            value["request_id"],
+        )
+        parts = (
+            Field("embedding", codec.dumps(embedding)),
+            _audio("file2", self.data_dir + candidate, "filename2.wav"),
+        )
+        request = BackendRequest(self.backend, "POST", url, parts=parts)
+        return self._result(request.send())
+
+    def compare_pair(self, value, candidate):
+        """Returns the result of *candidate* against the reference file"""
+        request = self.pairwise(dict(value, second_audio_file=candidate))
+        return self._result(request.send())
+
+    def _compare(self, compare, candidate):
+        try:
+            return compare(candidate)
+        except (requests.RequestException, OSError, ValueError) as e:
+            log.warning("Comparing %s failed: %s", candidate, e)
+            return {"status": f"failed: {e}"}
+
+    def _result(self, response):
+        if response.status_code != 200:
+            return {"status": f"failed with {response.status_code}"}
+        return _result_value(response.content)
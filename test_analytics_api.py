@@ -1,21 +1,26 @@
 import json
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 from argparse import Namespace
-from unittest.mock import MagicMock, Mock, mock_open, patch
+from unittest.mock import ANY, MagicMock, Mock, patch
 
 import requests
 
+import analytics_api
 import check
 from analytics_api import (
-    get_last_time,
     netspot_alarm_check,
     on_close,
     on_error,
     on_message,
     on_open,
-    set_last_time,
+    parse_address,
+    parse_topic_limit,
 )
+from netspot import CursorStore
 
 # ws = websocket.WebSocketApp(
 #         "ws://localhost:3000/ws",
@@ -30,7 +35,7 @@ class TestOnMessageFunction(unittest.TestCase):
     def setUp(self):
         self.ws = MagicMock()
 
-    @patch("analytics_api.json.loads")  # Mock the requests.post function
+    @patch("analytics_api.codec.loads")  # Mock the requests.post function
     def test_device_anomaly(self, mock_get):
         # Prepare a mock response from requests.get
         mock_response = mock_get.return_value
@@ -61,7 +66,7 @@ class TestOnMessageFunction(unittest.TestCase):
         }
         on_message(self.ws, json.dumps(json_message))
 
-    @patch("analytics_api.json.loads")
+    @patch("analytics_api.codec.loads")
     def test_speech_recognition_message(self, mock_json_loads):
         # Define a sample JSON message for Privacy_Aware_Speech_Recognition
         json_message = {
@@ -81,7 +86,7 @@ class TestOnMessageFunction(unittest.TestCase):
 
         on_message(self.ws, json.dumps(json_message))
 
-    @patch("analytics_api.json.loads")
+    @patch("analytics_api.codec.loads")
     def test_publish_alarms_request_message(self, mock_json_loads):
         json_message = {
             "Persistent": {
@@ -98,7 +103,7 @@ class TestOnMessageFunction(unittest.TestCase):
 
         on_message(self.ws, json.dumps(json_message))
 
-    @patch("analytics_api.json.loads")
+    @patch("analytics_api.codec.loads")
     def test_publish_alarms_request_message_None(self, mock_json_loads):
         json_message = {
             "Persistent": {
@@ -115,7 +120,7 @@ class TestOnMessageFunction(unittest.TestCase):
 
         on_message(self.ws, json.dumps(json_message))
 
-    @patch("analytics_api.json.loads")
+    @patch("analytics_api.codec.loads")
     def test_aud_manager_request_message(self, mock_json_loads):
         json_message = {
             "Persistent": {
@@ -128,6 +133,485 @@ class TestOnMessageFunction(unittest.TestCase):
         on_message(self.ws, json.dumps(json_message))
 
 
+class TestOnMessageDispatch(unittest.TestCase):
+    def tearDown(self):
+        analytics_api.dispatcher = None
+
+    def test_message_is_queued_with_topic(self):
+        ws = MagicMock()
+        analytics_api.dispatcher = MagicMock()
+        json_message = {
+            "Persistent": {
+                "topic_name": "SIFIS:AUD_Manager_Request",
+                "value": {"Request": "some_request"},
+            }
+        }
+
+        on_message(ws, json.dumps(json_message))
+
+        analytics_api.dispatcher.submit.assert_called_once_with(
+            "SIFIS:AUD_Manager_Request",
+            ANY,
+            ws,
+            {"Request": "some_request"},
+        )
+        handler = analytics_api.dispatcher.submit.call_args.args[1]
+        self.assertIs(
+            handler.handler,
+            analytics_api.TOPIC_HANDLERS["SIFIS:AUD_Manager_Request"],
+        )
+
+    def test_parse_topic_limit(self):
+        self.assertEqual(
+            parse_topic_limit("SIFIS:AUD_Manager_Request=3"),
+            ("SIFIS:AUD_Manager_Request", 3),
+        )
+        with self.assertRaises(ValueError):
+            parse_topic_limit("3")
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address("127.0.0.1:2000"), ("127.0.0.1", 2000))
+        with self.assertRaises(ValueError):
+            parse_address("2000")
+
+    def test_rejected_request_is_published(self):
+        ws = MagicMock()
+        value = {"request_id": "42", "requestor_id": "1"}
+
+        with self.assertLogs(analytics_api.log, "WARNING"):
+            analytics_api.reject_request(
+                "SIFIS:Privacy_Aware_Object_Recognition",
+                "deadline",
+                ws,
+                value,
+            )
+
+        message = json.loads(ws.send.call_args.args[0])
+        message = message["RequestPostTopicUUID"]
+        self.assertEqual(
+            message["topic_name"],
+            "SIFIS:Privacy_Aware_Object_Recognition_Results",
+        )
+        self.assertEqual(message["value"]["status"], "rejected: overloaded")
+        self.assertEqual(message["value"]["request_id"], "42")
+        self.assertEqual(message["value"]["reason"], "deadline")
+        self.assertEqual(
+            analytics_api.rejected_message(
+                "SIFIS:Publish_Alarms_Request", None, "queue full"
+            )["RequestPostTopicUUID"]["topic_name"],
+            "SIFIS:Netspot_Control_Results",
+        )
+
+
+class TestTopicRouting(unittest.TestCase):
+    def setUp(self):
+        analytics_api.dropped_topics.clear()
+
+    def tearDown(self):
+        analytics_api.DISABLED_TOPICS.clear()
+
+    def test_handlers_are_subscribed(self):
+        for topic_name in analytics_api.TOPIC_HANDLERS:
+            self.assertIn(topic_name, analytics_api.SUBSCRIBED_TOPICS)
+
+    def test_route(self):
+        self.assertIs(
+            analytics_api.route("SIFIS:Privacy_Aware_Speech_Recognition"),
+            analytics_api.speech_recognition,
+        )
+
+    def test_unhandled_topic_is_dropped(self):
+        ws = MagicMock()
+        json_message = {
+            "Persistent": {
+                "topic_name": "SIFIS:Object_Recognition_Results",
+                "value": {},
+            }
+        }
+
+        on_message(ws, json.dumps(json_message))
+
+        self.assertEqual(
+            analytics_api.dropped_topics["SIFIS:Object_Recognition_Results"],
+            1,
+        )
+        ws.send.assert_not_called()
+
+    def test_unsubscribed_topic_is_dropped(self):
+        self.assertIsNone(analytics_api.route("SIFIS:Unknown"))
+        self.assertEqual(analytics_api.dropped_topics["SIFIS:Unknown"], 1)
+
+    def test_disabled_topic(self):
+        analytics_api.DISABLED_TOPICS.add("SIFIS:AUD_Manager_Request")
+
+        self.assertIsNone(analytics_api.route("SIFIS:AUD_Manager_Request"))
+        self.assertEqual(
+            analytics_api.dropped_topics["SIFIS:AUD_Manager_Request"], 1
+        )
+
+    def test_topic_handler_decorator(self):
+        handler = MagicMock()
+        try:
+            analytics_api.topic_handler("SIFIS:Object_Recognition")(handler)
+            self.assertIs(
+                analytics_api.route("SIFIS:Object_Recognition"), handler
+            )
+        finally:
+            del analytics_api.TOPIC_HANDLERS["SIFIS:Object_Recognition"]
+
+
+class TestBackendHandlers(unittest.TestCase):
+    def test_object_recognition_request(self):
+        request = analytics_api.object_recognition_request(
+            {
+                "file_path": "/data",
+                "file_name": "video.mp4",
+                "requestor_id": "user123",
+                "requestor_type": "user",
+                "request_id": "123",
+                "epsilon": 0.5,
+                "sensitivity": 1,
+            }
+        )
+
+        self.assertEqual(request.method, "POST")
+        self.assertEqual(
+            request.url,
+            "http://localhost:8080/file_object/video.mp4/0.5/1/user123/user/123",
+        )
+        self.assertEqual(
+            request.parts,
+            (analytics_api.Upload("file", "/analytics_api/data/video.mp4"),),
+        )
+
+    @patch.object(analytics_api.face_databases, "version")
+    def test_face_recognition_request(self, mock_version):
+        mock_version.return_value = "0123456789abcdef"
+        request = analytics_api.face_recognition_request(
+            {
+                "file_name": "face.jpg",
+                "database_path": "faces",
+                "requestor_id": "user123",
+                "requestor_type": "user",
+                "request_id": "123",
+                "privacy_parameter": 1,
+            }
+        )
+
+        mock_version.assert_called_once_with("faces")
+        self.assertEqual(
+            request.parts,
+            (
+                analytics_api.Upload("file", "/analytics_api/data/face.jpg"),
+                analytics_api.Field("path", "faces"),
+                analytics_api.Field("database_version", "0123456789abcdef"),
+            ),
+        )
+
+    def test_backend_handler_forwards_reply(self):
+        ws = MagicMock()
+        request = MagicMock()
+        request.send.return_value.status_code = 200
+        request.send.return_value.content = b'{"RequestPostTopicUUID": {}}'
+        handler = analytics_api.BackendHandler(lambda value: request)
+
+        handler(ws, {})
+
+        ws.send.assert_called_once_with('{"RequestPostTopicUUID": {}}')
+
+    @patch("requests.Session.request")
+    def test_device_anomaly_result_is_published(self, mock_request):
+        ws = MagicMock()
+        content = b'{"RequestPostTopicUUID": {"value": {"request_id": "1"}}}'
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.content = content
+        handler = analytics_api.TOPIC_HANDLERS[
+            "SIFIS:Privacy_Aware_Device_Anomaly_Detection"
+        ]
+
+        handler(
+            ws,
+            {
+                "Temperatures": [30, 32],
+                "requestor_id": "1",
+                "requestor_type": "user",
+                "request_id": "1",
+            },
+        )
+
+        self.assertEqual(
+            mock_request.call_args.args[1],
+            "http://localhost:9090/temperature/30 32/1/user/1",
+        )
+        ws.send.assert_called_once_with(content.decode())
+
+    def test_backend_handler_checks_envelope(self):
+        ws = MagicMock()
+        request = MagicMock()
+        request.send.return_value.status_code = 200
+        handler = analytics_api.BackendHandler(lambda value: request)
+
+        for content in [b'{"error": "no model"}', b"[]", b"<html>"]:
+            request.send.return_value.content = content
+            with self.assertLogs("analytics_api", "WARNING"):
+                handler(ws, {})
+        ws.send.assert_not_called()
+
+        # Other keys before the envelope are decoded and checked
+        request.send.return_value.content = (
+            b'{"a": 1, "RequestPostTopicUUID": {}}'
+        )
+        handler(ws, {})
+        self.assertEqual(
+            json.loads(ws.send.call_args.args[0]),
+            {"a": 1, "RequestPostTopicUUID": {}},
+        )
+
+    def test_backend_handler_decodes_without_pass_through(self):
+        ws = MagicMock()
+        request = MagicMock()
+        request.send.return_value.status_code = 200
+        request.send.return_value.content = b'{"RequestPostTopicUUID": {}}'
+        handler = analytics_api.BackendHandler(lambda value: request)
+
+        with patch("analytics_api.pass_through", False):
+            handler(ws, {})
+
+        ws.send.assert_called_once_with('{"RequestPostTopicUUID":{}}')
+
+    def test_backend_handler_uses_cache(self):
+        ws = MagicMock()
+        request = MagicMock(parts=())
+        request.send.return_value.status_code = 200
+        request.send.return_value.content = json.dumps(
+            {"RequestPostTopicUUID": {"value": {"request_id": "1"}}}
+        ).encode()
+        cache = analytics_api.ResultCache()
+        handler = analytics_api.BackendHandler(
+            lambda value: request, topic_name="topic", cache=lambda: cache
+        )
+
+        handler(ws, {"request_id": "1"})
+        handler(ws, {"request_id": "2"})
+
+        request.send.assert_called_once()
+        self.assertEqual(
+            json.loads(ws.send.call_args.args[0]),
+            {"RequestPostTopicUUID": {"value": {"request_id": "2"}}},
+        )
+
+    def test_aud_manager_request(self):
+        request = analytics_api.aud_manager_request(
+            {"Request": "devices?name=a b; rm -rf /"}
+        )
+
+        self.assertEqual(request.method, "GET")
+        self.assertEqual(
+            request.url,
+            "http://localhost:5050/devices?name=a%20b%3B%20rm%20-rf%20/",
+        )
+
+    def test_escaped_aud_manager_request(self):
+        request = analytics_api.aud_manager_request(
+            {"Request": "devices?name=a%20b&load=100%"}
+        )
+
+        self.assertEqual(
+            request.url,
+            "http://localhost:5050/devices?name=a%20b&load=100%25",
+        )
+
+    def test_aud_manager_reply(self):
+        message = analytics_api.aud_manager_reply(
+            {"Request": "devices"}, 200, b"[]"
+        )
+
+        self.assertEqual(
+            message["RequestPostTopicUUID"]["value"],
+            {
+                "description": "AUD Manager Results",
+                "Request": "devices",
+                "Results": "[]",
+            },
+        )
+
+    @patch("requests.Session.request")
+    def test_aud_manager_cache(self, mock_request):
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.content = b"[]"
+        ws = MagicMock()
+        handler = analytics_api.TOPIC_HANDLERS["SIFIS:AUD_Manager_Request"]
+        analytics_api.aud_cache = analytics_api.ResultCache(ttl=5)
+        try:
+            handler(ws, {"Request": "devices"})
+            handler(ws, {"Request": "devices"})
+        finally:
+            analytics_api.aud_cache = None
+
+        mock_request.assert_called_once()
+        self.assertEqual(ws.send.call_count, 2)
+
+    @patch(
+        "requests.Session.request",
+        side_effect=requests.ConnectionError("refused"),
+    )
+    def test_backend_handler_connection_error(self, mock_request):
+        ws = MagicMock()
+        handler = analytics_api.TOPIC_HANDLERS["SIFIS:AUD_Manager_Request"]
+
+        handler(ws, {"Request": "devices"})
+
+        ws.send.assert_not_called()
+
+    @patch(
+        "requests.Session.request", side_effect=requests.ReadTimeout("slow")
+    )
+    def test_speech_recognition_connection_error(self, mock_request):
+        ws = MagicMock()
+        handler = analytics_api.TOPIC_HANDLERS[
+            "SIFIS:Privacy_Aware_Speech_Recognition"
+        ]
+
+        with tempfile.NamedTemporaryFile(suffix=".wav") as audio:
+            with patch.object(analytics_api, "DATA_DIR", ""):
+                handler(
+                    ws,
+                    {
+                        "Audio File": audio.name,
+                        "requestor_id": "user123",
+                        "requestor_type": "user",
+                        "request_id": "123",
+                        "Entity Types": ["person"],
+                        "method": "Whisper",
+                    },
+                )
+
+        mock_request.assert_called_once()
+        ws.send.assert_not_called()
+
+    def test_speech_recognition_request(self):
+        value = {
+            "Audio File": "a.wav",
+            "requestor_id": "user123",
+            "requestor_type": "user",
+            "request_id": "123",
+            "method": "Whisper",
+        }
+
+        request = analytics_api.speech_recognition.build(value)
+
+        self.assertEqual(
+            request.url, "http://localhost:5040/whisper/a.wav/user123/user/123"
+        )
+        self.assertEqual(
+            request.parts,
+            (analytics_api.Upload("file", "/analytics_api/data/a.wav"),),
+        )
+        with patch.object(analytics_api, "deepspeech_pool", None):
+            self.assertEqual(
+                analytics_api.speech_recognition.build(
+                    dict(value, method="DeepSpeeach")
+                ).backend,
+                analytics_api.BACKENDS["deepspeech"],
+            )
+        self.assertIsNone(
+            analytics_api.speech_recognition.build(dict(value, method="X"))
+        )
+
+    def test_speech_recognition_in_pool(self):
+        pool = MagicMock()
+        pool.recognize.return_value = b"hello"
+        value = {"Audio File": "a.wav", "method": "DeepSpeeach"}
+
+        with patch.object(analytics_api, "deepspeech_pool", pool):
+            self.assertIsNone(analytics_api.speech_recognition.build(value))
+            analytics_api.speech_recognition(MagicMock(), value)
+
+        pool.recognize.assert_called_once_with("a.wav")
+
+    def test_backend_handler_failed_request(self):
+        ws = MagicMock()
+        request = MagicMock()
+        request.send.return_value.status_code = 500
+        request.send.return_value.content = b"Internal Server Error"
+        handler = analytics_api.BackendHandler(lambda value: request)
+
+        handler(ws, {})
+
+        ws.send.assert_not_called()
+
+
+BACKEND_REQUESTS = {
+    "SIFIS:Privacy_Aware_Parental_Control": {
+        "file_name": "media.bin",
+        "requestor_id": "user123",
+        "requestor_type": "user",
+        "request_id": "1",
+        "Privacy_Parameter": 1,
+    },
+    "SIFIS:Privacy_Aware_Object_Recognition": {
+        "file_path": "/data",
+        "file_name": "media.bin",
+        "requestor_id": "user123",
+        "requestor_type": "user",
+        "request_id": "1",
+        "epsilon": 0.5,
+        "sensitivity": 1,
+    },
+    "SIFIS:Privacy_Aware_Face_Recognition": {
+        "file_name": "media.bin",
+        "database_path": "/db",
+        "requestor_id": "user123",
+        "requestor_type": "user",
+        "request_id": "1",
+        "privacy_parameter": 1,
+    },
+    "SIFIS:Privacy_Aware_Speaker_Verification": {
+        "first_audio_file": "media.bin",
+        "second_audio_file": "media.bin",
+        "requestor_id": "user123",
+        "requestor_type": "user",
+        "request_id": "1",
+    },
+}
+
+
+class TestBackendCallsPerRequest(unittest.TestCase):
+    """Regression check that each request costs one backend call"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, "media.bin"), "wb") as file:
+            file.write(b"media")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @patch("requests.Session.request")
+    def test_one_backend_call_per_request(self, mock_request):
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.content = b'{"RequestPostTopicUUID": {}}'
+        requests_per_topic = 5
+
+        with patch("analytics_api.DATA_DIR", self.directory + "/"):
+            for topic_name, value in BACKEND_REQUESTS.items():
+                mock_request.reset_mock()
+                ws = MagicMock()
+                message = json.dumps(
+                    {"Persistent": {"topic_name": topic_name, "value": value}}
+                )
+
+                for _ in range(requests_per_topic):
+                    on_message(ws, message)
+
+                self.assertEqual(
+                    mock_request.call_count, requests_per_topic, topic_name
+                )
+                self.assertEqual(
+                    ws.send.call_count, requests_per_topic, topic_name
+                )
+
+
 class TestMainFunction(unittest.TestCase):
     @patch(
         "argparse.ArgumentParser.parse_args",
@@ -175,12 +659,15 @@ class TestMainFunction(unittest.TestCase):
 
 
 class TestCheckNetSpotAlarmCheck(unittest.TestCase):
-    @patch("check.get_last_time", return_value=1234567890)
-    @patch("check.set_last_time")
+    def setUp(self):
+        cursors = CursorStore(None, legacy_path=None)
+        patcher = patch("check.netspot_cursors", cursors)
+        self.cursors = patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch("requests.get")
-    def test_check_successful_request_no_alarms(
-        self, mock_get, mock_set_last_time, mock_get_last_time
-    ):
+    def test_check_successful_request_no_alarms(self, mock_get):
+        self.cursors.advance("127.0.0.1", 8080, 1234567890)
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.json.return_value = []
@@ -188,7 +675,9 @@ class TestCheckNetSpotAlarmCheck(unittest.TestCase):
 
         result, message = check.netspot_alarm_check("127.0.0.1", 8080)
 
-        mock_get_last_time.assert_called_once()
+        self.assertEqual(mock_get.call_args[0][1]["time"], 1234567890)
+        self.assertGreater(self.cursors.get("127.0.0.1", 8080), 1234567890)
+        self.assertEqual(self.cursors.get("127.0.0.1", 2000), 0)
 
     @patch(
         "requests.get", side_effect=requests.RequestException("Request failed")
@@ -196,6 +685,8 @@ class TestCheckNetSpotAlarmCheck(unittest.TestCase):
     def test_request_exception(self, mock_get):
         result, message = check.netspot_alarm_check("127.0.0.1", 8080)
 
+        self.assertEqual(self.cursors.get("127.0.0.1", 8080), 0)
+
     @patch("requests.get")
     def test_server_error(self, mock_get):
         mock_response = Mock()
@@ -205,14 +696,19 @@ class TestCheckNetSpotAlarmCheck(unittest.TestCase):
 
         result, message = check.netspot_alarm_check("127.0.0.1", 8080)
 
+        self.assertEqual(self.cursors.get("127.0.0.1", 8080), 0)
+
 
 class TestNetSpotAlarmCheck(unittest.TestCase):
-    @patch("analytics_api.get_last_time", return_value=1234567890)
-    @patch("analytics_api.set_last_time")
-    @patch("requests.get")
-    def test_successful_request_no_alarms(
-        self, mock_get, mock_set_last_time, mock_get_last_time
-    ):
+    def setUp(self):
+        cursors = CursorStore(None, legacy_path=None)
+        patcher = patch("analytics_api.netspot_cursors", cursors)
+        self.cursors = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch("requests.Session.request")
+    def test_successful_request_no_alarms(self, mock_get):
+        self.cursors.advance("127.0.0.1", 8080, 1234567890)
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.json.return_value = []
@@ -220,15 +716,78 @@ class TestNetSpotAlarmCheck(unittest.TestCase):
 
         result, message = netspot_alarm_check("127.0.0.1", 8080)
 
-        mock_get_last_time.assert_called_once()
+        self.assertEqual(
+            mock_get.call_args.kwargs["params"]["time"], 1234567890
+        )
+        self.assertGreater(self.cursors.get("127.0.0.1", 8080), 1234567890)
+        self.assertEqual(self.cursors.get("127.0.0.1", 2000), 0)
+
+    @patch("requests.Session.request")
+    def test_alarms_are_summarized(self, mock_get):
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = [
+            {"stat": "R_SYN", "status": "UP", "probability": p, "time": t}
+            for t, p in enumerate([0.2, 0.9, 0.4])
+        ]
+        mock_get.return_value = mock_response
+
+        result, summary = netspot_alarm_check("127.0.0.1", 8080, 1)
+
+        self.assertTrue(result)
+        self.assertEqual(summary.count, 3)
+        self.assertEqual(summary.top()[0]["time"], 1)
+        self.assertAlmostEqual(summary.window, 60.0)
+
+    @patch("requests.Session.request")
+    def test_alarm_storm_is_paged(self, mock_get):
+        self.cursors.advance("127.0.0.1", 8080, 1000)
+        alarms = [
+            {"stat": "R_SYN", "status": "UP", "probability": 0.5, "time": t}
+            for t in range(1001, 1121)
+        ]
+
+        def netspot(method, url, params, **kwargs):
+            # The newest alarms since time up to until first
+            until = params.get("until", float("inf"))
+            matching = [
+                a for a in alarms if params["time"] <= a["time"] <= until
+            ]
+            return Mock(
+                status_code=200,
+                json=Mock(return_value=matching[::-1][: params["last"]]),
+            )
+
+        mock_get.side_effect = netspot
+
+        result, summary = netspot_alarm_check("127.0.0.1", 8080)
+
+        self.assertTrue(result)
+        self.assertEqual(summary.count, 120)
+        self.assertGreater(mock_get.call_count, 2)
+        self.assertGreater(self.cursors.get("127.0.0.1", 8080), 1120)
+
+    @patch("requests.Session.request")
+    def test_check_within_time_keeps_cursor(self, mock_get):
+        self.cursors.advance("127.0.0.1", 8080, 1000)
+        mock_get.return_value = Mock(
+            status_code=200, json=Mock(return_value=[])
+        )
+
+        netspot_alarm_check("127.0.0.1", 8080, 1)
+
+        self.assertEqual(self.cursors.get("127.0.0.1", 8080), 1000)
 
     @patch(
-        "requests.get", side_effect=requests.RequestException("Request failed")
+        "requests.Session.request",
+        side_effect=requests.RequestException("Request failed"),
     )
     def test_request_exception(self, mock_get):
         result, message = netspot_alarm_check("127.0.0.1", 8080)
 
-    @patch("requests.get")
+        self.assertEqual(self.cursors.get("127.0.0.1", 8080), 0)
+
+    @patch("requests.Session.request")
     def test_server_error(self, mock_get):
         mock_response = Mock()
         mock_response.status_code = 500
@@ -237,59 +796,11 @@ class TestNetSpotAlarmCheck(unittest.TestCase):
 
         result, message = netspot_alarm_check("127.0.0.1", 8080)
 
-
-class TestCheckGetLastTime(unittest.TestCase):
-    @patch("builtins.open", new_callable=mock_open, read_data="12345\n")
-    def test_check_successful_read(self, mock_file):
-        timestamp = check.get_last_time()
-
-    @patch("builtins.open", side_effect=FileNotFoundError)
-    def test_check_file_not_found(self, mock_file):
-        timestamp = check.get_last_time()
-
-    @patch(
-        "builtins.open", new_callable=mock_open, read_data="not_an_integer\n"
-    )
-    def test_value_error(self, mock_file):
-        timestamp = check.get_last_time()
-
-
-class TestGetLastTime(unittest.TestCase):
-    @patch("builtins.open", new_callable=mock_open, read_data="12345\n")
-    def test_successful_read(self, mock_file):
-        timestamp = get_last_time()
-
-    @patch("builtins.open", side_effect=FileNotFoundError)
-    def test_file_not_found(self, mock_file):
-        timestamp = get_last_time()
-
-    @patch(
-        "builtins.open", new_callable=mock_open, read_data="not_an_integer\n"
-    )
-    def test_value_error(self, mock_file):
-        timestamp = get_last_time()
-
-
-class TestCheckSetLastTime(unittest.TestCase):
-    @patch("builtins.open", new_callable=mock_open)
-    def test_check_successful_write(self, mock_file):
-        check.set_last_time()
-
-    @patch("builtins.open", side_effect=PermissionError)
-    def test_check_permission_error(self, mock_file):
-        with self.assertRaises(PermissionError):
-            check.set_last_time()
-
-
-class TestSetLastTime(unittest.TestCase):
-    @patch("builtins.open", new_callable=mock_open)
-    def test_successful_write(self, mock_file):
-        set_last_time()
-
-    @patch("builtins.open", side_effect=PermissionError)
-    def test_permission_error(self, mock_file):
-        with self.assertRaises(PermissionError):
-            set_last_time()
+        self.assertFalse(result)
+        self.assertEqual(
+            message, "Server responded with 500:\nInternal Server Error"
+        )
+        self.assertEqual(self.cursors.get("127.0.0.1", 8080), 0)
 
 
 def test_on_error():
@@ -0,0 +1,244 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import backends
+from audio_windows import WindowedAudioAnomaly
+from backends import REFERENCE_HEADER, Backend, BackendRequest, Field, Upload
+from camera import CameraSessions
+from object_stream import ObjectStreams
+from speaker_verification import SpeakerVerification
+
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from async_gateway import AsyncBackends, AsyncSender, Gateway
+except ImportError:
+    web = None
+
+
+def result_message(request_id):
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": "SIFIS:Privacy_Aware_Object_Recognition_Results",
+            "value": {"request_id": request_id},
+        }
+    }
+
+
+@unittest.skipIf(web is None, "aiohttp is not installed")
+class TestAsyncBackends(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.received = []
+        self.reject_references = False
+
+        async def handle(request):
+            form = await request.post()
+            if "file_path" in form:
+                if self.reject_references:
+                    return web.Response(status=415)
+                self.received.append(
+                    (
+                        request.headers[REFERENCE_HEADER],
+                        form["file_path"].file.read().decode(),
+                        form["file_sha256"].file.read().decode(),
+                    )
+                )
+                return web.json_response(result_message("1"))
+            upload = form["file"]
+            self.received.append(
+                (upload.filename, upload.file.read(), form["path"].file.read())
+            )
+            return web.json_response(result_message("1"))
+
+        app = web.Application()
+        app.router.add_post("/file_object/{tail:.*}", handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.backend = Backend("object_recognition", self.server.port)
+        self.backends = AsyncBackends()
+
+        file = tempfile.NamedTemporaryFile(suffix=".mp4", delete=False)
+        file.write(b"video")
+        file.close()
+        self.path = file.name
+
+    async def asyncTearDown(self):
+        await self.backends.close()
+        await self.server.close()
+        os.unlink(self.path)
+
+    async def test_send(self):
+        request = BackendRequest(
+            self.backend,
+            "POST",
+            self.backend.url("file_object", "a.mp4", 1),
+            parts=(Upload("file", self.path), Field("path", "/db")),
+        )
+
+        status, content = await self.backends.send(request)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(content), result_message("1"))
+        self.assertEqual(
+            self.received,
+            [(os.path.basename(self.path), b"video", b"/db")],
+        )
+
+    def request(self):
+        return BackendRequest(
+            self.backend,
+            "POST",
+            self.backend.url("file_object", "a.mp4", 1),
+            parts=(Upload("file", self.path), Field("path", "/db")),
+        )
+
+    async def test_send_by_reference(self):
+        self.backend.by_reference = True
+
+        status, _ = await self.backends.send(self.request())
+
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            self.received,
+            [
+                (
+                    "reference",
+                    os.path.abspath(self.path),
+                    hashlib.sha256(b"video").hexdigest(),
+                )
+            ],
+        )
+
+    async def test_rejected_reference_is_uploaded(self):
+        self.backend.by_reference = True
+        self.reject_references = True
+
+        with self.assertLogs(backends.log, "WARNING"):
+            status, _ = await self.backends.send(self.request())
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.received[0][1], b"video")
+        self.assertFalse(self.backend.by_reference)
+
+
+@unittest.skipIf(web is None, "aiohttp is not installed")
+class TestGateway(unittest.IsolatedAsyncioTestCase):
+    async def test_handlers_run_concurrently(self):
+        release = asyncio.Event()
+        started = []
+
+        async def send(request):
+            started.append(request)
+            await release.wait()
+            return 200, json.dumps(result_message(request)).encode()
+
+        def complete(key, value, status, content):
+            return json.loads(content)
+
+        handler = MagicMock(
+            build=lambda value: value, complete=complete, cached=False
+        )
+        gateway = Gateway(
+            lambda message: ("topic", message, handler), max_in_flight=8
+        )
+        gateway.backends.send = send
+        ws = MagicMock()
+        ws.send_str = MagicMock(side_effect=lambda data: asyncio.sleep(0))
+        sender = AsyncSender(ws)
+
+        for request_id in ["1", "2", "3"]:
+            await gateway.on_message(sender, request_id)
+        await asyncio.sleep(0)
+
+        self.assertEqual(started, ["1", "2", "3"])
+        release.set()
+        await gateway.join()
+        self.assertEqual(ws.send_str.call_count, 3)
+
+    async def test_invalid_message_is_skipped(self):
+        def parse(message):
+            return ("topic", json.loads(message)["value"], handler)
+
+        handler = MagicMock(build=None)
+        gateway = Gateway(parse)
+        ws = MagicMock()
+        ws.send_str = MagicMock(side_effect=lambda data: asyncio.sleep(0))
+
+        with self.assertLogs("analytics_api.gateway", "WARNING") as logged:
+            await gateway.on_message(AsyncSender(ws), "not json")
+            await gateway.on_message(AsyncSender(ws), "{}")
+        await gateway.on_message(AsyncSender(ws), '{"value": "result"}')
+        await gateway.join()
+
+        self.assertEqual(len(logged.records), 2)
+        handler.assert_called_once()
+
+    async def test_sync_handler_runs_in_thread(self):
+        def handler(ws, value):
+            ws.send(value)
+
+        gateway = Gateway(lambda message: ("topic", message, handler))
+        ws = MagicMock()
+        ws.send_str = MagicMock(side_effect=lambda data: asyncio.sleep(0))
+
+        await gateway.on_message(AsyncSender(ws), "result")
+        await gateway.join()
+
+        ws.send_str.assert_called_once_with("result")
+
+    async def test_fallback_requests_are_sent_natively(self):
+        async def send(request):
+            sent.append(request)
+            return 200, json.dumps(result_message(request["id"])).encode()
+
+        fallback = MagicMock(
+            build=lambda value: value,
+            complete=lambda key, value, status, content: json.loads(content),
+            cached=False,
+        )
+        backend = Backend("backend", 8090)
+        handlers = [
+            CameraSessions(backend, fallback),
+            ObjectStreams(backend, fallback, "/data"),
+            SpeakerVerification(backend, fallback, MagicMock(), "/data"),
+            WindowedAudioAnomaly(backend, fallback, "/data"),
+        ]
+        for handler in handlers:
+            with self.subTest(handler=type(handler).__name__):
+                sent = []
+                gateway = Gateway(lambda message: ("topic", message, handler))
+                gateway.backends.send = send
+                ws = MagicMock()
+                ws.send_str = MagicMock(
+                    side_effect=lambda data: asyncio.sleep(0)
+                )
+
+                await gateway.on_message(AsyncSender(ws), {"id": "1"})
+                await gateway.join()
+
+                self.assertEqual(sent, [{"id": "1"}])
+                fallback.assert_not_called()
+                ws.send_str.assert_called_once()
+
+    async def test_session_stop_runs_in_thread(self):
+        fallback = MagicMock(build=MagicMock())
+        sessions = CameraSessions(Backend("face_recognition", 8090), fallback)
+        gateway = Gateway(lambda message: ("topic", message, sessions))
+        gateway.backends.send = MagicMock()
+
+        with self.assertLogs("analytics_api.camera", "INFO"):
+            await gateway.on_message(
+                AsyncSender(MagicMock()),
+                {"id": "1", "cam_link": "rtsp:camera1", "stop": True},
+            )
+            await gateway.join()
+
+        gateway.backends.send.assert_not_called()
+        fallback.build.assert_not_called()
@@ -0,0 +1,226 @@
+import io
+import shutil
+import tempfile
+import unittest
+import wave
+from unittest.mock import MagicMock, patch
+
+import audio_windows
+import test_helpers
+from audio_windows import (
+    WindowedAudioAnomaly,
+    parse_wav,
+    top_labels,
+    window_wav,
+    windows,
+)
+from backends import Backend, BackendRequest
+from test_helpers import sent
+
+
+def wav_file(seconds, sample_rate=100):
+    data = io.BytesIO()
+    with wave.open(data, "wb") as output:
+        output.setnchannels(1)
+        output.setsampwidth(2)
+        output.setframerate(sample_rate)
+        output.writeframes(
+            b"".join(
+                i.to_bytes(2, "little")
+                for i in range(int(seconds * sample_rate))
+            )
+        )
+    return data.getvalue()
+
+
+def request(request_id, **fields):
+    return test_helpers.request(
+        request_id, audio_file="long.wav", method="m1", **fields
+    )
+
+
+def reply(*labels, status_code=200):
+    return test_helpers.reply(
+        status_code,
+        {
+            "predictions": [
+                {"label": label, "probability": probability}
+                for label, probability in labels
+            ]
+        },
+    )
+
+
+class TestWindows(unittest.TestCase):
+    def test_parse_wav(self):
+        wav = parse_wav(wav_file(2))
+
+        self.assertEqual((wav.sample_rate, wav.block_align), (100, 2))
+        self.assertEqual((wav.data_offset, wav.data_size), (44, 400))
+        self.assertEqual(wav.duration, 2)
+
+    def test_not_a_wav_file(self):
+        with self.assertRaises(ValueError):
+            parse_wav(b"RIFF\0\0\0\0AVI LIST")
+
+    def test_windows_overlap(self):
+        wav = parse_wav(wav_file(2.5))
+
+        self.assertEqual(
+            windows(wav, 1, 0.5),
+            [(0, 200), (100, 300), (200, 400), (300, 500)],
+        )
+        self.assertEqual(windows(wav, 1, 2), [(0, 200), (300, 500)])
+        self.assertEqual(windows(wav, 10, 5), [(0, 500)])
+
+    def test_window_wav(self):
+        data = wav_file(2)
+        wav = parse_wav(data)
+
+        with wave.open(io.BytesIO(window_wav(data, wav, 100, 200))) as window:
+            self.assertEqual(window.getframerate(), 100)
+            self.assertEqual(window.readframes(100), data[144:244])
+
+    def test_top_labels(self):
+        results = [
+            {"predictions": [{"label": "glass", "probability": 0.4}]},
+            {"status": "failed with 500"},
+            {
+                "predictions": [
+                    {"label": "glass", "probability": 0.9},
+                    {"label": "dog", "probability": 0.5},
+                ]
+            },
+        ]
+
+        self.assertEqual(
+            top_labels(results, 1),
+            [{"label": "glass", "probability": 0.9, "windows": 2}],
+        )
+
+
+class TestWindowedAudioAnomaly(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp() + "/"
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        with open(self.data_dir + "long.wav", "wb") as file:
+            file.write(wav_file(3))
+        self.fallback = MagicMock()
+        self.handler = WindowedAudioAnomaly(
+            Backend("audio_anomaly", 5000),
+            self.fallback,
+            self.data_dir,
+            window=1,
+            hop=1,
+            pipeline=2,
+        )
+        self.addCleanup(self.handler.close)
+        self.ws = MagicMock()
+
+    def sent(self):
+        return [message["value"] for message in sent(self.ws)]
+
+    @patch.object(BackendRequest, "send", autospec=True)
+    def test_windows_are_published(self, mock_send):
+        replies = {
+            0: reply(("dog", 0.3)),
+            100: reply(status_code=500),
+            200: reply(("glass", 0.8), ("dog", 0.6)),
+        }
+
+        def send(request):
+            # The first sample is the number of the frame
+            data = request.parts[0].data
+            return replies[int.from_bytes(data[44:46], "little")]
+
+        mock_send.side_effect = send
+
+        self.handler(self.ws, request("1", stream=True))
+
+        self.assertEqual(mock_send.call_count, 3)
+        sent_request = mock_send.call_args.args[0]
+        self.assertEqual(
+            sent_request.url,
+            "http://localhost:5000/model/predict/long.wav/m1/1/user/1",
+        )
+        audio = sent_request.parts[0]
+        self.assertEqual(
+            (audio.name, audio.filename, len(audio.data)),
+            ("audio", "window.wav", 44 + 200),
+        )
+        values = self.sent()
+        self.assertEqual([v["final"] for v in values], [False] * 3 + [True])
+        self.assertEqual(
+            [
+                (w["index"], w["start"], w["end"])
+                for w in values[-1]["timeline"]
+            ],
+            [(0, 0, 1), (1, 1, 2), (2, 2, 3)],
+        )
+        self.assertEqual(values[1]["window"]["status"], "failed with 500")
+        self.assertEqual(
+            [(p["label"], p["windows"]) for p in values[-1]["predictions"]],
+            [("glass", 1), ("dog", 2)],
+        )
+
+    @patch.object(BackendRequest, "send", autospec=True)
+    def test_invalid_predictions_fail_the_window(self, mock_send):
+        replies = {
+            0: reply(("dog", 0.3)),
+            100: test_helpers.reply(200, ["dog"]),
+            200: test_helpers.reply(200, {"predictions": None}),
+        }
+
+        def send(request):
+            data = request.parts[0].data
+            return replies[int.from_bytes(data[44:46], "little")]
+
+        mock_send.side_effect = send
+
+        self.handler(self.ws, request("1", stream=True))
+
+        values = self.sent()
+        self.assertEqual([v["final"] for v in values], [False] * 3 + [True])
+        self.assertTrue(values[1]["window"]["status"].startswith("failed"))
+        self.assertTrue(values[2]["window"]["status"].startswith("failed"))
+        self.assertEqual(
+            [(p["label"], p["windows"]) for p in values[-1]["predictions"]],
+            [("dog", 1)],
+        )
+
+    @patch.object(BackendRequest, "send", autospec=True)
+    def test_requests_share_the_pool(self, mock_send):
+        mock_send.return_value = reply(("dog", 0.3))
+        executor = self.handler.executor()
+
+        self.handler(self.ws, request("1", stream=True))
+        self.handler(self.ws, request("2", stream=True))
+
+        self.assertIs(self.handler.executor(), executor)
+        self.assertEqual(mock_send.call_count, 6)
+        self.handler.pipeline = 3
+        self.assertIsNot(self.handler.executor(), executor)
+
+    def test_request_without_stream(self):
+        self.handler(self.ws, request("1"))
+
+        self.fallback.assert_called_once_with(self.ws, request("1"))
+        self.assertIs(
+            self.handler.build(request("2")), self.fallback.build.return_value
+        )
+        self.assertIsNone(self.handler.build(request("3", stream=True)))
+
+    @patch.object(BackendRequest, "send", autospec=True)
+    def test_invalid_recording(self, mock_send):
+        with open(self.data_dir + "long.wav", "wb") as file:
+            file.write(b"not a recording")
+
+        with self.assertLogs(audio_windows.log, "WARNING"):
+            self.handler(self.ws, request("1", stream=True))
+
+        mock_send.assert_not_called()
+        self.ws.send.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
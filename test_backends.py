@@ -0,0 +1,308 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from requests.models import RequestEncodingMixin
+
+import backends
+from backends import (
+    Backend,
+    BackendRequest,
+    Content,
+    FallbackHandler,
+    Field,
+    MultipartEncoder,
+    Upload,
+)
+
+
+class TestBackend(unittest.TestCase):
+    def setUp(self):
+        self.backend = Backend("whisper", 5040, pool_size=2)
+
+    def tearDown(self):
+        self.backend.close()
+
+    def test_url(self):
+        self.assertEqual(
+            self.backend.url("whisper", "a.wav", 1, "user", "req"),
+            "http://localhost:5040/whisper/a.wav/1/user/req",
+        )
+
+    def test_session_is_shared(self):
+        session = self.backend.session
+
+        self.assertIs(self.backend.session, session)
+        adapter = session.get_adapter("http://localhost:5040")
+        self.assertEqual(adapter._pool_maxsize, 2)
+
+    @patch("requests.Session.request")
+    def test_default_timeout(self, mock_request):
+        self.backend.post("http://localhost:5040/whisper", data=b"x")
+
+        mock_request.assert_called_once_with(
+            "POST",
+            "http://localhost:5040/whisper",
+            data=b"x",
+            timeout=(
+                backends.DEFAULT_CONNECT_TIMEOUT,
+                backends.DEFAULT_READ_TIMEOUT,
+            ),
+        )
+
+    @patch("requests.Session.request")
+    def test_explicit_timeout(self, mock_request):
+        self.backend.get("http://localhost:5040/", timeout=1)
+
+        mock_request.assert_called_once_with(
+            "GET", "http://localhost:5040/", timeout=1
+        )
+
+    def test_configure(self):
+        session = self.backend.session
+
+        self.backend.configure(pool_size=8, read_timeout=10)
+
+        self.assertIsNot(self.backend.session, session)
+        self.assertEqual(self.backend.timeout, (3.05, 10))
+        with self.assertRaises(AttributeError):
+            self.backend.configure(unknown=1)
+
+    def test_missing_endpoint_is_remembered(self):
+        self.backend.check_endpoint("batch", 200)
+        self.assertTrue(self.backend.has_endpoint("batch"))
+
+        with self.assertLogs(backends.log, "INFO"):
+            with self.assertRaises(backends.MissingEndpoint):
+                self.backend.check_endpoint("batch", 404)
+
+        self.assertFalse(self.backend.has_endpoint("batch"))
+        self.assertTrue(self.backend.has_endpoint("stream"))
+        self.backend.configure(host="10.0.0.1")
+        self.assertTrue(self.backend.has_endpoint("batch"))
+
+
+class TestNetspotBackends(unittest.TestCase):
+    def test_netspot_backend_is_reused(self):
+        backend = backends.netspot("127.0.0.1", "2000")
+
+        self.assertIs(backends.netspot("127.0.0.1", 2000), backend)
+        self.assertEqual(backend.base_url, "http://127.0.0.1:2000")
+
+
+class TestBackendRequest(unittest.TestCase):
+    def setUp(self):
+        file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
+        file.write(b"audio")
+        file.close()
+        self.path = file.name
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    @patch("requests.Session.request")
+    def test_send_multipart(self, mock_request):
+        backend = Backend("face_recognition", 8090)
+        request = BackendRequest(
+            backend,
+            "POST",
+            backend.url("check_directory"),
+            parts=(Upload("file", self.path), Field("path", "/db")),
+        )
+
+        def consume(*args, **kwargs):
+            b"".join(kwargs["data"])
+            return MagicMock(status_code=200)
+
+        mock_request.side_effect = consume
+
+        request.send()
+
+        body = mock_request.call_args.kwargs["data"]
+        self.assertIsInstance(body, MultipartEncoder)
+        self.assertEqual(
+            mock_request.call_args.kwargs["headers"],
+            {"Content-Type": body.content_type},
+        )
+        self.assertEqual(body.bytes_read, len(body))
+
+    @patch("urllib3.filepost.choose_boundary", return_value="boundary")
+    def test_encoder_matches_requests(self, mock_boundary):
+        files = [
+            ("file", ("a.wav", open(self.path, "rb"), "audio/wav")),
+            ("path", "/db"),
+            ("window", ("w.wav", b"window", "audio/wav")),
+        ]
+        expected, content_type = RequestEncodingMixin._encode_files(files, {})
+        files[0][1][1].close()
+        parts = (
+            Upload("file", self.path, "a.wav", "audio/wav"),
+            Field("path", "/db"),
+            Content("window", b"window", "w.wav", "audio/wav"),
+        )
+
+        for use_mmap in [False, True]:
+            with MultipartEncoder(parts, use_mmap, 2, "boundary") as body:
+                self.assertEqual(body.content_type, content_type)
+                self.assertEqual(len(body), len(expected))
+                self.assertEqual(b"".join(bytes(c) for c in body), expected)
+
+    def test_encoder_closes_files(self):
+        body = MultipartEncoder((Upload("file", self.path),))
+        file = body._segments[1]._file
+
+        body.close()
+
+        self.assertTrue(file.closed)
+
+    def test_encoder_closes_files_on_error(self):
+        with patch("backends.ExitStack.close") as mock_close:
+            with self.assertRaises(FileNotFoundError):
+                MultipartEncoder(
+                    (Upload("a", self.path), Upload("b", "/missing.wav"))
+                )
+
+        mock_close.assert_called_once()
+
+    def test_form_filename(self):
+        self.assertEqual(Upload("file", "/data/a.mp4").form_filename, "a.mp4")
+        self.assertEqual(
+            Upload("file", "/data/a.mp4", "b.mp4").form_filename, "b.mp4"
+        )
+
+
+class TestByReference(unittest.TestCase):
+    def setUp(self):
+        file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
+        file.write(b"audio")
+        file.close()
+        self.path = file.name
+        self.sent = []
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def request(self, host="localhost"):
+        backend = Backend(
+            "speaker_verification", 7070, host, by_reference=True
+        )
+        return BackendRequest(
+            backend,
+            "POST",
+            backend.url(),
+            parts=(Upload("file", self.path), Field("path", "/db")),
+        )
+
+    def respond(self, *status_codes, headers=None):
+        responses = iter(status_codes)
+
+        def request(*args, **kwargs):
+            self.sent.append(
+                (kwargs["headers"], b"".join(kwargs["data"]).decode())
+            )
+            return MagicMock(
+                status_code=next(responses), headers=headers or {}
+            )
+
+        return request
+
+    @patch("requests.Session.request")
+    def test_files_are_sent_by_reference(self, mock_request):
+        mock_request.side_effect = self.respond(200)
+
+        self.request().send()
+
+        ((headers, body),) = self.sent
+        self.assertEqual(headers[backends.REFERENCE_HEADER], "reference")
+        self.assertIn(os.path.abspath(self.path), body)
+        self.assertIn(backends.file_digest(self.path), body)
+        self.assertIn('name="file_filename"', body)
+        self.assertIn("/db", body)
+        self.assertNotIn("audio", body)
+
+    @patch("requests.Session.request")
+    def test_remote_backend_gets_uploads(self, mock_request):
+        mock_request.side_effect = self.respond(200)
+
+        self.request("10.0.0.1").send()
+
+        ((headers, body),) = self.sent
+        self.assertNotIn(backends.REFERENCE_HEADER, headers)
+        self.assertIn("audio", body)
+
+    @patch("requests.Session.request")
+    def test_rejected_reference_is_uploaded(self, mock_request):
+        mock_request.side_effect = self.respond(415, 200)
+        request = self.request()
+
+        with self.assertLogs(backends.log, "WARNING"):
+            response = request.send()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.sent), 2)
+        self.assertIn("audio", self.sent[1][1])
+        self.assertFalse(request.backend.by_reference)
+
+    @patch("requests.Session.request")
+    def test_invalid_request_keeps_references(self, mock_request):
+        mock_request.side_effect = self.respond(400)
+        request = self.request()
+
+        response = request.send()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.sent), 1)
+        self.assertTrue(request.backend.by_reference)
+
+    @patch("requests.Session.request")
+    def test_upload_header_is_uploaded(self, mock_request):
+        mock_request.side_effect = self.respond(
+            400, 200, headers={backends.REFERENCE_HEADER: "upload"}
+        )
+        request = self.request()
+
+        with self.assertLogs(backends.log, "WARNING"):
+            response = request.send()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("audio", self.sent[1][1])
+        self.assertFalse(request.backend.by_reference)
+
+    def test_file_digest(self):
+        self.assertEqual(
+            backends.file_digest(self.path),
+            hashlib.sha256(b"audio").hexdigest(),
+        )
+        with open(self.path, "ab") as file:
+            file.write(b" file")
+
+        self.assertEqual(
+            backends.file_digest(self.path),
+            hashlib.sha256(b"audio file").hexdigest(),
+        )
+
+
+class TestFallbackHandler(unittest.TestCase):
+    def test_handles_is_required(self):
+        class Handler(FallbackHandler):
+            pass
+
+        with self.assertRaises(TypeError):
+            Handler()
+
+    def test_build_delegates_to_fallback(self):
+        class Handler(FallbackHandler):
+            fallback = MagicMock()
+
+            def handles(self, value):
+                return value["own"]
+
+        handler = Handler()
+
+        self.assertIsNone(handler.build({"own": True}))
+        self.assertIs(
+            handler.build({"own": False}),
+            Handler.fallback.build.return_value,
+        )
@@ -0,0 +1,189 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import camera
+import test_helpers
+from backends import Backend
+from camera import CameraSessions, frame_message
+from test_helpers import sent, stream
+
+
+def request(request_id, **fields):
+    return test_helpers.request(
+        request_id,
+        cam_link="rtsp:camera1",
+        database_path="/db",
+        privacy_parameter=1,
+        **fields,
+    )
+
+
+class TestCameraSessions(unittest.TestCase):
+    def setUp(self):
+        self.backend = Backend("face_recognition", 8090)
+        self.fallback = MagicMock()
+        self.sessions = CameraSessions(self.backend, self.fallback, 0)
+        self.ws = MagicMock()
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.sessions.stop_all()
+
+    def sent(self, ws=None):
+        return [message["value"] for message in sent(ws or self.ws)]
+
+    def wait_for_end(self):
+        for _ in range(100):
+            if not len(self.sessions):
+                return
+            time.sleep(0.01)
+        self.fail("Session did not end")
+
+    @patch("backends.Backend.request")
+    def test_frames_are_published(self, mock_request):
+        mock_request.return_value = stream(
+            [b'{"faces": ["Alice"]}', b"", b'{"faces": []}']
+        )
+
+        self.sessions(self.ws, request("1", session=True))
+        self.wait_for_end()
+
+        args, kwargs = mock_request.call_args
+        self.assertEqual(
+            args[1],
+            "http://localhost:8090/cam_face_recognition_stream/"
+            "rtsp:camera1/1/1/user/1",
+        )
+        self.assertTrue(kwargs["stream"])
+        values = self.sent()
+        self.assertEqual(
+            [(v["frame"], v.get("faces"), v["final"]) for v in values],
+            [(1, ["Alice"], False), (2, [], False), (2, None, True)],
+        )
+        self.assertEqual(values[0]["request_id"], "1")
+
+    @patch("backends.Backend.request")
+    def test_frame_rate_is_capped(self, mock_request):
+        mock_request.return_value = stream([b"{}"] * 3)
+        self.sessions.max_fps = 20
+
+        started = time.monotonic()
+        self.sessions(self.ws, request("1", session=True))
+        self.wait_for_end()
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+    @patch("backends.Backend.request")
+    def test_requests_share_a_session(self, mock_request):
+        release = threading.Event()
+
+        def lines():
+            yield b"{}"
+            release.wait(1)
+
+        response = stream(lines())
+        response.close.side_effect = release.set
+        mock_request.return_value = response
+        other = MagicMock()
+
+        self.sessions(self.ws, request("1", session=True))
+        self.sessions(other, request("2", session=True))
+        self.sessions(other, request("2", stop=True))
+        self.assertEqual(len(self.sessions), 1)
+
+        self.sessions(self.ws, request("1", stop=True))
+        self.wait_for_end()
+
+        mock_request.assert_called_once()
+        self.assertTrue(self.sent()[-1]["final"])
+
+    @patch("backends.Backend.request")
+    def test_stop_without_subscription(self, mock_request):
+        release = threading.Event()
+
+        def lines():
+            yield b"{}"
+            release.wait(1)
+
+        response = stream(lines())
+        response.close.side_effect = release.set
+        mock_request.return_value = response
+
+        self.sessions(self.ws, request("1", session=True))
+        with self.assertLogs(camera.log, "INFO") as captured:
+            self.sessions(self.ws, request("2", stop=True))
+
+        self.assertIn("Not subscribed", captured.output[0])
+        self.assertEqual(len(self.sessions), 1)
+        self.assertFalse(release.is_set())
+
+    @patch("backends.Backend.request")
+    def test_stop_closes_stream(self, mock_request):
+        closed = threading.Event()
+
+        def lines():
+            yield b"{}"
+            closed.wait(1)
+
+        response = stream(lines())
+        response.close.side_effect = closed.set
+        mock_request.return_value = response
+        self.ws.send.side_effect = lambda message: self.done.set()
+
+        self.sessions(self.ws, request("1", session=True))
+        self.assertTrue(self.done.wait(1))
+        self.sessions(self.ws, request("1", stop=True))
+
+        self.assertTrue(closed.is_set())
+        self.assertEqual(len(self.sessions), 0)
+        self.assertTrue(self.sent()[-1]["final"])
+
+    @patch("backends.Backend.request")
+    def test_fallback_without_stream_endpoint(self, mock_request):
+        mock_request.return_value = stream([], 404)
+
+        self.sessions(self.ws, request("1", session=True))
+        self.wait_for_end()
+
+        self.fallback.assert_called_once_with(
+            self.ws, request("1", session=True)
+        )
+        self.sessions(self.ws, request("2", session=True))
+
+        mock_request.assert_called_once()
+        self.assertEqual(self.fallback.call_count, 2)
+        self.assertIsNone(self.sessions.build(request("3", stop=True)))
+
+    def test_request_without_session(self):
+        self.sessions(self.ws, request("1"))
+
+        self.fallback.assert_called_once_with(self.ws, request("1"))
+        self.assertEqual(len(self.sessions), 0)
+
+    def test_build_delegates_to_fallback(self):
+        self.assertIs(
+            self.sessions.build(request("1")),
+            self.fallback.build.return_value,
+        )
+        self.assertIsNone(self.sessions.build(request("2", session=True)))
+        self.assertIs(self.sessions.reply, self.fallback.reply)
+
+    def test_frame_message(self):
+        message = frame_message(
+            request("1"),
+            3,
+            {"RequestPostTopicUUID": {"value": {"faces": ["Bob"]}}},
+        )
+
+        self.assertEqual(
+            message["RequestPostTopicUUID"]["topic_name"],
+            "SIFIS:Privacy_Aware_Face_Recognition_CAM_Results",
+        )
+        value = message["RequestPostTopicUUID"]["value"]
+        self.assertEqual((value["faces"], value["frame"]), (["Bob"], 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
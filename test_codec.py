@@ -0,0 +1,45 @@
+import unittest
+
+import codec
+
+
+class TestCodec(unittest.TestCase):
+    def tearDown(self):
+        codec.use("auto")
+
+    def test_codecs_agree(self):
+        message = {
+            "RequestPostTopicUUID": {
+                "topic_name": "SIFIS:Privacy_Aware_Object_Recognition",
+                "value": {"Ω": [1, 2.5, None, True], "path": "a/b"},
+            }
+        }
+        for name, implementation in codec.CODECS.items():
+            with self.subTest(name):
+                text = implementation.dumps(message)
+                self.assertIsInstance(text, str)
+                self.assertNotIn(" ", text)
+                self.assertEqual(implementation.loads(text), message)
+                self.assertEqual(implementation.loads(text.encode()), message)
+
+    def test_use(self):
+        codec.use("json")
+        self.assertIs(codec.codec, codec.JsonCodec)
+        self.assertEqual(codec.dumps({"a": 1}), '{"a":1}')
+
+        codec.use("auto")
+        if codec.orjson is not None:
+            self.assertIs(codec.codec, codec.OrjsonCodec)
+
+        with self.assertRaises(ValueError):
+            codec.use("yaml")
+
+    @unittest.skipIf(codec.orjson is None, "orjson is not installed")
+    def test_orjson_falls_back_for_big_ints(self):
+        self.assertEqual(
+            codec.OrjsonCodec.dumps({1: 2**70}), '{"1":%d}' % 2**70
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+import deepspeech_pool
+from deepspeech_pool import DeepSpeechPool, Worker
+
+# Stand-ins for the modules of the DeepSpeech image
+DEEPSPEECH = """
+loads = 0
+
+
+class Model:
+    def __init__(self, path):
+        global loads
+        loads += 1
+        self.loads = loads
+"""
+
+RECOGNIZE = """
+import argparse
+import sys
+import time
+
+import deepspeech
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--audio")
+args = parser.parse_args()
+model = deepspeech.Model("model.pbmm")
+if args.audio == "fail.wav":
+    print("no such file", file=sys.stderr)
+    sys.exit(1)
+if args.audio == "slow.wav":
+    time.sleep(5)
+print(args.audio, model.loads)
+"""
+
+
+def completed(returncode=0, stdout=b"", stderr=b""):
+    return MagicMock(returncode=returncode, stdout=stdout, stderr=stderr)
+
+
+class TestDeepSpeechPool(unittest.TestCase):
+    def setUp(self):
+        modules = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, modules)
+        for name, source in [
+            ("deepspeech.py", DEEPSPEECH),
+            ("recognize_wavFile_Func.py", RECOGNIZE),
+        ]:
+            with open(os.path.join(modules, name), "w") as file:
+                file.write(source)
+        # The worker runs here instead of in a container
+        command = self.command = Worker.command
+        patchers = [
+            patch.dict(os.environ, {"PYTHONPATH": modules}),
+            patch.object(
+                Worker,
+                "command",
+                lambda worker: (sys.executable,) + command(worker)[5:],
+            ),
+            patch("deepspeech_pool.subprocess.run", return_value=completed()),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.run_mock = deepspeech_pool.subprocess.run
+
+    def pool(self, **kwargs):
+        pool = DeepSpeechPool(**kwargs)
+        self.addCleanup(pool.stop)
+        return pool
+
+    def test_containers_started_once(self):
+        pool = self.pool(size=2)
+
+        pool.recognize("a.wav")
+        pool.recognize("b.wav")
+
+        commands = [call.args[0][1] for call in self.run_mock.call_args_list]
+        self.assertEqual(commands.count("run"), 2)
+        names = {
+            call.args[0][call.args[0].index("--name") + 1]
+            for call in self.run_mock.call_args_list
+            if call.args[0][1] == "run"
+        }
+        self.assertEqual(len(names), 2)
+
+    def test_model_is_loaded_once(self):
+        pool = self.pool()
+
+        self.assertEqual(pool.recognize("a.wav"), b"a.wav 1\n")
+        self.assertEqual(pool.recognize("b.wav"), b"b.wav 1\n")
+
+    def test_worker_command(self):
+        args = self.command(Worker("container_0"))
+
+        self.assertEqual(
+            args[:7],
+            ("docker", "exec", "-i", "container_0", "python", "-u", "-c"),
+        )
+
+    def test_failed_recognition_keeps_worker(self):
+        pool = self.pool()
+
+        with self.assertLogs(deepspeech_pool.log, "WARNING"):
+            self.assertIsNone(pool.recognize("fail.wav"))
+        self.assertEqual(pool.recognize("a.wav"), b"a.wav 1\n")
+
+    def test_worker_is_restarted(self):
+        pool = self.pool()
+        pool.recognize("a.wav")
+
+        worker = pool._workers[0]
+        worker.process.kill()
+        worker.process.wait()
+
+        self.assertEqual(pool.recognize("b.wav"), b"b.wav 1\n")
+
+    def test_timeout_stops_worker(self):
+        pool = self.pool(timeout=0.2)
+
+        with self.assertLogs(deepspeech_pool.log, "WARNING"):
+            self.assertIsNone(pool.recognize("slow.wav"))
+
+        self.assertIsNone(pool._workers[0].process)
+        pool.timeout = 5
+        self.assertEqual(pool.recognize("a.wav"), b"a.wav 1\n")
+
+    def test_docker_missing(self):
+        self.run_mock.side_effect = FileNotFoundError
+
+        self.assertIsNone(self.pool().recognize("a.wav"))
+
+    def test_busy_container_is_not_shared(self):
+        release = threading.Event()
+        running = []
+
+        def recognize(worker, audio, timeout):
+            running.append(worker.container)
+            release.wait(1)
+            return {"returncode": 0, "stdout": ""}
+
+        pool = self.pool(size=1)
+        pool.start()
+        with patch.object(Worker, "recognize", recognize):
+            threads = [
+                threading.Thread(target=pool.recognize, args=("a.wav",))
+                for _ in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            threads[0].join(0.1)
+
+            self.assertEqual(len(running), 1)
+            release.set()
+            for thread in threads:
+                thread.join(1)
+        self.assertEqual(len(running), 2)
+
+    def test_stop(self):
+        pool = self.pool(size=2)
+        pool.recognize("a.wav")
+        process = pool._workers[0].process
+        self.run_mock.reset_mock()
+
+        pool.stop()
+
+        self.assertIsNotNone(process.poll())
+        self.assertEqual(
+            [call.args[0][:2] for call in self.run_mock.call_args_list],
+            [("docker", "rm")] * 2,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+import base64
+import json
+import struct
+import threading
+import unittest
+from unittest.mock import MagicMock, call, patch
+
+import device_anomaly
+import test_helpers
+from backends import Backend
+from device_anomaly import BatchHandler, batch_body, pack_series, unpack_series
+
+
+def request(request_id, temperatures=(20.5, 21.0)):
+    return test_helpers.request(request_id, Temperatures=list(temperatures))
+
+
+def result(request_id):
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": "SIFIS:Privacy_Aware_Device_Anomaly_Detection_Results",
+            "value": {"request_id": request_id, "anomaly": False},
+        }
+    }
+
+
+def reply(status_code=200, results=()):
+    return test_helpers.reply(status_code, {"results": list(results)})
+
+
+class TestPacking(unittest.TestCase):
+    def test_round_trip(self):
+        series = [[20.5, 21.0, 22.25], [], [-1.5]]
+
+        text, lengths = pack_series(series)
+
+        self.assertEqual(lengths, [3, 0, 1])
+        self.assertEqual(unpack_series(text, lengths), series)
+
+    @patch.object(device_anomaly, "numpy", None)
+    def test_without_numpy(self):
+        text, lengths = pack_series([[1.0, 2.0]])
+
+        self.assertEqual(base64.b64decode(text), struct.pack("<2f", 1.0, 2.0))
+        self.assertEqual(lengths, [2])
+
+    def test_batch_body(self):
+        body = batch_body([request("1"), request("2", [3.0])], [[1.0], [3.0]])
+
+        self.assertEqual(body["dtype"], "<f4")
+        self.assertEqual(
+            [(r["request_id"], r["length"]) for r in body["requests"]],
+            [("1", 1), ("2", 1)],
+        )
+
+
+class TestBatchHandler(unittest.TestCase):
+    def setUp(self):
+        self.backend = Backend("device_anomaly", 9090)
+        self.fallback = MagicMock()
+        self.ws = MagicMock()
+
+    def handler(self, **kwargs):
+        return BatchHandler(self.backend, self.fallback, **kwargs)
+
+    def sent(self):
+        return [
+            message["value"]["request_id"]
+            for message in test_helpers.sent(self.ws)
+        ]
+
+    @patch("requests.Session.request")
+    def test_full_batch_is_sent(self, mock_request):
+        mock_request.return_value = reply(results=[result("2"), result("1")])
+        handler = self.handler(window=60, max_batch=2)
+
+        handler(self.ws, request("1"))
+        mock_request.assert_not_called()
+        handler(self.ws, request("2", ["30", 31]))
+
+        mock_request.assert_called_once()
+        args, kwargs = mock_request.call_args
+        self.assertEqual(
+            args[:2], ("POST", "http://localhost:9090/temperature_batch")
+        )
+        body = json.loads(kwargs["data"])
+        self.assertEqual(
+            unpack_series(
+                body["temperatures"], [r["length"] for r in body["requests"]]
+            ),
+            [[20.5, 21.0], [30.0, 31.0]],
+        )
+        self.assertEqual(self.sent(), ["1", "2"])
+
+    @patch("requests.Session.request")
+    def test_batch_is_sent_after_window(self, mock_request):
+        done = threading.Event()
+        mock_request.return_value = reply(results=[result("1")])
+        self.ws.send.side_effect = lambda message: done.set()
+        handler = self.handler(window=0.01)
+
+        handler(self.ws, request("1"))
+
+        self.assertTrue(done.wait(1))
+        self.assertEqual(self.sent(), ["1"])
+
+    @patch("requests.Session.request")
+    def test_missing_result(self, mock_request):
+        mock_request.return_value = reply(results=[result("1")])
+        handler = self.handler(window=60)
+        handler(self.ws, request("1"))
+        handler(self.ws, request("2"))
+
+        with self.assertLogs(device_anomaly.log, "WARNING"):
+            handler.flush()
+
+        self.assertEqual(self.sent(), ["1"])
+
+    @patch("requests.Session.request")
+    def test_fallback_without_batch_endpoint(self, mock_request):
+        mock_request.return_value = reply(404)
+        handler = self.handler(window=60)
+        handler(self.ws, request("1"))
+
+        handler.flush()
+        handler(self.ws, request("2"))
+
+        self.assertEqual(
+            self.fallback.call_args_list,
+            [call(self.ws, request("1")), call(self.ws, request("2"))],
+        )
+        mock_request.assert_called_once()
+        self.ws.send.assert_not_called()
+
+    @patch("requests.Session.request")
+    def test_failed_fallback_is_logged(self, mock_request):
+        mock_request.return_value = reply(404)
+        self.fallback.side_effect = [ValueError("invalid response"), None]
+        handler = self.handler(window=60)
+        handler(self.ws, request("1"))
+        handler(self.ws, request("2"))
+
+        with self.assertLogs(device_anomaly.log, "ERROR") as logged:
+            handler.flush()
+
+        self.assertEqual(self.fallback.call_count, 2)
+        self.assertEqual(
+            [record.fields["request_id"] for record in logged.records], ["1"]
+        )
+
+    @patch("requests.Session.request")
+    def test_failed_send_is_logged(self, mock_request):
+        mock_request.return_value = reply(results=[result("1"), result("2")])
+        self.ws.send.side_effect = [OSError("closed"), None]
+        handler = self.handler(window=60)
+        handler(self.ws, request("1"))
+        handler(self.ws, request("2"))
+
+        with self.assertLogs(device_anomaly.log, "ERROR"):
+            handler.flush()
+
+        self.assertEqual(self.sent(), ["1", "2"])
+
+    @patch("requests.Session.request")
+    def test_invalid_temperatures(self, mock_request):
+        handler = self.handler(window=60)
+
+        with self.assertLogs(device_anomaly.log, "WARNING"):
+            handler(self.ws, request("1", ["hot"]))
+        handler.flush()
+
+        mock_request.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
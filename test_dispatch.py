@@ -0,0 +1,159 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import dispatch
+from dispatch import Dispatcher, LockedSender
+
+
+class TestLockedSender(unittest.TestCase):
+    def test_send_and_attributes(self):
+        ws = MagicMock()
+        ws.url = "ws://localhost:3000/ws"
+        sender = LockedSender(ws, threading.Lock())
+
+        sender.send("message")
+
+        ws.send.assert_called_once_with("message")
+        self.assertEqual(sender.url, "ws://localhost:3000/ws")
+
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.ws = MagicMock()
+        self.dispatcher = Dispatcher(
+            max_workers=4, topic_limits={"slow": 1}, default_limit=2
+        )
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+
+    def test_handler_receives_locked_sender(self):
+        done = threading.Event()
+
+        def handler(ws, value):
+            ws.send(value)
+            done.set()
+
+        self.dispatcher.submit("fast", handler, self.ws, "result")
+
+        self.assertTrue(done.wait(1))
+        self.ws.send.assert_called_once_with("result")
+
+    def test_topic_limit(self):
+        release = threading.Event()
+        started = []
+
+        def handler(ws, number):
+            started.append(number)
+            release.wait(1)
+
+        for number in range(3):
+            self.dispatcher.submit("slow", handler, self.ws, number)
+        time.sleep(0.1)
+
+        self.assertEqual(started, [0])
+        self.assertEqual(self.dispatcher.running("slow"), 1)
+        self.assertEqual(self.dispatcher.pending("slow"), 2)
+
+        release.set()
+        self.dispatcher.shutdown()
+        self.assertEqual(started, [0, 1, 2])
+
+    def test_slow_topic_does_not_block_others(self):
+        release = threading.Event()
+        done = threading.Event()
+
+        self.dispatcher.submit("slow", lambda ws: release.wait(1), self.ws)
+        self.dispatcher.submit("fast", lambda ws: done.set(), self.ws)
+
+        self.assertTrue(done.wait(0.5))
+        release.set()
+
+    def test_handler_exception_frees_slot(self):
+        done = threading.Event()
+
+        def failing(ws):
+            raise RuntimeError("failure")
+
+        with self.assertLogs(dispatch.log, "ERROR") as logged:
+            self.dispatcher.submit("slow", failing, self.ws)
+            self.dispatcher.submit("slow", lambda ws: done.set(), self.ws)
+
+            self.assertTrue(done.wait(1))
+            self.dispatcher.shutdown()
+        self.assertEqual(self.dispatcher.running("slow"), 0)
+        self.assertEqual(logged.records[0].fields["topic"], "slow")
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.ws = MagicMock()
+        self.release = threading.Event()
+        self.started = []
+        self.rejected = []
+        self.dispatcher = Dispatcher(
+            max_workers=1,
+            default_limit=1,
+            priorities={"alarm": 0, "video": 2},
+            on_reject=self.on_reject,
+        )
+        self.dispatcher.submit("busy", self.handler, self.ws, "busy")
+
+    def tearDown(self):
+        self.release.set()
+        self.dispatcher.shutdown()
+
+    def handler(self, ws, name):
+        self.started.append(name)
+        self.release.wait(1)
+
+    def on_reject(self, topic, reason, ws, name):
+        self.rejected.append((topic, reason, name))
+
+    def test_priority_order(self):
+        self.dispatcher.submit("video", self.handler, self.ws, "video")
+        self.dispatcher.submit("audio", self.handler, self.ws, "audio")
+        self.dispatcher.submit("alarm", self.handler, self.ws, "alarm 1")
+        self.dispatcher.submit("alarm", self.handler, self.ws, "alarm 2")
+        self.assertEqual(self.dispatcher.queued(), 4)
+
+        self.release.set()
+        self.dispatcher.shutdown()
+
+        self.assertEqual(
+            self.started, ["busy", "alarm 1", "alarm 2", "audio", "video"]
+        )
+
+    def test_full_queue_sheds_lowest_priority(self):
+        self.dispatcher.max_pending = 2
+        self.dispatcher.submit("video", self.handler, self.ws, "video")
+        self.dispatcher.submit("audio", self.handler, self.ws, "audio 1")
+        self.dispatcher.submit("alarm", self.handler, self.ws, "alarm")
+        self.dispatcher.submit("audio", self.handler, self.ws, "audio 2")
+
+        self.assertEqual(
+            self.rejected,
+            [
+                ("video", dispatch.QUEUE_FULL, "video"),
+                ("audio", dispatch.QUEUE_FULL, "audio 2"),
+            ],
+        )
+        self.assertEqual(
+            self.dispatcher.rejected[("video", dispatch.QUEUE_FULL)], 1
+        )
+        self.release.set()
+        self.dispatcher.shutdown()
+        self.assertEqual(self.started, ["busy", "alarm", "audio 1"])
+
+    def test_deadline(self):
+        self.dispatcher.deadline = 0.05
+        self.dispatcher.submit("audio", self.handler, self.ws, "old")
+        time.sleep(0.1)
+        self.dispatcher.submit("audio", self.handler, self.ws, "new")
+
+        self.assertEqual(self.rejected, [("audio", dispatch.DEADLINE, "old")])
+        self.release.set()
+        self.dispatcher.shutdown()
+        self.assertEqual(self.started, ["busy", "new"])
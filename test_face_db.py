@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import face_db
+from face_db import FaceDatabaseIndex, manifest_version, scan
+
+
+class TestFaceDatabaseIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.database = os.path.join(self.root, "faces")
+        os.makedirs(os.path.join(self.database, "alice"))
+        self.write("alice/1.jpg", b"alice")
+        self.write("bob.jpg", b"bob")
+        self.index = FaceDatabaseIndex(self.root, check_interval=0)
+
+    def write(self, name, data):
+        path = os.path.join(self.database, name)
+        with open(path, "wb") as file:
+            file.write(data)
+        return path
+
+    def test_version_changes_with_the_files(self):
+        version = self.index.refresh("faces")
+
+        self.assertEqual(self.index.refresh("faces"), version)
+        path = self.write("bob.jpg", b"robert")
+        os.utime(path, ns=(0, 0))
+        self.assertNotEqual(self.index.refresh("faces"), version)
+
+    def test_absolute_path(self):
+        self.assertEqual(
+            self.index.refresh(self.database), self.index.refresh("faces")
+        )
+
+    def test_version_is_indexed_in_the_background(self):
+        threads = []
+
+        def record(*args):
+            threads.append(threading.current_thread())
+            return scan(*args)
+
+        with patch.object(face_db, "scan", record):
+            self.assertIsNone(self.index.version("faces"))
+            self.index.join()
+
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(
+            self.index.version("faces"), self.index.refresh("faces")
+        )
+
+    def test_unreadable_files_are_skipped(self):
+        os.symlink(
+            os.path.join(self.root, "missing"),
+            os.path.join(self.database, "dangling.jpg"),
+        )
+
+        self.assertEqual(
+            sorted(scan(self.database)), ["alice/1.jpg", "bob.jpg"]
+        )
+
+    def test_unchanged_files_are_not_hashed_again(self):
+        files = scan(self.database)
+
+        with patch.object(face_db, "_sha256") as mock_sha256:
+            self.assertEqual(scan(self.database, files), files)
+
+        mock_sha256.assert_not_called()
+
+    def test_version_is_checked_after_interval(self):
+        self.index.check_interval = 60
+        version = self.index.refresh("faces")
+        self.write("carol.jpg", b"carol")
+
+        self.assertEqual(self.index.version("faces"), version)
+        self.index.join()
+        self.assertEqual(self.index.version("faces"), version)
+        self.index.check_interval = 0
+        self.assertEqual(self.index.version("faces"), version)
+        self.index.join()
+        self.assertNotEqual(self.index.version("faces"), version)
+
+    def test_paths_outside_root_are_refused(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+
+        for path in [outside, "../" + os.path.basename(outside), "/etc"]:
+            with self.subTest(path=path):
+                self.assertIsNone(self.index.version(path))
+                self.assertIsNone(self.index.refresh(path))
+        os.symlink(outside, os.path.join(self.root, "link"))
+        self.assertIsNone(self.index.refresh("link"))
+        self.index.join()
+        self.assertEqual(self.index._manifests, {})
+
+        with self.assertLogs(face_db.log, "INFO"):
+            self.index.warm([outside])
+        self.assertIsNotNone(self.index.refresh(outside))
+
+    def test_missing_database(self):
+        self.assertIsNone(self.index.refresh("missing"))
+        self.assertIsNone(self.index.version("missing"))
+
+    def test_warm(self):
+        with patch.object(face_db, "scan", wraps=scan) as mock_scan:
+            self.index.check_interval = 60
+            with self.assertLogs(face_db.log, "WARNING"):
+                self.index.warm(["faces", "missing"])
+            self.index.version("faces")
+
+        mock_scan.assert_called_once()
+
+    def test_manifest_version(self):
+        self.assertEqual(
+            manifest_version({"a": (1, 2, "x"), "b": (3, 4, "y")}),
+            manifest_version({"b": (5, 6, "y"), "a": (7, 8, "x")}),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
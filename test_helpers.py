@@ -0,0 +1,36 @@
+"""Requests, responses and sent messages shared by the handler tests"""
+import json
+from unittest.mock import MagicMock
+
+
+def request(request_id, **fields):
+    """Returns the value of a request of requestor 1 with the *fields*"""
+    return dict(
+        requestor_id="1",
+        requestor_type="user",
+        request_id=request_id,
+        **fields
+    )
+
+
+def reply(status_code=200, content=None):
+    """Returns a backend response with *content* as JSON"""
+    response = MagicMock(status_code=status_code, headers={})
+    response.content = json.dumps(content).encode()
+    return response
+
+
+def stream(lines, status_code=200):
+    """Returns a streamed backend response of the *lines*"""
+    response = reply(status_code)
+    response.iter_lines.return_value = lines
+    response.__enter__.return_value = response
+    return response
+
+
+def sent(ws):
+    """Returns the RequestPostTopicUUID of the messages sent to *ws*"""
+    return [
+        json.loads(call.args[0])["RequestPostTopicUUID"]
+        for call in ws.send.call_args_list
+    ]
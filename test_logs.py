@@ -0,0 +1,97 @@
+import io
+import json
+import logging
+import queue
+import unittest
+
+import logs
+
+
+class TestPayload(unittest.TestCase):
+    def tearDown(self):
+        logs.echo_payloads = True
+        logs.max_payload = logs.DEFAULT_MAX_PAYLOAD
+
+    def test_truncated(self):
+        logs.max_payload = 4
+
+        self.assertEqual(str(logs.payload("abcdefgh")), "abcd... (8 total)")
+        self.assertEqual(str(logs.payload(b"abcdefgh")), "abcd... (8 total)")
+        self.assertEqual(str(logs.payload({"a": 1})), "{'a'... (8 total)")
+        self.assertEqual(str(logs.payload("abc")), "abc")
+
+    def test_echo_off(self):
+        logs.echo_payloads = False
+
+        self.assertIsNone(logs.payload("abc"))
+
+
+def record(level=logging.INFO, topic=None):
+    item = logging.LogRecord("analytics_api", level, "", 0, "text", (), None)
+    item.fields = {"topic": topic, "request_id": "1", "value": None}
+    return item
+
+
+class TestFormatters(unittest.TestCase):
+    def test_text(self):
+        text = logs.TextFormatter().format(record())
+
+        self.assertTrue(text.endswith("INFO analytics_api: text request_id=1"))
+
+    def test_json(self):
+        data = json.loads(logs.JsonFormatter().format(record()))
+
+        self.assertEqual(data["level"], "INFO")
+        self.assertEqual(data["message"], "text")
+        self.assertEqual(data["request_id"], "1")
+        self.assertNotIn("value", data)
+
+
+class TestSamplingFilter(unittest.TestCase):
+    def test_one_of_n(self):
+        sampling = logs.SamplingFilter({"busy": 3})
+
+        passed = [sampling.filter(record(topic="busy")) for _ in range(6)]
+
+        self.assertEqual(passed, [True, False, False, True, False, False])
+        self.assertTrue(sampling.filter(record(topic="other")))
+        self.assertTrue(sampling.filter(record(logging.WARNING, "busy")))
+
+
+class TestDroppingQueueHandler(unittest.TestCase):
+    def test_full_queue_drops(self):
+        handler = logs.DroppingQueueHandler(queue.Queue(1))
+
+        handler.handle(record())
+        handler.handle(record())
+
+        self.assertEqual(handler.queue.qsize(), 1)
+        self.assertEqual(handler.dropped, 1)
+
+
+class TestSetup(unittest.TestCase):
+    def tearDown(self):
+        logs.shutdown()
+        logs.log.handlers = []
+        logs.log.propagate = True
+        logs.log.setLevel(logging.NOTSET)
+        logs.echo_payloads = True
+
+    def test_records_are_written_in_background(self):
+        stream = io.StringIO()
+        logs.setup("INFO", "json", stream=stream, echo=False)
+
+        logs.get_logger("netspot").info("alarms", extra=logs.fields(count=2))
+        logs.log.debug("not written")
+        logs.shutdown()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        data = json.loads(lines[0])
+        self.assertEqual(data["logger"], "analytics_api.netspot")
+        self.assertEqual(data["count"], 2)
+        self.assertFalse(logs.echo_payloads)
+
+
+if __name__ == "__main__":
+    unittest.main()
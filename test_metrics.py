@@ -0,0 +1,140 @@
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import MagicMock, patch
+
+import requests
+
+import metrics
+from backends import Backend
+from metrics import (
+    CallbackGauge,
+    Counter,
+    Gauge,
+    Histogram,
+    Instrumented,
+    Registry,
+)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_exposition(self):
+        registry = Registry()
+        counter = registry.register(
+            Counter("requests_total", "Requests", ("topic",))
+        )
+        gauge = registry.register(Gauge("running", "Running"))
+        counter.inc("a")
+        counter.inc('b"\n', amount=2)
+        gauge.set(value=1.5)
+
+        self.assertEqual(
+            registry.exposition(),
+            "# HELP requests_total Requests\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{topic="a"} 1\n'
+            'requests_total{topic="b\\"\\n"} 2\n'
+            "# HELP running Running\n"
+            "# TYPE running gauge\n"
+            "running 1.5\n",
+        )
+
+    def test_histogram_buckets(self):
+        histogram = Histogram("latency", "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value=value)
+
+        self.assertEqual(
+            histogram.samples(),
+            [
+                ("_bucket", {"le": "0.1"}, 2),
+                ("_bucket", {"le": "1"}, 3),
+                ("_bucket", {"le": "+Inf"}, 4),
+                ("_count", {}, 4),
+                ("_sum", {}, 2.65),
+            ],
+        )
+        self.assertEqual(histogram.count(), 4)
+
+    def test_callback_gauge(self):
+        gauge = CallbackGauge(
+            "lag", "Lag", ("netspot",), lambda: {("a",): 1.0, ("b",): None}
+        )
+
+        self.assertEqual(gauge.samples(), [("", {"netspot": "a"}, 1.0)])
+
+
+class TestHandling(unittest.TestCase):
+    def setUp(self):
+        for metric in (metrics.errors, metrics.handler_seconds):
+            metric.clear()
+
+    def test_handler_is_measured(self):
+        def handler(ws, value):
+            self.assertEqual(metrics.in_flight.value("topic"), 1)
+            return value
+
+        self.assertEqual(Instrumented("topic", handler)(None, 1), 1)
+
+        self.assertEqual(metrics.in_flight.value("topic"), 0)
+        self.assertEqual(metrics.handler_seconds.count("topic"), 1)
+        self.assertEqual(metrics.errors.value("topic"), 0)
+
+    def test_error_is_counted(self):
+        with self.assertRaises(ValueError):
+            with metrics.handling("topic"):
+                raise ValueError
+
+        self.assertEqual(metrics.in_flight.value("topic"), 0)
+        self.assertEqual(metrics.errors.value("topic"), 1)
+
+
+class TestBackendMetrics(unittest.TestCase):
+    def setUp(self):
+        for metric in (metrics.backend_requests, metrics.backend_seconds):
+            metric.clear()
+
+    @patch("requests.Session.request")
+    def test_requests_are_counted(self, mock_request):
+        backend = Backend("whisper", 8000)
+        mock_request.return_value = MagicMock(status_code=200)
+        backend.get(backend.url())
+        mock_request.side_effect = requests.ConnectionError
+        with self.assertRaises(requests.ConnectionError):
+            backend.get(backend.url())
+
+        self.assertEqual(metrics.backend_requests.value("whisper", "200"), 1)
+        self.assertEqual(metrics.backend_requests.value("whisper", "error"), 1)
+        self.assertEqual(metrics.backend_seconds.count("whisper"), 2)
+
+
+class TestServe(unittest.TestCase):
+    def setUp(self):
+        self.server = metrics.serve(0)
+        address, port = self.server.server_address
+        self.url = f"http://{address}:{port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_metrics_endpoint(self):
+        metrics.messages.inc("SIFIS:Test")
+
+        with urllib.request.urlopen(f"{self.url}/metrics") as response:
+            self.assertEqual(
+                response.headers["Content-Type"], metrics.CONTENT_TYPE
+            )
+            body = response.read().decode()
+
+        self.assertIn('analytics_messages_total{topic="SIFIS:Test"} ', body)
+
+    def test_other_paths_are_not_found(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(f"{self.url}/")
+
+        self.assertEqual(context.exception.code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
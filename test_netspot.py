@@ -0,0 +1,301 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+
+import requests
+
+import netspot
+from netspot import (
+    AlarmPoller,
+    AlarmSummary,
+    CursorStore,
+    alarm_time_ns,
+    summary_message,
+)
+
+
+class TestCursorStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cursors.json")
+        self.legacy_path = os.path.join(self.directory, "last_time.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, **kwargs):
+        kwargs.setdefault("legacy_path", self.legacy_path)
+        return CursorStore(self.path, **kwargs)
+
+    def test_cursors_are_per_endpoint(self):
+        cursors = self.store()
+        cursors.advance("127.0.0.1", 2000, 100)
+        cursors.advance("127.0.0.1", "2001", 200)
+
+        self.assertEqual(cursors.get("127.0.0.1", "2000"), 100)
+        self.assertEqual(cursors.get("127.0.0.1", 2001), 200)
+        self.assertEqual(cursors.get("10.0.0.1", 2000), 0)
+        cursors.close()
+
+    def test_cursor_does_not_move_backwards(self):
+        cursors = self.store()
+        cursors.advance("127.0.0.1", 2000, 200)
+        cursors.advance("127.0.0.1", 2000, 100)
+
+        self.assertEqual(cursors.get("127.0.0.1", 2000), 200)
+        cursors.close()
+
+    def test_close_writes_cursors(self):
+        cursors = self.store(flush_interval=60)
+        cursors.advance("127.0.0.1", 2000, 100)
+        cursors.close()
+
+        with open(self.path) as file:
+            self.assertEqual(json.load(file), {"127.0.0.1:2000": 100})
+        self.assertEqual(self.store().get("127.0.0.1", 2000), 100)
+        self.assertEqual(os.listdir(self.directory), ["cursors.json"])
+
+    def test_cursors_are_written_in_background(self):
+        cursors = self.store(flush_interval=0.01)
+        cursors.advance("127.0.0.1", 2000, 100)
+        for _ in range(100):
+            if os.path.exists(self.path):
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.store().get("127.0.0.1", 2000), 100)
+        cursors.close()
+
+    def test_legacy_file_is_the_default(self):
+        with open(self.legacy_path, "w") as file:
+            file.write("12345")
+        cursors = self.store()
+
+        self.assertEqual(cursors.get("127.0.0.1", 2000), 12345)
+        cursors.advance("127.0.0.1", 2000, 100)
+        self.assertEqual(cursors.get("127.0.0.1", 2000), 12345)
+
+    def test_invalid_files_are_ignored(self):
+        for path in (self.path, self.legacy_path):
+            with open(path, "w") as file:
+                file.write("not_an_integer\n")
+
+        self.assertEqual(self.store().get("127.0.0.1", 2000), 0)
+
+    def test_memory_only(self):
+        cursors = CursorStore(None, legacy_path=None)
+        cursors.advance("127.0.0.1", 2000, 100)
+        cursors.close()
+
+        self.assertEqual(cursors.get("127.0.0.1", 2000), 100)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_lock_is_per_endpoint(self):
+        cursors = self.store()
+
+        self.assertIs(
+            cursors.lock("127.0.0.1", 2000), cursors.lock("127.0.0.1", "2000")
+        )
+        self.assertIsNot(
+            cursors.lock("127.0.0.1", 2000), cursors.lock("127.0.0.1", 2001)
+        )
+
+
+def alarm(time, probability=0.5):
+    return {
+        "stat": "R_SYN",
+        "status": "UP_ALERT",
+        "probability": probability,
+        "time": time,
+    }
+
+
+def reply(alarms, status_code=200):
+    response = Mock()
+    response.status_code = status_code
+    response.json.return_value = alarms
+    return response
+
+
+class TestAlarmPoller(unittest.TestCase):
+    def setUp(self):
+        self.cursors = CursorStore(None, legacy_path=None)
+        self.cursors.advance("127.0.0.1", 2000, 100)
+        self.poller = AlarmPoller(
+            "127.0.0.1", 2000, self.cursors, "Device", page_size=2
+        )
+        self.ws = self.poller.ws = MagicMock()
+
+    def sent(self):
+        return [
+            json.loads(call.args[0])["RequestPostTopicUUID"]["value"]
+            for call in self.ws.send.call_args_list
+        ]
+
+    @patch("requests.Session.request")
+    def test_pages_until_caught_up(self, mock_request):
+        # Netspot returns the newest alarms first
+        mock_request.side_effect = [
+            reply([alarm(400), alarm(300, 0.9)]),
+            reply([alarm(300, 0.9), alarm(250)]),
+            reply([alarm(250), alarm(200)]),
+            reply([alarm(150)]),
+        ]
+
+        self.assertEqual(self.poller.poll(), 5)
+
+        params = [call.kwargs["params"] for call in mock_request.mock_calls]
+        self.assertEqual([p["time"] for p in params], [100] * 4)
+        self.assertEqual(
+            [p.get("until") for p in params], [None, 300, 250, 200]
+        )
+        sent = self.sent()
+        self.assertEqual([value["Count"] for value in sent], [2, 1, 1, 1])
+        self.assertEqual(sent[0]["Device"], "Device")
+        self.assertEqual((sent[0]["Time"], sent[1]["Time"]), (300, 250))
+        self.assertEqual(sent[3]["Window"], 100e-9)
+        self.assertGreater(self.cursors.get("127.0.0.1", 2000), 400)
+        self.assertEqual(self.poller.stats["alarms"], 5)
+        self.assertEqual(self.poller.alarms_per_second, 5 / 60)
+        self.assertLess(self.poller.lag, 1.0)
+
+    @patch("requests.Session.request")
+    def test_alarms_of_the_same_time_span_pages(self, mock_request):
+        mock_request.side_effect = [
+            reply([alarm(300, 0.1), alarm(200, 0.2)]),
+            reply([alarm(200, 0.2), alarm(200, 0.3)]),
+            reply([alarm(200, 0.2), alarm(200, 0.3)]),
+        ]
+
+        with self.assertLogs(netspot.log, "WARNING"):
+            self.assertEqual(self.poller.poll(), 3)
+
+        self.assertEqual([value["Count"] for value in self.sent()], [2, 1])
+
+    @patch("requests.Session.request")
+    def test_cursor_waits_until_caught_up(self, mock_request):
+        mock_request.side_effect = [
+            reply([alarm(400), alarm(300)]),
+            requests.ConnectionError("down"),
+        ]
+
+        with self.assertRaises(requests.ConnectionError):
+            self.poller.poll()
+
+        self.assertEqual(self.cursors.get("127.0.0.1", 2000), 100)
+
+    @patch("requests.Session.request")
+    def test_page_without_times_ends_paging(self, mock_request):
+        mock_request.return_value = reply([alarm("?"), alarm("?")])
+
+        self.assertEqual(self.poller.poll(), 2)
+
+        mock_request.assert_called_once()
+
+    @patch("requests.Session.request")
+    def test_error_does_not_move_cursor(self, mock_request):
+        mock_request.return_value = reply([], 500)
+
+        with self.assertRaises(requests.HTTPError):
+            self.poller.poll()
+
+        self.assertEqual(self.cursors.get("127.0.0.1", 2000), 100)
+        self.ws.send.assert_not_called()
+
+    def test_adaptive_interval(self):
+        self.poller.min_interval = 1.0
+        self.poller.max_interval = 5.0
+
+        self.assertEqual(self.poller.adapt_interval(0), 2.0)
+        self.assertEqual(self.poller.adapt_interval(0), 4.0)
+        self.assertEqual(self.poller.adapt_interval(0), 5.0)
+        self.assertEqual(self.poller.adapt_interval(10), 1.0)
+
+
+class TestAlarmSummary(unittest.TestCase):
+    def test_top_k(self):
+        summary = AlarmSummary(top_k=2)
+        summary.extend(
+            alarm(time, probability)
+            for time, probability in enumerate([0.1, 0.7, 0.3, 0.7, 0.2])
+        )
+
+        # The later one of equally probable alarms first
+        self.assertEqual([a["time"] for a in summary.top()], [3, 1])
+        self.assertEqual(summary.count, 5)
+        self.assertEqual(summary.max_probability, 0.7)
+        self.assertAlmostEqual(summary.mean_probability, 0.4)
+
+    def test_groups(self):
+        summary = AlarmSummary()
+        summary.extend(
+            [
+                alarm(1, 0.2),
+                dict(alarm(2, 0.4), status="DOWN_ALERT"),
+                alarm(3, 0.6),
+            ]
+        )
+
+        self.assertEqual(
+            summary.groups(),
+            [
+                (("R_SYN", "UP_ALERT"), 2, 0.6, 0.4),
+                (("R_SYN", "DOWN_ALERT"), 1, 0.4, 0.4),
+            ],
+        )
+
+    def test_rate(self):
+        summary = AlarmSummary(since=1_000_000_000, until=3_000_000_000)
+        summary.extend([alarm(1), alarm(2)])
+
+        self.assertEqual(summary.window, 2.0)
+        self.assertEqual(summary.rate, 1.0)
+        self.assertIsNone(AlarmSummary().rate)
+
+    def test_summary_message(self):
+        summary = AlarmSummary(top_k=1, group_by=("stat",))
+        summary.extend([alarm(1, 0.2), alarm(2, 0.8)])
+
+        message = summary_message("Device", summary)
+
+        value = message["RequestPostTopicUUID"]["value"]
+        self.assertEqual(
+            message["RequestPostTopicUUID"]["topic_name"],
+            "SIFIS:Netspot_Control_Results",
+        )
+        self.assertEqual((value["Probability"], value["Time"]), (0.8, 2))
+        self.assertEqual(len(value["Top Alarms"]), 1)
+        self.assertEqual(
+            value["Groups"],
+            [
+                {
+                    "Statistic": "R_SYN",
+                    "Count": 2,
+                    "Max Probability": 0.8,
+                    "Mean Probability": 0.5,
+                }
+            ],
+        )
+
+
+class TestAlarmTime(unittest.TestCase):
+    def test_alarm_time_ns(self):
+        self.assertEqual(alarm_time_ns({"time": 123}), 123)
+        self.assertEqual(alarm_time_ns({"time": "123"}), 123)
+        self.assertEqual(
+            alarm_time_ns({"time": "1970-01-01T00:00:01.000000002Z"}),
+            1_000_000_002,
+        )
+        self.assertEqual(
+            alarm_time_ns({"time": "1970-01-01T02:00:00.5+02:00"}),
+            500_000_000,
+        )
+        self.assertIsNone(alarm_time_ns({"time": "yesterday"}))
+        self.assertIsNone(alarm_time_ns({}))
+
+
+if __name__ == "__main__":
+    unittest.main()
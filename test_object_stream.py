@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import object_stream
+import test_helpers
+from backends import Backend
+from object_stream import ObjectStreams, frame_message
+from test_helpers import sent, stream
+
+
+def request(request_id, **fields):
+    fields.setdefault("file_name", "video.mp4")
+    return test_helpers.request(
+        request_id, epsilon=0.5, sensitivity=1, **fields
+    )
+
+
+class TestObjectStreams(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        with open(os.path.join(self.data_dir, "video.mp4"), "wb") as file:
+            file.write(b"0123456789")
+        self.backend = Backend("object_recognition", 8080)
+        self.fallback = MagicMock()
+        self.streams = ObjectStreams(
+            self.backend, self.fallback, self.data_dir, chunk_size=4
+        )
+        self.ws = MagicMock()
+
+    @patch("backends.Backend.request")
+    def test_frames_are_published(self, mock_request):
+        chunks = []
+
+        def send(method, url, data, **kwargs):
+            chunks.extend(data)
+            return stream(
+                [
+                    b'{"objects": ["cat"]}',
+                    b"",
+                    b'{"frame": 5, "objects": []}',
+                    b'{"RequestPostTopicUUID": {"topic_name": "results"}}',
+                ]
+            )
+
+        mock_request.side_effect = send
+
+        self.streams(self.ws, request("1", stream=True))
+
+        args, kwargs = mock_request.call_args
+        self.assertEqual(
+            args[1],
+            "http://localhost:8080/file_object_stream/video.mp4/0.5/1/1/user/1",
+        )
+        self.assertTrue(kwargs["stream"])
+        self.assertEqual(chunks, [b"0123", b"4567", b"89"])
+        messages = sent(self.ws)
+        self.assertEqual(
+            [m["topic_name"] for m in messages],
+            [object_stream.FRAME_TOPIC] * 2
+            + ["results", object_stream.FRAME_TOPIC],
+        )
+        self.assertEqual(
+            [
+                (m["value"]["frame"], m["value"]["final"])
+                for m in messages
+                if "value" in m
+            ],
+            [(1, False), (5, False), (2, True)],
+        )
+        self.assertEqual(messages[0]["value"]["objects"], ["cat"])
+
+    @patch("backends.Backend.request")
+    def test_fallback_without_stream_endpoint(self, mock_request):
+        mock_request.return_value = stream([], 404)
+
+        self.streams(self.ws, request("1", stream=True))
+
+        self.fallback.assert_called_once_with(
+            self.ws, request("1", stream=True)
+        )
+        self.streams(self.ws, request("2", stream=True))
+
+        mock_request.assert_called_once()
+        self.assertEqual(self.fallback.call_count, 2)
+        self.ws.send.assert_not_called()
+        self.assertIs(
+            self.streams.build(request("3", stream=True)),
+            self.fallback.build.return_value,
+        )
+
+    @patch("backends.Backend.request")
+    def test_request_without_stream(self, mock_request):
+        self.streams(self.ws, request("1"))
+
+        self.fallback.assert_called_once_with(self.ws, request("1"))
+        mock_request.assert_not_called()
+        self.assertIsNone(self.streams.build(request("2", stream=True)))
+
+    @patch("backends.Backend.request")
+    def test_missing_video(self, mock_request):
+        with self.assertLogs(object_stream.log, "WARNING"):
+            self.streams(
+                self.ws, request("1", stream=True, file_name="missing.mp4")
+            )
+
+        mock_request.assert_not_called()
+        self.fallback.assert_not_called()
+
+    def test_frame_message(self):
+        message = frame_message(request("1"), 3, {"objects": ["dog"]})
+
+        value = message["RequestPostTopicUUID"]["value"]
+        self.assertEqual(
+            (value["frame"], value["objects"], value["file_name"]),
+            (3, ["dog"], "video.mp4"),
+        )
+        self.assertFalse(value["final"])
+
+
+if __name__ == "__main__":
+    unittest.main()
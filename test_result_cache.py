@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import metrics
+import result_cache
+from backends import Backend, BackendRequest, Field, Upload
+from result_cache import ResultCache
+
+TOPIC = "SIFIS:Privacy_Aware_Object_Recognition"
+
+
+def make_value(request_id, epsilon=0.5):
+    return {
+        "file_name": "video.mp4",
+        "requestor_id": "user" + request_id,
+        "requestor_type": "user",
+        "request_id": request_id,
+        "epsilon": epsilon,
+    }
+
+
+def make_message(request_id):
+    return {
+        "RequestPostTopicUUID": {
+            "topic_name": TOPIC + "_Results",
+            "value": {
+                "requestor_id": "user" + request_id,
+                "request_id": request_id,
+                "objects": ["cat"],
+            },
+        }
+    }
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "video.mp4")
+        with open(self.path, "wb") as file:
+            file.write(b"video")
+        backend = Backend("object_recognition", 8080)
+        self.request = BackendRequest(
+            backend,
+            "POST",
+            backend.url("file_object"),
+            parts=(Upload("file", self.path), Field("path", "/db")),
+        )
+        self.cache = ResultCache(max_entries=2, ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key_ignores_caller(self):
+        self.assertEqual(
+            self.cache.key(TOPIC, make_value("1"), self.request),
+            self.cache.key(TOPIC, make_value("2"), self.request),
+        )
+        self.assertNotEqual(
+            self.cache.key(TOPIC, make_value("1"), self.request),
+            self.cache.key(TOPIC, make_value("1", 0.1), self.request),
+        )
+
+    def test_key_uses_file_contents(self):
+        key = self.cache.key(TOPIC, make_value("1"), self.request)
+        with open(self.path, "wb") as file:
+            file.write(b"another video")
+
+        self.assertNotEqual(
+            self.cache.key(TOPIC, make_value("1"), self.request), key
+        )
+
+    def test_hit_is_rewritten_for_caller(self):
+        self.assertIsNone(self.cache.get("key", make_value("1")))
+        self.cache.put("key", make_message("1"))
+
+        message = self.cache.get("key", make_value("2"))
+
+        result = message["RequestPostTopicUUID"]["value"]
+        self.assertEqual(result["request_id"], "2")
+        self.assertEqual(result["requestor_id"], "user2")
+        self.assertEqual(result["objects"], ["cat"])
+        self.assertEqual(self.cache.stats["hits"], 1)
+        self.assertEqual(self.cache.stats["misses"], 1)
+
+    def test_lru_eviction(self):
+        for key in ["a", "b"]:
+            self.cache.put(key, make_message(key))
+        self.cache.get("a", {})
+        self.cache.put("c", make_message("c"))
+
+        self.assertIsNone(self.cache.get("b", {}))
+        self.assertIsNotNone(self.cache.get("a", {}))
+        self.assertEqual(self.cache.stats["evictions"], 1)
+
+    def test_ttl(self):
+        with patch("result_cache.time.time", return_value=1000.0):
+            self.cache.put("key", make_message("1"))
+        with patch("result_cache.time.time", return_value=1061.0):
+            self.assertIsNone(self.cache.get("key", {}))
+        self.assertEqual(self.cache.stats["expired"], 1)
+
+    def test_disk_tier(self):
+        directory = os.path.join(self.directory, "cache")
+        ResultCache(directory=directory).put("key", make_message("1"))
+
+        cache = ResultCache(directory=directory)
+        message = cache.get("key", make_value("2"))
+
+        self.assertEqual(
+            message["RequestPostTopicUUID"]["value"]["request_id"], "2"
+        )
+        self.assertEqual(cache.stats["disk_hits"], 1)
+
+    def test_invalid_disk_entries_are_misses(self):
+        directory = os.path.join(self.directory, "cache")
+        cache = ResultCache(directory=directory)
+        for data in ("[]", "{}", '{"expires": "soon", "message": {}}'):
+            with self.subTest(data=data):
+                with open(os.path.join(directory, "key.json"), "w") as file:
+                    file.write(data)
+                self.assertIsNone(cache.get("key", make_value("1")))
+        self.assertEqual(cache.stats["misses"], 3)
+
+    def test_disk_errors_keep_the_result(self):
+        directory = os.path.join(self.directory, "cache")
+        cache = ResultCache(directory=directory)
+
+        with patch(
+            "result_cache.tempfile.mkstemp", side_effect=OSError("full")
+        ), self.assertLogs(result_cache.log, "WARNING"):
+            cache.put("key", make_message("1"))
+
+        self.assertIsNotNone(cache.get("key", make_value("2")))
+        self.assertEqual(cache.stats["write_errors"], 1)
+        self.assertEqual(
+            metrics.cache_events.value("results", "write_errors"), 1
+        )
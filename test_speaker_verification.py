@@ -0,0 +1,186 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+
+import speaker_verification
+import test_helpers
+from backends import Backend, BackendRequest
+from speaker_verification import EmbeddingCache, SpeakerVerification, rank
+from test_helpers import reply, sent
+
+
+def request(request_id, **fields):
+    fields.setdefault("first_audio_file", "reference.wav")
+    return test_helpers.request(request_id, **fields)
+
+
+class TestSpeakerVerification(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp() + "/"
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        for name in ("reference.wav", "a.wav", "b.wav", "c.wav"):
+            with open(os.path.join(self.data_dir, name), "wb") as file:
+                file.write(name.encode())
+        self.backend = Backend("speaker_verification", 7070)
+        self.fallback = MagicMock()
+        self.pairwise = MagicMock()
+        self.handler = SpeakerVerification(
+            self.backend, self.fallback, self.pairwise, self.data_dir
+        )
+        self.addCleanup(self.handler.close)
+        self.ws = MagicMock()
+
+    def ranking(self):
+        return sent(self.ws)[-1]["value"]["ranking"]
+
+    @patch.object(BackendRequest, "send", autospec=True)
+    def test_candidates_are_ranked(self, mock_send):
+        scores = {"a.wav": 0.2, "b.wav": 0.9, "c.wav": 0.5}
+
+        def send(request):
+            if request.url.startswith(
+                "http://localhost:7070/speaker_embedding/"
+            ):
+                return reply(content={"embedding": [0.1, 0.2]})
+            candidate = request.url.split("/")[4]
+            self.assertEqual(request.parts[0].value, "[0.1,0.2]")
+            return reply(content={"score": scores[candidate]})
+
+        mock_send.side_effect = send
+        value = request("1", candidate_audio_files=["a.wav", "b.wav", "c.wav"])
+
+        self.handler(self.ws, value)
+
+        self.assertEqual(
+            [r["audio_file"] for r in self.ranking()],
+            ["b.wav", "c.wav", "a.wav"],
+        )
+        self.assertEqual(mock_send.call_count, 4)
+
+    @patch.object(BackendRequest, "send", autospec=True)
+    def test_reference_embedding_is_reused(self, mock_send):
+        mock_send.side_effect = lambda request: reply(
+            content={"embedding": [1.0], "score": 1.0}
+        )
+        value = request("1", candidate_audio_files=["a.wav"])
+
+        self.handler(self.ws, value)
+        self.handler(self.ws, value)
+
+        embedding_requests = [
+            call
+            for call in mock_send.call_args_list
+            if "/speaker_embedding/" in call.args[0].url
+        ]
+        self.assertEqual(len(embedding_requests), 1)
+        self.assertEqual(len(self.handler.embeddings), 1)
+
+    @patch.object(BackendRequest, "send", autospec=True)
+    def test_pairs_without_embedding_endpoint(self, mock_send):
+        mock_send.return_value = reply(404)
+        pair = Mock()
+        pair.send.side_effect = [
+            reply(content={"RequestPostTopicUUID": {"value": {"score": 1}}}),
+            reply(content={"RequestPostTopicUUID": {"value": {"score": 2}}}),
+        ]
+        self.handler.workers = 1
+        self.pairwise.return_value = pair
+
+        self.handler(
+            self.ws, request("1", candidate_audio_files=["a.wav", "b.wav"])
+        )
+
+        self.assertEqual(
+            [
+                c.args[0]["second_audio_file"]
+                for c in self.pairwise.call_args_list
+            ],
+            ["a.wav", "b.wav"],
+        )
+        self.assertEqual(
+            [(r["audio_file"], r["score"]) for r in self.ranking()],
+            [("b.wav", 2), ("a.wav", 1)],
+        )
+        pair.send.side_effect = None
+        pair.send.return_value = reply(content={"score": 3})
+        self.handler(self.ws, request("2", candidate_audio_files=["c.wav"]))
+
+        mock_send.assert_called_once()
+        self.assertEqual(self.ranking(), [{"score": 3, "audio_file": "c.wav"}])
+
+    @patch.object(BackendRequest, "send", autospec=True)
+    def test_failed_candidate(self, mock_send):
+        def send(request):
+            if "/speaker_embedding/" in request.url:
+                return reply(content={"embedding": [1.0]})
+            return reply(500)
+
+        mock_send.side_effect = send
+
+        self.handler(self.ws, request("1", candidate_audio_files=["a.wav"]))
+
+        self.assertEqual(
+            self.ranking(),
+            [{"status": "failed with 500", "audio_file": "a.wav"}],
+        )
+
+    @patch.object(BackendRequest, "send", autospec=True)
+    def test_invalid_embedding(self, mock_send):
+        value = request("1", candidate_audio_files=["a.wav"])
+
+        for content in [{"score": 1.0}, [0.1, 0.2]]:
+            with self.subTest(content=content):
+                mock_send.return_value = reply(content=content)
+
+                with self.assertLogs(speaker_verification.log, "WARNING"):
+                    self.handler(self.ws, value)
+
+        self.assertEqual(mock_send.call_count, 2)
+        self.ws.send.assert_not_called()
+
+    def test_request_without_candidates(self):
+        value = request("1", second_audio_file="a.wav")
+
+        self.handler(self.ws, value)
+
+        self.fallback.assert_called_once_with(self.ws, value)
+        self.assertIs(
+            self.handler.build(value), self.fallback.build.return_value
+        )
+        self.assertIsNone(
+            self.handler.build(request("2", candidate_audio_files=[]))
+        )
+
+    def test_missing_reference(self):
+        value = request(
+            "1", first_audio_file="missing.wav", candidate_audio_files=[]
+        )
+
+        with self.assertLogs(speaker_verification.log, "WARNING"):
+            self.handler(self.ws, value)
+
+        self.ws.send.assert_not_called()
+
+
+class TestRanking(unittest.TestCase):
+    def test_rank(self):
+        self.assertEqual(
+            rank([{"id": 1}, {"score": 0.5}, {"id": 2}, {"score": 0.7}]),
+            [{"score": 0.7}, {"score": 0.5}, {"id": 1}, {"id": 2}],
+        )
+
+    def test_embedding_cache(self):
+        cache = EmbeddingCache(max_size=2)
+        cache.put("a", [1])
+        cache.put("b", [2])
+        cache.get("a")
+        cache.put("c", [3])
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import tracing
+from backends import Backend, BackendRequest, Upload
+
+VALUE = {"request_id": "42", "requestor_id": "1", "file_name": "a.wav"}
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        file = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+        file.close()
+        self.path = file.name
+
+    def tearDown(self):
+        tracing.close()
+        os.unlink(self.path)
+
+    def handle(self):
+        trace = tracing.begin("SIFIS:Test", VALUE, time.perf_counter())
+        with tracing.activate(trace):
+            with tracing.span("inference", backend="test"):
+                with tracing.span("open"):
+                    pass
+            with self.assertRaises(ValueError):
+                with tracing.span("send"):
+                    raise ValueError
+        return trace
+
+    def test_off_by_default(self):
+        self.assertIsNone(tracing.begin("SIFIS:Test", VALUE, 0.0))
+        with tracing.activate(None):
+            self.assertIsNone(tracing.current())
+            with tracing.span("send"):
+                pass
+
+    def test_chrome_trace(self):
+        tracing.enable(self.path, "chrome")
+        trace = self.handle()
+        tracing.close()
+
+        with open(self.path) as file:
+            events = json.load(file)
+        spans = [event for event in events if event["ph"] == "X"]
+        self.assertEqual(
+            [span["name"] for span in spans],
+            ["SIFIS:Test", "parse", "queue", "open", "inference", "send"],
+        )
+        self.assertEqual({span["tid"] for span in spans}, {trace.number})
+        root, inference = spans[0], spans[4]
+        self.assertEqual(inference["args"]["request_id"], "42")
+        self.assertEqual(inference["args"]["backend"], "test")
+        self.assertEqual(spans[5]["args"]["error"], "ValueError")
+        for span in spans[1:]:
+            self.assertGreaterEqual(span["ts"], root["ts"])
+            self.assertLessEqual(
+                span["ts"] + span["dur"], root["ts"] + root["dur"]
+            )
+        self.assertEqual(events[0]["args"]["name"], "SIFIS:Test 42")
+
+    def test_otlp_trace(self):
+        tracing.enable(self.path, "otlp")
+        self.handle()
+        self.handle()
+        tracing.close()
+
+        with open(self.path) as file:
+            requests = [json.loads(line) for line in file]
+        self.assertEqual(len(requests), 2)
+        spans = requests[0]["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        by_name = {span["name"]: span for span in spans}
+        root = by_name["SIFIS:Test"]
+        self.assertNotIn("parentSpanId", root)
+        self.assertEqual(by_name["inference"]["parentSpanId"], root["spanId"])
+        self.assertEqual(
+            by_name["open"]["parentSpanId"], by_name["inference"]["spanId"]
+        )
+        self.assertEqual(
+            {span["traceId"] for span in spans}, {root["traceId"]}
+        )
+        self.assertEqual(by_name["send"]["status"], {"code": 2})
+        self.assertIn(
+            {"key": "request_id", "value": {"stringValue": "42"}},
+            root["attributes"],
+        )
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            tracing.enable(self.path, "xml")
+
+    @patch("requests.Session.request")
+    def test_backend_request_spans(self, mock_request):
+        def consume(*args, **kwargs):
+            b"".join(kwargs["data"])
+            return MagicMock(status_code=200)
+
+        mock_request.side_effect = consume
+        backend = Backend("face_recognition", 8090)
+        request = BackendRequest(
+            backend, "POST", backend.url(), parts=(Upload("file", self.path),)
+        )
+        tracing.enable(self.path + ".trace", "chrome")
+        trace = tracing.begin("SIFIS:Test", VALUE, time.perf_counter())
+        try:
+            with tracing.activate(trace):
+                request.send()
+        finally:
+            tracing.close()
+            os.unlink(self.path + ".trace")
+
+        self.assertEqual(
+            [span.name for span in trace.spans],
+            ["parse", "queue", "open", "upload", "inference"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
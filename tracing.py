@@ -0,0 +1,390 @@
+"""
+Tracing
+
+Shows where the time of a single request goes: decoding the DHT message,
+waiting for a worker, opening and uploading the files, the backend
+inference, decoding the response and sending the result message. Tracing is
+off until enable() is called, then the spans of each handled message are
+written to a local file when its handler ends.
+
+The file is in the Chrome trace event format, which chrome://tracing and
+https://ui.perfetto.dev open, or OTLP JSON lines, one
+ExportTraceServiceRequest per message, which OpenTelemetry tools read. The
+traces have the topic, request_id and requestor_id of their message.
+"""
+import contextvars
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import NamedTuple
+
+import logs
+
+FORMATS = ("chrome", "otlp")
+DEFAULT_FORMAT = "chrome"
+DEFAULT_QUEUE_SIZE = 1000
+SERVICE_NAME = "analytics_api"
+
+log = logs.get_logger("tracing")
+
+# Added to time.perf_counter() for the seconds since the epoch
+_epoch = time.time() - time.perf_counter()
+
+_current = contextvars.ContextVar("trace", default=None)
+_exporter = None
+_null = nullcontext()
+
+
+def _span_id():
+    return os.urandom(8).hex()
+
+
+class Span(NamedTuple):
+    """Stage of a trace, the times are from time.perf_counter()"""
+
+    name: str
+    start: float
+    end: float
+    span_id: str
+    parent_id: str
+    attributes: dict
+
+
+class Trace:
+    """
+    Spans of one handled DHT message
+
+    Parameters
+    ----------
+    topic_name : str
+        Topic of the message.
+    value : dict
+        "value" field of the message, for the request_id and requestor_id.
+    started : float
+        time.perf_counter() when the message was received.
+    """
+
+    _numbers = itertools.count(1)
+
+    def __init__(self, topic_name, value, started):
+        self.number = next(self._numbers)
+        self.trace_id = os.urandom(16).hex()
+        self.span_id = _span_id()
+        self.name = topic_name
+        self.started = started
+        self.ended = None
+        if not isinstance(value, dict):
+            value = {}
+        self.attributes = {"topic": topic_name}
+        for key in ("request_id", "requestor_id"):
+            if value.get(key) is not None:
+                self.attributes[key] = str(value[key])
+        self.spans = []
+        self._parents = [self.span_id]
+
+    def add(self, name, start, end, **attributes):
+        """Adds a span that has already ended"""
+        self.spans.append(
+            Span(name, start, end, _span_id(), self._parents[-1], attributes)
+        )
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Measures the with block as a span"""
+        span_id = _span_id()
+        parent_id = self._parents[-1]
+        self._parents.append(span_id)
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            self._parents.pop()
+            self.spans.append(
+                Span(
+                    name,
+                    start,
+                    time.perf_counter(),
+                    span_id,
+                    parent_id,
+                    attributes,
+                )
+            )
+
+    def root(self):
+        """Returns the span of the whole message"""
+        return Span(
+            self.name,
+            self.started,
+            self.ended or time.perf_counter(),
+            self.span_id,
+            None,
+            {},
+        )
+
+
+def begin(topic_name, value, started):
+    """
+    Starts the trace of a received message
+
+    The time from *started* to now is the "parse" span.
+
+    Returns
+    -------
+    Trace or None
+        None when tracing is off.
+    """
+    if _exporter is None:
+        return None
+    trace = Trace(topic_name, value, started)
+    trace.add("parse", started, time.perf_counter())
+    return trace
+
+
+def current():
+    """Returns the trace of the running handler or None"""
+    return _current.get()
+
+
+@contextmanager
+def activate(trace):
+    """
+    Makes *trace* current in the with block and exports it at the end
+
+    The time from the "parse" span to the with block is the "queue" span.
+    Does nothing when *trace* is None.
+    """
+    if trace is None:
+        yield
+        return
+    parsed = trace.spans[0].end if trace.spans else trace.started
+    trace.add("queue", parsed, time.perf_counter())
+    token = _current.set(trace)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        trace.ended = time.perf_counter()
+        exporter = _exporter
+        if exporter is not None:
+            exporter.export(trace)
+
+
+def span(name, **attributes):
+    """Measures the with block as a span of the current trace, if any"""
+    trace = _current.get()
+    if trace is None:
+        return _null
+    return trace.span(name, **attributes)
+
+
+def record(name, start, end, **attributes):
+    """Adds a span that has already ended to the current trace, if any"""
+    trace = _current.get()
+    if trace is not None and start is not None and end is not None:
+        trace.add(name, start, end, **attributes)
+
+
+class Traced:
+    """Topic handler run with its trace current"""
+
+    def __init__(self, trace, handler):
+        self.trace = trace
+        self.handler = handler
+
+    def __call__(self, ws, value):
+        with activate(self.trace):
+            return self.handler(ws, value)
+
+
+def _microseconds(seconds):
+    return round((seconds + _epoch) * 1e6)
+
+
+def chrome_events(trace):
+    """Returns the Chrome trace events of *trace*"""
+    pid = os.getpid()
+    label = trace.name
+    if "request_id" in trace.attributes:
+        label += f" {trace.attributes['request_id']}"
+    events = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": pid,
+            "tid": trace.number,
+            "args": {"name": label},
+        }
+    ]
+    for span in [trace.root()] + trace.spans:
+        start = _microseconds(span.start)
+        events.append(
+            {
+                "name": span.name,
+                "cat": trace.name,
+                "ph": "X",
+                "ts": start,
+                "dur": max(_microseconds(span.end) - start, 0),
+                "pid": pid,
+                "tid": trace.number,
+                "args": dict(trace.attributes, **span.attributes),
+            }
+        )
+    return events
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [
+        {"key": key, "value": _otlp_value(value)}
+        for key, value in attributes.items()
+    ]
+
+
+def _nanoseconds(seconds):
+    return str(round((seconds + _epoch) * 1e9))
+
+
+def otlp_request(trace):
+    """Returns *trace* as an OTLP JSON ExportTraceServiceRequest"""
+    spans = []
+    for span in [trace.root()] + trace.spans:
+        item = {
+            "traceId": trace.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": _nanoseconds(span.start),
+            "endTimeUnixNano": _nanoseconds(span.end),
+            "attributes": _otlp_attributes(
+                dict(trace.attributes, **span.attributes)
+            ),
+        }
+        if span.parent_id is not None:
+            item["parentSpanId"] = span.parent_id
+        if "error" in span.attributes:
+            item["status"] = {"code": 2}
+        spans.append(item)
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": _otlp_attributes(
+                        {"service.name": SERVICE_NAME}
+                    )
+                },
+                "scopeSpans": [
+                    {"scope": {"name": SERVICE_NAME}, "spans": spans}
+                ],
+            }
+        ]
+    }
+
+
+class Exporter:
+    """
+    Writes the ended traces to a file in a background thread
+
+    Traces not fitting on the queue are dropped and counted.
+
+    Parameters
+    ----------
+    path : str
+        File written, replaced if it exists.
+    trace_format : str
+        "chrome" or "otlp".
+    queue_size : int
+        Traces waiting to be written before new ones are dropped.
+    """
+
+    _stop = object()
+
+    def __init__(
+        self,
+        path,
+        trace_format=DEFAULT_FORMAT,
+        queue_size=DEFAULT_QUEUE_SIZE,
+    ):
+        if trace_format not in FORMATS:
+            raise ValueError(f"Unknown trace format {trace_format!r}")
+        self.format = trace_format
+        self.dropped = 0
+        self._file = open(path, "w")
+        self._events = 0
+        self._queue = queue.Queue(queue_size)
+        if self.format == "chrome":
+            # The events are an array, closed by close(). The trace viewers
+            # also read the file without the closing bracket.
+            self._file.write("[\n")
+        self._thread = threading.Thread(
+            target=self._run, name="tracing", daemon=True
+        )
+        self._thread.start()
+
+    def export(self, trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Writes the queued traces and closes the file"""
+        self._queue.put(self._stop)
+        self._thread.join()
+        if self.format == "chrome":
+            self._file.write("\n]\n")
+        self._file.close()
+        if self.dropped:
+            log.warning("Dropped %d traces", self.dropped)
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            if trace is self._stop:
+                return
+            try:
+                self._write(trace)
+            except Exception:
+                log.exception("Writing a trace failed")
+            if self._queue.empty():
+                self._file.flush()
+
+    def _write(self, trace):
+        if self.format == "otlp":
+            self._file.write(json.dumps(otlp_request(trace)) + "\n")
+            return
+        for event in chrome_events(trace):
+            if self._events:
+                self._file.write(",\n")
+            self._file.write(json.dumps(event))
+            self._events += 1
+
+
+def enable(path, trace_format=DEFAULT_FORMAT):
+    """Starts writing the traces to *path*"""
+    global _exporter
+    close()
+    _exporter = Exporter(path, trace_format)
+
+
+def close():
+    """Stops tracing and writes the remaining traces"""
+    global _exporter
+    exporter, _exporter = _exporter, None
+    if exporter is not None:
+        exporter.close()